@@ -0,0 +1,312 @@
+import bisect
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# edge-tts streams "audio-24khz-48kbitrate-mono-mp3" by default
+SAMPLE_RATE = 24000
+CHANNELS = 1
+SAMPLE_WIDTH = 2 # int16
+BYTES_PER_SECOND = SAMPLE_RATE * CHANNELS * SAMPLE_WIDTH
+RING_BUFFER_SECONDS = float(os.environ.get("AUDIO_RING_BUFFER_SECONDS", 30))
+BLOCK_FRAMES = 1024 # ~43 ms per output callback at 24 kHz
+
+class RingBuffer:
+    """Fixed-size byte FIFO between the decoder threads and the audio callback.
+
+    Writers block while it is full (backpressure on decoding); the reader never blocks.
+    """
+
+    def __init__(self, capacity):
+        self._buffer = bytearray(capacity)
+        self._capacity = capacity
+        self._start = 0
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def write(self, data, is_current=lambda: True):
+        """Appends data, waiting for space; gives up early if `is_current()` turns false (playback stopped)."""
+        view = memoryview(data)
+        while view:
+            with self._cond:
+                while self._size == self._capacity and is_current():
+                    self._cond.wait(0.1)
+                if not is_current():
+                    return
+                end = (self._start + self._size) % self._capacity
+                count = min(len(view), self._capacity - self._size, self._capacity - end)
+                self._buffer[end:end + count] = view[:count]
+                self._size += count
+            view = view[count:]
+
+    def read(self, count):
+        """Removes and returns up to `count` bytes (fewer if not enough are buffered)."""
+        with self._cond:
+            count = min(count, self._size)
+            first = min(count, self._capacity - self._start)
+            data = bytes(self._buffer[self._start:self._start + first]) + bytes(self._buffer[:count - first])
+            self._start = (self._start + count) % self._capacity
+            self._size -= count
+            self._cond.notify_all()
+            return data
+
+    def clear(self):
+        with self._cond:
+            self._start = self._size = 0
+            self._cond.notify_all()
+
+    def __len__(self):
+        return self._size
+
+# --- Sinks ---
+class AudioSink:
+    """Playback target for MP3 audio as it is synthesized.
+
+    Call `feed_mp3` with encoded bytes as they arrive and `end_utterance` after the last bytes of
+    one synthesis; `wait_until_drained` blocks until everything fed so far has been played and
+    `stop` discards whatever has not been played yet. None of the feed calls block.
+    """
+
+    def __init__(self):
+        self.counters = {"utterances": 0, "mp3_bytes": 0, "underruns": 0, "stops": 0}
+
+    def feed_mp3(self, data):
+        self.counters["mp3_bytes"] += len(data)
+
+    def end_utterance(self):
+        self.counters["utterances"] += 1
+
+    def buffered_ms(self):
+        return 0
+
+    def utterances_started(self):
+        """Utterances whose playback has begun (or been dropped by `stop`), counted since the sink was created."""
+        return self.counters["utterances"]
+
+    def wait_until_drained(self, timeout=None):
+        return True
+
+    def stop(self):
+        self.counters["stops"] += 1
+
+    def close(self):
+        pass
+
+    def metrics(self):
+        return dict(self.counters)
+
+class NullSink(AudioSink):
+    """Discards audio (headless runs and tests); only the counters are kept."""
+
+class FileSink(AudioSink):
+    """Appends the MP3 stream to a file, which stays playable because MP3 frames concatenate."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+
+    def feed_mp3(self, data):
+        super().feed_mp3(data)
+        with self._lock:
+            self._file.write(data)
+
+    def end_utterance(self):
+        super().end_utterance()
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class StreamingSink(AudioSink):
+    """Decodes MP3 in memory with ffmpeg and plays the PCM through one long-lived sounddevice stream.
+
+    Each utterance gets its own ffmpeg process fed over stdin (closing stdin flushes the decoder's
+    last frames), and its PCM is appended to a ring buffer in utterance order. The output stream
+    runs continuously and plays silence when the buffer is empty, so consecutive utterances are
+    gapless as long as decoding stays ahead. An empty buffer while more audio is expected counts
+    as an underrun.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, channels=CHANNELS, device=None):
+        super().__init__()
+        import sounddevice as sd # PortAudio is loaded here, so headless machines can still import this module
+        self.ffmpeg = shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise RuntimeError("ffmpeg not found on PATH; it is needed to decode MP3")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bytes_per_second = sample_rate * channels * SAMPLE_WIDTH
+        self.counters.update(max_buffered_ms=0)
+        self._ring = RingBuffer(int(RING_BUFFER_SECONDS * self.bytes_per_second))
+        self._commands = queue.Queue() # ("data", bytes) / ("end", None), applied in order by the feeder thread
+        self._lock = threading.Lock()
+        self._generation = 0 # Bumped by stop(); decoders from older generations discard their output
+        self._decoder = None # ffmpeg process for the utterance currently being fed
+        self._readers = [] # Reader threads still producing PCM, oldest first
+        self._busy = False
+        self._written_bytes = 0 # PCM bytes written to the ring buffer so far
+        self._played_bytes = 0 # PCM bytes handed to the device (or dropped by stop) so far
+        self._utterance_offsets = [] # _written_bytes at the start of each utterance's PCM, ascending
+        self._feeder = threading.Thread(target=self._feed_loop, daemon=True, name="audio-feed")
+        self._feeder.start()
+        self._stream = sd.RawOutputStream(
+            samplerate=sample_rate, channels=channels, dtype="int16", blocksize=BLOCK_FRAMES, callback=self._callback,
+        )
+        self._stream.start()
+
+    # --- Feeding and decoding ---
+    def feed_mp3(self, data):
+        if data:
+            super().feed_mp3(data)
+            self._commands.put(("data", bytes(data)))
+
+    def end_utterance(self):
+        super().end_utterance()
+        self._commands.put(("end", None))
+
+    def _start_decoder(self):
+        process = subprocess.Popen(
+            [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-fflags", "nobuffer", "-probesize", "32",
+             "-analyzeduration", "0", "-f", "mp3", "-i", "pipe:0",
+             "-f", "s16le", "-ac", str(self.channels), "-ar", str(self.sample_rate), "pipe:1"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0,
+        )
+        with self._lock:
+            generation = self._generation
+            previous = self._readers[-1] if self._readers else None
+            reader = threading.Thread(target=self._read_pcm, args=(process, previous, generation), daemon=True, name="audio-decode")
+            self._readers.append(reader)
+        reader.start()
+        return process
+
+    def _read_pcm(self, process, previous, generation):
+        is_current = lambda: self._generation == generation
+        first = True
+        try:
+            if previous:
+                previous.join() # Keep utterances in order; this one decodes ahead into its pipe meanwhile
+            while True:
+                pcm = os.read(process.stdout.fileno(), 8192)
+                if not pcm:
+                    break
+                if is_current():
+                    if first:
+                        self._utterance_offsets.append(self._written_bytes)
+                        first = False
+                    self._ring.write(pcm, is_current)
+                    self._written_bytes += len(pcm)
+                    buffered_ms = len(self._ring) * 1000 // self.bytes_per_second
+                    self.counters["max_buffered_ms"] = max(self.counters["max_buffered_ms"], buffered_ms)
+        finally:
+            process.stdout.close()
+            process.wait()
+            with self._lock:
+                self._readers.remove(threading.current_thread())
+
+    def _feed_loop(self):
+        while True:
+            command, data = self._commands.get()
+            self._busy = True
+            try:
+                if command == "close":
+                    return
+                if command == "data":
+                    if self._decoder is None:
+                        self._decoder = self._start_decoder()
+                    self._decoder.stdin.write(data)
+                elif command == "end" and self._decoder is not None:
+                    self._decoder.stdin.close() # EOF makes ffmpeg flush the utterance's last frames
+                    self._decoder = None
+            except (BrokenPipeError, OSError) as e:
+                if self._decoder is not None:
+                    logger.warning(f"MP3 decoder stopped unexpectedly: {e}")
+                    self._decoder.kill()
+                    self._decoder = None
+            finally:
+                self._busy = not self._commands.empty()
+
+    # --- Playback ---
+    def _callback(self, outdata, frames, time_info, status):
+        needed = frames * self.channels * SAMPLE_WIDTH
+        pcm = self._ring.read(needed)
+        outdata[:len(pcm)] = pcm
+        self._played_bytes += len(pcm)
+        if len(pcm) < needed:
+            outdata[len(pcm):] = b"\x00" * (needed - len(pcm))
+            if self._audio_expected():
+                self.counters["underruns"] += 1
+        if status.output_underflow:
+            self.counters["underruns"] += 1
+
+    def _audio_expected(self):
+        return self._busy or not self._commands.empty() or bool(self._readers) or self._decoder is not None
+
+    def buffered_ms(self):
+        """Decoded audio waiting to be played (the queue depth), in milliseconds."""
+        return len(self._ring) * 1000 // self.bytes_per_second
+
+    def utterances_started(self):
+        """Utterances whose first audio has reached the device (or was dropped by `stop`)."""
+        return bisect.bisect_left(self._utterance_offsets, self._played_bytes)
+
+    def wait_until_drained(self, timeout=None):
+        """Blocks until all fed audio has been played; returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._audio_expected() or len(self._ring):
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        time.sleep(self._stream.latency) # Let the device play out its last block
+        return True
+
+    def stop(self):
+        """Drops everything not yet played (used when the user interrupts)."""
+        super().stop()
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                self._commands.get_nowait()
+            except queue.Empty:
+                break
+        self._commands.put(("end", None)) # Closes the current decoder from the feeder thread
+        self._ring.clear()
+        self._played_bytes = self._written_bytes # Dropped audio counts as played for utterances_started
+
+    def close(self):
+        self.stop()
+        self._commands.put(("close", None))
+        self._feeder.join(timeout=2)
+        self._stream.stop()
+        self._stream.close()
+
+    def metrics(self):
+        metrics = super().metrics()
+        metrics["buffered_ms"] = self.buffered_ms()
+        return metrics
+
+def make_sink(kind=None):
+    """Builds the sink named by `kind` or the AUDIO_SINK env var: 'stream' (default), 'null' or 'file:<path>'.
+
+    Falls back to a NullSink when no audio device or ffmpeg is available.
+    """
+    kind = kind or os.environ.get("AUDIO_SINK", "stream")
+    if kind == "null":
+        return NullSink()
+    if kind.startswith("file:"):
+        return FileSink(kind[len("file:"):])
+    try:
+        return StreamingSink()
+    except Exception as e: # No PortAudio, no output device, or no ffmpeg
+        logger.warning(f"Audio playback unavailable ({e}); using a null sink.")
+        return NullSink()
@@ -0,0 +1,226 @@
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import threading
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Batch Settings ---
+DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))
+DEFAULT_REQUESTS_PER_MINUTE = float(os.environ.get("BATCH_REQUESTS_PER_MINUTE", 60))
+MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 5))
+RETRY_BASE_DELAY_SECONDS = 2.0
+RETRY_MAX_DELAY_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# --- Input / Checkpoint Handling ---
+def read_inquiries(path):
+    """Reads a JSONL file of {"id", "inquiry"} objects; lines without an id get "line-<n>".
+
+    Blank lines are skipped; malformed lines and duplicate ids are logged and skipped.
+    """
+    items, seen = [], set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                logger.warning(f"Skipping malformed line {line_number} in {path}: {e}")
+                continue
+            inquiry = record.get("inquiry") if isinstance(record, dict) else None
+            if not inquiry:
+                logger.warning(f"Skipping line {line_number} in {path}: missing 'inquiry' field.")
+                continue
+            item_id = f"line-{line_number}" if record.get("id") is None else str(record["id"]) # 0 and "" are valid ids
+            if item_id in seen:
+                logger.warning(f"Skipping line {line_number} in {path}: duplicate id '{item_id}'.")
+                continue
+            seen.add(item_id)
+            items.append({"id": item_id, "inquiry": inquiry})
+    return items
+
+def load_completed_ids(out_path):
+    """Ids already answered successfully in an existing output file (the resume checkpoint)."""
+    completed = set()
+    try:
+        with open(out_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # A line cut short by a crash; that item is simply retried
+                if isinstance(record, dict) and record.get("status") == "ok":
+                    completed.add(str(record.get("id")))
+    except FileNotFoundError:
+        pass
+    return completed
+
+class ResultWriter:
+    """Appends one JSON line per finished item, flushed and fsynced so a crash loses at most the line in progress."""
+
+    def __init__(self, out_path):
+        self._lock = threading.Lock()
+        needs_newline = False
+        if os.path.exists(out_path) and os.path.getsize(out_path) > 0:
+            with open(out_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(out_path, "a", encoding="utf-8")
+        if needs_newline: # Terminate a partial line left by a crash so the next record parses
+            self._file.write("\n")
+
+    def write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+# --- Rate Limiting ---
+class RateLimiter:
+    """Token bucket shared by all batch workers, with a global pause when the API returns 429."""
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, burst=None):
+        if not requests_per_minute > 0:
+            raise ValueError(f"requests_per_minute must be positive, got {requests_per_minute}")
+        self.rate = requests_per_minute / 60.0
+        self.capacity = burst or max(1.0, min(requests_per_minute / 6.0, 10.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Holds back every worker for `seconds` (used after a rate-limit response)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+def error_status(error):
+    """HTTP status carried by a GenAI API error (None for other exceptions)."""
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return status if isinstance(status, int) else None
+
+# --- Batch Runner ---
+def _run_item(item, generate_fn, limiter, max_attempts):
+    start_time = time.perf_counter()
+    for attempt in range(1, max_attempts + 1):
+        with metrics.timer("queue_seconds", stage="rate_limit"):
+            limiter.acquire()
+        try:
+            response_text, usage, source = generate_fn(item["inquiry"])
+            return {
+                "id": item["id"],
+                "status": "ok",
+                "response": response_text,
+                "source": source,
+                "latency_ms": round((time.perf_counter() - start_time) * 1000, 1),
+                "attempts": attempt,
+                "usage": usage,
+            }
+        except Exception as error:
+            status = error_status(error)
+            if attempt >= max_attempts or status not in RETRYABLE_STATUS_CODES:
+                logger.error(f"[{item['id']}] Failed after {attempt} attempt(s): {error}")
+                return {
+                    "id": item["id"],
+                    "status": "error",
+                    "error": f"{type(error).__name__}: {error}",
+                    "latency_ms": round((time.perf_counter() - start_time) * 1000, 1),
+                    "attempts": attempt,
+                }
+            delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1))) * random.uniform(0.75, 1.25)
+            if status == 429:
+                limiter.pause(delay) # Quota is shared, so every worker backs off together
+            logger.warning(f"[{item['id']}] HTTP {status}; retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+
+def run_batch(items, generate_fn, on_result=None, concurrency=DEFAULT_CONCURRENCY,
+              requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, max_attempts=MAX_ATTEMPTS):
+    """Answers `items` ([{"id", "inquiry"}]) concurrently and returns their result records in input order.
+
+    `generate_fn(inquiry)` returns (response_text, usage dict or None, source) and raises on failure;
+    errors with a 429/5xx status are retried with backoff, under a shared requests-per-minute budget.
+    `on_result(record)` is called from worker threads as each item finishes (e.g. to checkpoint it).
+    """
+    limiter = RateLimiter(requests_per_minute)
+    results = {}
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch") as executor:
+        future_to_id = {executor.submit(_run_item, item, generate_fn, limiter, max_attempts): item["id"] for item in items}
+        for done_count, future in enumerate(concurrent.futures.as_completed(future_to_id), start=1):
+            record = future.result()
+            results[record["id"]] = record
+            if on_result:
+                on_result(record)
+            logger.info(f"[{done_count}/{len(items)}] {record['id']}: {record['status']} in {record['latency_ms']:.0f} ms")
+    elapsed = time.perf_counter() - start_time
+    ordered = [results[item["id"]] for item in items]
+    logger.info(f"Batch finished: {len(ordered)} items in {elapsed:.1f}s, {sum(r['status'] == 'error' for r in ordered)} failed.")
+    return ordered
+
+def summarize(records, elapsed_seconds=None):
+    """Counts, latency percentiles and token totals for a list of result records."""
+    ok = [r for r in records if r["status"] == "ok"]
+    latencies = sorted(r["latency_ms"] for r in ok)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))] if latencies else None
+    tokens = {"input_tokens": 0, "output_tokens": 0, "cached_tokens": 0}
+    for record in ok:
+        for key in tokens:
+            tokens[key] += (record.get("usage") or {}).get(key) or 0
+    summary = {
+        "total": len(records),
+        "ok": len(ok),
+        "failed": len(records) - len(ok),
+        "latency_ms": {"p50": percentile(50), "p95": percentile(95), "max": latencies[-1] if latencies else None},
+        "tokens": tokens,
+    }
+    if elapsed_seconds:
+        summary["elapsed_seconds"] = round(elapsed_seconds, 1)
+    return summary
+
+def run_batch_file(in_path, out_path, generate_fn, concurrency=DEFAULT_CONCURRENCY, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE):
+    """Runs a JSONL batch, appending results to `out_path` and skipping ids already answered there.
+
+    Re-running after a crash (or with failures) resumes from the checkpoint. Returns the summary
+    of the items processed in this run.
+    """
+    items = read_inquiries(in_path)
+    completed = load_completed_ids(out_path)
+    pending = [item for item in items if item["id"] not in completed]
+    logger.info(f"Batch {in_path}: {len(items)} inquiries, {len(items) - len(pending)} already answered in {out_path}, {len(pending)} to run.")
+    if not pending:
+        return summarize([])
+
+    writer = ResultWriter(out_path)
+    start_time = time.perf_counter()
+    try:
+        records = run_batch(pending, generate_fn, on_result=writer.write, concurrency=concurrency, requests_per_minute=requests_per_minute)
+    finally:
+        writer.close()
+    return summarize(records, time.perf_counter() - start_time)
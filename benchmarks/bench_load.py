@@ -0,0 +1,277 @@
+"""Load and latency benchmark for the webhook workers and main.generate_response against a local fake Gemini server.
+
+Each target is driven at increasing concurrency. For every level the benchmark reports p50/p95/p99
+latency, time-to-first-token (streamed requests), throughput and the server's resident memory.
+Results are written as JSON so runs can be compared between commits.
+
+    python benchmarks/bench_load.py [--targets flask asgi cli] [--concurrency 1 4 16 64] [--output results.json]
+
+Targets:
+    flask  worker.py (Flask, threaded) in a subprocess
+    asgi   worker_asgi.py (Starlette on uvicorn) in a subprocess
+    cli    main.generate_response called from threads in this process (needs sys_prompts.json)
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import concurrent.futures
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fake_gemini import FakeGeminiServer
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark webhook and CLI latency under concurrent load against a local fake Gemini server.")
+    parser.add_argument("--targets", nargs="+", choices=["flask", "asgi", "cli"], default=["flask", "asgi", "cli"], help="What to drive.")
+    parser.add_argument("--modes", nargs="+", choices=["blocking", "stream"], default=["blocking", "stream"], help="Webhook response modes to measure.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="Concurrency levels.")
+    parser.add_argument("--requests-per-level", type=int, help="Requests per level (default: 4x concurrency, at least 8).")
+    parser.add_argument("--ttft-ms", type=int, default=400, help="Fake server delay before the first chunk.")
+    parser.add_argument("--token-ms", type=float, default=8, help="Fake server delay per output token.")
+    parser.add_argument("--response-tokens", type=int, default=150, help="Output tokens per fake response.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake Gemini calls answered with HTTP 429.")
+    parser.add_argument("--output", help="Write results as JSON to this path.")
+    parser.add_argument("--serve", choices=["flask", "asgi"], help=argparse.SUPPRESS) # Internal: run a worker subprocess
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+# --- Worker Subprocess ---
+def serve_worker(kind, port, base_url):
+    """Runs a worker whose GenAI client points at the fake server, skipping Drive sync and uploads."""
+    from google import genai
+    from google.genai import types
+    import worker
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    worker.genai_client = genai.Client(api_key="bench-key", http_options=types.HttpOptions(base_url=base_url))
+    # A file reference keeps the request payload shaped like production without a real upload
+    worker.knowledge_base = {
+        "version": "bench", "file_paths": {}, "drone_index": None, "built_at": time.time(),
+        "file_parts": (types.Part.from_uri(file_uri=f"{base_url}/v1beta/files/bench-kb", mime_type="text/plain"),),
+    }
+    worker.context_cache = None
+    worker.response_cache = None # Every request must reach the model to measure it
+    worker.is_initialized = True
+
+    if kind == "flask":
+        worker.app.run(host="127.0.0.1", port=port, debug=False, threaded=True)
+    else:
+        import uvicorn
+        import worker_asgi
+        uvicorn.run(worker_asgi.app, host="127.0.0.1", port=port, log_level="warning", backlog=2048)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_worker(kind, base_url, timeout=60):
+    """Starts a worker subprocess and waits for /health; returns (process, port)."""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", kind, "--port", str(port), "--base-url", base_url],
+        cwd=REPO_DIR,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{kind} worker exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return process, port
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{kind} worker did not become healthy within {timeout}s")
+
+def process_memory_mb(pid):
+    """(current RSS, peak RSS) in MB from /proc (Linux); (None, None) elsewhere."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, amount = line.split(":")
+                    values[key] = round(int(amount.split()[0]) / 1024, 1)
+    except OSError:
+        return None, None
+    return values.get("VmRSS"), values.get("VmHWM")
+
+# --- Request Drivers ---
+def send_webhook(port, inquiry, stream):
+    """Posts one inquiry; returns (ok, latency_ms, ttft_ms)."""
+    start_time = time.perf_counter()
+    ttft_ms = None
+    ok = False
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+        conn.request("POST", "/webhook", json.dumps({"inquiry": inquiry, "stream": stream}), {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        if stream and response.status == 200:
+            for line in response:
+                if line.startswith(b"event: chunk") and ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - start_time) * 1000
+                elif line.startswith(b"event: done"):
+                    ok = True
+                elif line.startswith(b"event: error"):
+                    ok = False
+        else:
+            ok = response.status == 200 and "response" in json.loads(response.read() or b"{}")
+        conn.close()
+    except (OSError, ValueError, http.client.HTTPException):
+        ok = False
+    return ok, (time.perf_counter() - start_time) * 1000, ttft_ms
+
+class FirstTokenTimer:
+    """Stdout replacement that records, per thread, when generate_response prints its first streamed text."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def arm(self):
+        self._local.start, self._local.streaming, self._local.ttft_ms = time.perf_counter(), False, None
+
+    def ttft_ms(self):
+        return getattr(self._local, "ttft_ms", None)
+
+    def write(self, text):
+        if not hasattr(self._local, "start") or not text.strip():
+            return len(text)
+        if text.startswith("📚 Context:"): # Printed right before the model stream starts
+            self._local.streaming = True
+        elif self._local.streaming and self._local.ttft_ms is None:
+            self._local.ttft_ms = (time.perf_counter() - self._local.start) * 1000
+        return len(text)
+
+    def flush(self):
+        pass
+
+def make_cli_driver(base_url):
+    """Returns a callable(inquiry) -> (ok, latency_ms, ttft_ms) that runs main.generate_response."""
+    from google import genai
+    from google.genai import types
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    client = genai.Client(api_key="bench-key", http_options=types.HttpOptions(base_url=base_url))
+    file_parts = [types.Part.from_uri(file_uri=f"{base_url}/v1beta/files/bench-kb", mime_type="text/plain")]
+    timer = FirstTokenTimer()
+
+    def run(inquiry):
+        timer.arm()
+        start_time = time.perf_counter()
+        usage_metadata, history = main.generate_response(client, file_parts, inquiry, [])
+        ok = usage_metadata is not None and len(history) == 2
+        return ok, (time.perf_counter() - start_time) * 1000, timer.ttft_ms()
+    return run, timer
+
+# --- Measurement ---
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))], 1)
+
+def run_level(send, concurrency, request_count):
+    """Sends `request_count` inquiries with `concurrency` in flight; returns latency/TTFT/throughput stats."""
+    inquiries = [f"Name: Bench {i}\nMessage: Is drone model {i} supported with the RC Pro controller?" for i in range(request_count)]
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, inquiries))
+    elapsed = time.perf_counter() - start_time
+    latencies = [latency for ok, latency, _ in outcomes if ok]
+    ttfts = [ttft for ok, _, ttft in outcomes if ok and ttft is not None]
+    return {
+        "concurrency": concurrency,
+        "requests": request_count,
+        "ok": len(latencies),
+        "errors": request_count - len(latencies),
+        "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99)},
+        "ttft_ms": {"p50": percentile(ttfts, 50), "p95": percentile(ttfts, 95), "p99": percentile(ttfts, 99)},
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "elapsed_seconds": round(elapsed, 2),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_arguments()
+    if args.serve:
+        serve_worker(args.serve, args.port, args.base_url)
+        return
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    fake = FakeGeminiServer(ttft_ms=args.ttft_ms, token_ms=args.token_ms, response_tokens=args.response_tokens, error_rate=args.error_rate).start()
+    results = []
+    try:
+        for target in args.targets:
+            if target == "cli":
+                if not os.path.exists(os.path.join(REPO_DIR, "sys_prompts.json")):
+                    print("Skipping cli target: sys_prompts.json not found in the repository root.")
+                    continue
+                os.chdir(REPO_DIR)
+                send, timer = make_cli_driver(fake.base_url)
+                for concurrency in args.concurrency:
+                    count = args.requests_per_level or max(8, concurrency * 4)
+                    with contextlib.redirect_stdout(timer):
+                        level = run_level(send, concurrency, count)
+                    level.update(target="cli", mode="stream", rss_mb=None, peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1))
+                    results.append(level)
+                    print(json.dumps(level))
+                continue
+
+            try:
+                process, port = start_worker(target, fake.base_url)
+            except RuntimeError as e:
+                print(f"Skipping {target} target: {e}")
+                continue
+            try:
+                for mode in args.modes:
+                    for concurrency in args.concurrency:
+                        count = args.requests_per_level or max(8, concurrency * 4)
+                        level = run_level(lambda inquiry: send_webhook(port, inquiry, mode == "stream"), concurrency, count)
+                        rss_mb, peak_rss_mb = process_memory_mb(process.pid)
+                        level.update(target=target, mode=mode, rss_mb=rss_mb, peak_rss_mb=peak_rss_mb)
+                        results.append(level)
+                        print(json.dumps(level))
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+    finally:
+        fake.stop()
+
+    report = {
+        "commit": git_commit(),
+        "fake_server": {"ttft_ms": args.ttft_ms, "token_ms": args.token_ms, "response_tokens": args.response_tokens, "error_rate": args.error_rate},
+        "results": results,
+    }
+    print(f"\n{'target':<6} {'mode':<8} {'conc':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'ttft50':>8} {'rps':>7} {'rss MB':>7} {'err':>4}")
+    for r in results:
+        print(f"{r['target']:<6} {r['mode']:<8} {r['concurrency']:>4} {r['latency_ms']['p50'] or 0:>8.0f} {r['latency_ms']['p95'] or 0:>8.0f} "
+              f"{r['latency_ms']['p99'] or 0:>8.0f} {r['ttft_ms']['p50'] or 0:>8.0f} {r['throughput_rps'] or 0:>7.1f} "
+              f"{r['peak_rss_mb'] or 0:>7.1f} {r['errors']:>4}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Startup benchmark for the CLI and voice entry points.
+
+Times `<script> --help` and a bare `import <module>` (the cost every run pays before any work) in fresh
+interpreters, and breaks the import down per top-level package with `python -X importtime`. Heavy
+packages that only some code paths need (Drive client, audio, speech) are flagged if they still load.
+
+    python benchmarks/bench_startup.py [--repeat 5] [--top 15] [--output results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["main", "voice_goog", "voice_msft"]
+
+# Packages that should only load on the code path that needs them
+LAZY_PACKAGES = [
+    "googleapiclient", "google_auth_oauthlib", "google_auth_httplib2", "httplib2", "google.oauth2",
+    "pygame", "pydub", "sounddevice", "soundfile", "google.cloud.speech", "edge_tts",
+]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark entry-point startup time and per-package import cost.")
+    parser.add_argument("--entry-points", nargs="+", default=ENTRY_POINTS, help="Modules to benchmark (run from the repo root).")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per scenario; the median is reported.")
+    parser.add_argument("--top", type=int, default=15, help="Top-level packages to list per scenario, by cumulative import time.")
+    parser.add_argument("--output", help="Write results as JSON to this path.")
+    return parser.parse_args()
+
+def parse_importtime(stderr):
+    """{"packages": {top-level package: cumulative us}, "modules": set of every imported module} from -X importtime output."""
+    packages, modules = {}, set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        name_field = fields[2][1:] # One space follows the separator; the rest is two per nesting level
+        name = name_field.strip()
+        modules.add(name)
+        if name_field == name: # Top level: imported directly by the script
+            packages[name] = packages.get(name, 0) + int(fields[1])
+    return {"packages": packages, "modules": modules}
+
+def run_scenario(command, repeat):
+    """Runs `command` `repeat` times in fresh interpreters; returns wall times plus the last run's import profile."""
+    wall_ms = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=REPO_DIR, capture_output=True, text=True)
+        wall_ms.append((time.perf_counter() - start_time) * 1000)
+        if proc.returncode != 0:
+            error = [line for line in proc.stderr.splitlines() if not line.startswith("import time:")]
+            return {"error": "\n".join(error[-3:]) or f"exit code {proc.returncode}"}
+    profile = parse_importtime(proc.stderr)
+    loaded_lazy = sorted(
+        package for package in LAZY_PACKAGES
+        if any(module == package or module.startswith(package + ".") for module in profile["modules"])
+    )
+    return {
+        "median_ms": round(statistics.median(wall_ms), 1),
+        "min_ms": round(min(wall_ms), 1),
+        "import_ms": round(sum(profile["packages"].values()) / 1000, 1),
+        "modules": len(profile["modules"]),
+        "packages_ms": {name: round(us / 1000, 1) for name, us in sorted(profile["packages"].items(), key=lambda item: -item[1])},
+        "lazy_packages_loaded": loaded_lazy,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = parse_arguments()
+    baseline = run_scenario(["-c", "pass"], args.repeat)
+    print(f"Interpreter baseline: {baseline.get('median_ms')} ms")
+
+    results = []
+    for module in args.entry_points:
+        for label, command in ((f"{module}.py --help", [f"{module}.py", "--help"]), (f"import {module}", ["-c", f"import {module}"])):
+            result = dict(scenario=label, **run_scenario(command, args.repeat))
+            results.append(result)
+            if "error" in result:
+                print(f"\n{label}: failed ({result['error']})")
+                continue
+            print(f"\n{label}: {result['median_ms']} ms median (min {result['min_ms']} ms), {result['import_ms']} ms importing {result['modules']} modules")
+            for name, ms in list(result["packages_ms"].items())[:args.top]:
+                print(f"  {ms:8.1f} ms  {name}")
+            if result["lazy_packages_loaded"]:
+                print(f"  Loaded at startup but only needed on some paths: {', '.join(result['lazy_packages_loaded'])}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "startup", "commit": git_commit(), "python": sys.version.split()[0],
+                       "repeat": args.repeat, "baseline_ms": baseline.get("median_ms"), "results": results}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Offline comparison of full-context and retrieval-mode answers.
+
+Runs each inquiry twice (all documents inline vs. top-k retrieved passages) and reports answer
+overlap, link agreement, prompt-token cost and latency. Inquiries are read from a JSONL file with
+one {"inquiry": "..."} object per line.
+
+    python benchmarks/eval_retrieval.py --inquiries eval_inquiries.jsonl [--top-k 6] [--embeddings] [--output eval.jsonl]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.genai import types
+import main
+from retrieval import load_or_build_index, tokenize
+
+URL_PATTERN = re.compile(r"https?://\S+")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compare full-context and retrieval answers on a set of inquiries.")
+    parser.add_argument("--inquiries", required=True, help="JSONL file with one {\"inquiry\": ...} per line.")
+    parser.add_argument("--model-str", default="models/gemini-2.0-flash-001", help="Model to generate with.")
+    parser.add_argument("--top-k", type=int, default=6, help="Passages per inquiry in retrieval mode.")
+    parser.add_argument("--embeddings", action="store_true", help="Use hybrid BM25 + embedding retrieval.")
+    parser.add_argument("--output", help="Write per-inquiry results as JSONL to this path.")
+    return parser.parse_args()
+
+def unigram_f1(reference, candidate):
+    """Token-overlap F1 between two answers (ROUGE-1 style)."""
+    ref, cand = Counter(tokenize(reference)), Counter(tokenize(candidate))
+    overlap = sum((ref & cand).values())
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / sum(cand.values()), overlap / sum(ref.values())
+    return 2 * precision * recall / (precision + recall)
+
+def link_agreement(reference, candidate):
+    """Jaccard similarity of the URLs cited in two answers (1.0 when neither cites any)."""
+    ref = {url.rstrip(".,)") for url in URL_PATTERN.findall(reference)}
+    cand = {url.rstrip(".,)") for url in URL_PATTERN.findall(candidate)}
+    if not ref and not cand:
+        return 1.0
+    return len(ref & cand) / len(ref | cand)
+
+def run_mode(client, file_parts, system_text, model_str, inquiry, index, top_k):
+    prefix_contents, _, context_mode = main.build_context_prefix(
+        client, file_parts, system_text, model_str, inquiry, index=index, cache=None, top_k=top_k,
+    )
+    contents = prefix_contents + [types.Content(role="user", parts=[
+        types.Part.from_text(text="--- User Inquiry ---"),
+        types.Part.from_text(text=inquiry),
+    ])]
+    start_time = time.perf_counter()
+    response = client.models.generate_content(
+        model=model_str,
+        contents=contents,
+        config=types.GenerateContentConfig(temperature=0, response_mime_type="text/plain"),
+    )
+    latency = time.perf_counter() - start_time
+    usage = response.usage_metadata
+    return {
+        "mode": context_mode,
+        "text": response.text or "",
+        "prompt_tokens": usage.prompt_token_count if usage else None,
+        "output_tokens": usage.candidates_token_count if usage else None,
+        "latency_s": round(latency, 3),
+    }
+
+def main_eval():
+    args = parse_arguments()
+    with open(args.inquiries, "r") as f:
+        inquiries = [json.loads(line)["inquiry"] for line in f if line.strip()]
+    if not inquiries:
+        sys.exit(f"No inquiries found in {args.inquiries}.")
+
+    client, file_parts = main.prepare_context_files(False)
+    if not client:
+        sys.exit("Could not prepare context files.")
+    index = load_or_build_index("drive", main.prepared_file_paths, main.knowledge_base_version, client=client, use_embeddings=args.embeddings)
+    system_text = main.load_system_prompt()
+
+    results = []
+    for number, inquiry in enumerate(inquiries, 1):
+        full = run_mode(client, file_parts, system_text, args.model_str, inquiry, None, args.top_k)
+        retrieved = run_mode(client, file_parts, system_text, args.model_str, inquiry, index, args.top_k)
+        result = {
+            "inquiry": inquiry,
+            "full": full,
+            "retrieval": retrieved,
+            "answer_f1": round(unigram_f1(full["text"], retrieved["text"]), 3),
+            "link_agreement": round(link_agreement(full["text"], retrieved["text"]), 3),
+        }
+        results.append(result)
+        print(f"[{number}/{len(inquiries)}] F1={result['answer_f1']:.2f} links={result['link_agreement']:.2f} "
+              f"tokens {full['prompt_tokens']} -> {retrieved['prompt_tokens']} ({retrieved['mode']})")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    full_tokens = [r["full"]["prompt_tokens"] for r in results if r["full"]["prompt_tokens"]]
+    retrieval_tokens = [r["retrieval"]["prompt_tokens"] for r in results if r["retrieval"]["prompt_tokens"]]
+    print("\n=== Retrieval Eval Summary ===")
+    print(f"Inquiries: {len(results)}")
+    print(f"Mean answer F1 vs full context: {statistics.mean(r['answer_f1'] for r in results):.3f}")
+    print(f"Mean link agreement: {statistics.mean(r['link_agreement'] for r in results):.3f}")
+    if full_tokens and retrieval_tokens:
+        print(f"Mean prompt tokens: full {statistics.mean(full_tokens):.0f}, retrieval {statistics.mean(retrieval_tokens):.0f} "
+              f"({1 - statistics.mean(retrieval_tokens) / statistics.mean(full_tokens):.0%} fewer)")
+    print(f"Mean latency: full {statistics.mean(r['full']['latency_s'] for r in results):.2f}s, "
+          f"retrieval {statistics.mean(r['retrieval']['latency_s'] for r in results):.2f}s")
+    print("==============================")
+
+if __name__ == "__main__":
+    main_eval()
@@ -0,0 +1,82 @@
+"""Local stand-in for the Drive v3 endpoints used by drive_sync (files.get and files.export)."""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FILE_PATH = re.compile(r"^/drive/v3/files/([^/]+)(/export)?$")
+
+class FakeDriveServer:
+    """Serves fake Google Docs with configurable latency and an optional rate of 429 responses."""
+
+    def __init__(self, file_count, latency_ms=150, metadata_latency_ms=40, error_rate=0.0, doc_bytes=20000, port=0):
+        self.files = {f"fake-doc-{i}": f"Fake Doc {i}" for i in range(file_count)}
+        self.latency_ms = latency_ms
+        self.metadata_latency_ms = metadata_latency_ms
+        self.error_rate = error_rate
+        self.body = (b"SkyeBrowse knowledge base line.\n" * (doc_bytes // 32 + 1))[:doc_bytes]
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_endpoint(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/drive/v3/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass # Keep benchmark output clean
+
+            def _send(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with server._lock:
+                    server.request_count += 1
+                parsed = urlparse(self.path)
+                match = FILE_PATH.match(parsed.path)
+                if not match or match.group(1) not in server.files:
+                    self._send(404, b'{"error": {"code": 404, "message": "File not found"}}', "application/json")
+                    return
+                file_id, is_export = match.group(1), bool(match.group(2))
+                if server.error_rate and random.random() < server.error_rate:
+                    self._send(429, b'{"error": {"code": 429, "message": "Rate limit exceeded"}}', "application/json")
+                    return
+                if is_export and parse_qs(parsed.query).get("alt") == ["media"]:
+                    time.sleep(server.latency_ms / 1000)
+                    self._send(200, server.body, "text/plain")
+                    return
+                time.sleep(server.metadata_latency_ms / 1000)
+                metadata = {
+                    "id": file_id,
+                    "name": server.files[file_id],
+                    "mimeType": "application/vnd.google-apps.document",
+                    "modifiedTime": "2025-04-01T00:00:00.000Z",
+                    "version": "1",
+                }
+                self._send(200, json.dumps(metadata).encode("utf-8"), "application/json")
+
+        return Handler
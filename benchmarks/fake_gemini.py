@@ -0,0 +1,149 @@
+"""Local stand-in for the Gemini API endpoints used by the CLIs and workers (generateContent,
+streamGenerateContent with SSE, and files.get), with configurable token streams and delays.
+
+Point a client at it with GEMINI_BASE_URL=<server.base_url> (or types.HttpOptions(base_url=...)).
+"""
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+GENERATE_PATH = re.compile(r"^/v1beta/(?:models/)?([^/:]+):(generateContent|streamGenerateContent)$")
+FILE_PATH = re.compile(r"^/v1beta/(files/[^/]+)$")
+WORDS = ("Thanks", "for", "reaching", "out", "to", "SkyeBrowse", "support", "the", "app", "supports",
+         "your", "drone", "through", "Universal", "Upload", "and", "the", "mobile", "capture", "flow")
+
+class FakeGeminiServer:
+    """Answers every prompt with `response_tokens` words, streamed in `chunk_tokens`-word chunks.
+
+    The first chunk arrives after `ttft_ms`; each further chunk after `chunk_tokens * token_ms`.
+    `error_rate` answers that fraction of generate calls with HTTP 429.
+    """
+
+    def __init__(self, ttft_ms=400, token_ms=8, response_tokens=150, chunk_tokens=15, error_rate=0.0, port=0):
+        self.ttft_ms = ttft_ms
+        self.token_ms = token_ms
+        self.response_tokens = response_tokens
+        self.chunk_tokens = chunk_tokens
+        self.error_rate = error_rate
+        self.request_count = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024 # Accept bursts from high-concurrency runs
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def chunks(self):
+        """The response text split into the chunks a streamed call returns."""
+        words = [WORDS[i % len(WORDS)] for i in range(self.response_tokens)]
+        return [" ".join(words[i:i + self.chunk_tokens]) + " " for i in range(0, len(words), self.chunk_tokens)]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass # Keep benchmark output clean
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def do_GET(self):
+                match = FILE_PATH.match(urlparse(self.path).path)
+                if not match:
+                    self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                    return
+                self._send(200, {
+                    "name": match.group(1),
+                    "uri": f"{server.base_url}/v1beta/{match.group(1)}",
+                    "mimeType": "text/plain",
+                    "state": "ACTIVE",
+                    "expirationTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 47 * 3600)),
+                })
+
+            def do_POST(self):
+                request_body = self._read_body()
+                match = GENERATE_PATH.match(urlparse(self.path).path)
+                if not match:
+                    self._send(404, {"error": {"code": 404, "message": "Not supported by fake server", "status": "NOT_FOUND"}})
+                    return
+                with server._lock:
+                    server.request_count += 1
+                    server.in_flight += 1
+                    server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                try:
+                    if server.error_rate and random.random() < server.error_rate:
+                        self._send(429, {"error": {"code": 429, "message": "Resource has been exhausted", "status": "RESOURCE_EXHAUSTED"}})
+                        return
+                    model, method = match.groups()
+                    prompt_tokens = max(1, len(request_body) // 4)
+                    if method == "streamGenerateContent":
+                        self._stream(model, prompt_tokens)
+                    else:
+                        time.sleep((server.ttft_ms + server.response_tokens * server.token_ms) / 1000)
+                        self._send(200, server_response(model, "".join(server.chunks()), prompt_tokens, server.response_tokens))
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def _stream(self, model, prompt_tokens):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close") # No Content-Length; the stream ends when the socket closes
+                self.end_headers()
+                chunks = server.chunks()
+                time.sleep(server.ttft_ms / 1000)
+                for index, text in enumerate(chunks):
+                    if index:
+                        time.sleep(server.chunk_tokens * server.token_ms / 1000)
+                    is_last = index == len(chunks) - 1
+                    event = server_response(model, text, prompt_tokens, server.response_tokens if is_last else None)
+                    self.wfile.write(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+def server_response(model, text, prompt_tokens, output_tokens=None):
+    """A GenerateContentResponse body; usage is attached when `output_tokens` is given (the final chunk)."""
+    response = {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}],
+        "modelVersion": model,
+    }
+    if output_tokens is not None:
+        response["candidates"][0]["finishReason"] = "STOP"
+        response["usageMetadata"] = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+    return response
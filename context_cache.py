@@ -0,0 +1,215 @@
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+from google.genai import errors, types
+
+logger = logging.getLogger(__name__)
+
+# --- Settings ---
+DISPLAY_NAME_PREFIX = "skyebot-kb"
+DEFAULT_TTL_SECONDS = int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", 3600))
+RENEW_MARGIN_SECONDS = 300 # Extend the TTL once less than this much time is left
+FAILURE_RETRY_SECONDS = 600 # Don't retry a failed cache creation on every request
+
+def compute_kb_version(file_paths):
+    """Hashes the knowledge-base files (names + contents) into a short version string."""
+    sha = hashlib.sha256()
+    for name in sorted(file_paths):
+        sha.update(name.encode("utf-8") + b"\0")
+        try:
+            with open(file_paths[name], "rb") as f:
+                for block in iter(lambda: f.read(65536), b""):
+                    sha.update(block)
+        except OSError as e:
+            logger.warning(f"Could not read {file_paths[name]} for KB version hash: {e}")
+        sha.update(b"\0")
+    return sha.hexdigest()[:16]
+
+def _prompt_key(system_text):
+    return hashlib.sha256(system_text.encode("utf-8")).hexdigest()[:12]
+
+def _model_key(model_str):
+    return model_str.split("/")[-1].replace(".", "-")
+
+def _display_name(model_str, prompt_key, kb_version):
+    # Display names are limited to 128 chars; model + two short hashes fits comfortably
+    return f"{DISPLAY_NAME_PREFIX}-{_model_key(model_str)}-{prompt_key}-{kb_version}"
+
+class ContextCacheManager:
+    """Creates and reuses one server-side cached-content entry per (model, prompt, knowledge-base version).
+
+    The cache holds the static prompt prefix (system prompt + uploaded file parts), so each request
+    only sends the inquiry and references the cache by name. Entries are renewed before they expire.
+    Caches of other knowledge-base versions are never deleted automatically, since other workers or CLI
+    runs may still be using them; nothing renews an unused version, so it expires within ttl_seconds.
+    """
+
+    def __init__(self, client, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock() # Guards the dicts below; never held across an API call
+        self._entries = {} # display_name -> {"name", "expire_time", "token_count"}
+        self._failures = {} # display_name -> monotonic time of last failed creation
+        self._pending = {} # display_name -> Event set when the in-progress create/renew finishes
+
+    def get_cache_name(self, model_str, kb_version, system_text, file_parts, as_system_instruction=False):
+        """Returns the cached-content name for this prefix, creating or renewing it as needed (None on failure).
+
+        With `as_system_instruction` the system text is cached as the system instruction (worker style);
+        otherwise it leads the cached user turn, followed by the file parts (CLI style).
+        Only one request creates or renews a given prefix; others asking for the same prefix wait for
+        it (or keep using the entry being renewed), and requests for other prefixes are not held up.
+        """
+        if not kb_version or not file_parts:
+            return None
+        prompt_key = _prompt_key(system_text)
+        display_name = _display_name(model_str, prompt_key, kb_version)
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(display_name)
+                if entry is not None and self._seconds_left(entry) >= RENEW_MARGIN_SECONDS:
+                    return entry["name"]
+                pending = self._pending.get(display_name)
+                if pending is None:
+                    failed_at = self._failures.get(display_name)
+                    if entry is None and failed_at and time.monotonic() - failed_at < FAILURE_RETRY_SECONDS:
+                        return None
+                    self._pending[display_name] = threading.Event()
+                    break # This request does the API calls
+            if entry is not None and self._seconds_left(entry) > 0:
+                return entry["name"] # Still live while another request renews it
+            pending.wait()
+
+        try:
+            if entry is None:
+                entry = self._find_existing(display_name)
+            else:
+                entry = self._renew(entry) # None if expired or deleted server-side; built again below
+            if entry is None:
+                entry = self._create(display_name, model_str, system_text, file_parts, as_system_instruction)
+            with self._lock:
+                if entry is None:
+                    self._entries.pop(display_name, None)
+                    self._failures[display_name] = time.monotonic()
+                else:
+                    self._entries[display_name] = entry
+                    self._failures.pop(display_name, None)
+        finally:
+            with self._lock:
+                self._pending.pop(display_name).set()
+        return entry["name"] if entry else None
+
+    def forget(self, cache_name):
+        """Drops the entry for a cache the server no longer has (expired early, deleted or evicted).
+
+        The next request for that prefix looks for or creates a cache again.
+        """
+        with self._lock:
+            for display_name, entry in list(self._entries.items()):
+                if entry["name"] == cache_name:
+                    del self._entries[display_name]
+                    logger.info(f"Forgot context cache {cache_name} ({display_name}); it is no longer available.")
+
+    def invalidate_all(self):
+        """Deletes every cache entry this tool created (e.g., after a forced Drive refresh)."""
+        with self._lock:
+            self._entries.clear()
+            self._failures.clear()
+        self._delete_matching(lambda display_name: True)
+
+    # --- Internal helpers (API calls; called without self._lock) ---
+    @staticmethod
+    def _to_entry(cached):
+        return {
+            "name": cached.name,
+            "expire_time": cached.expire_time,
+            "token_count": cached.usage_metadata.total_token_count if cached.usage_metadata else None,
+        }
+
+    @staticmethod
+    def _seconds_left(entry):
+        if not entry["expire_time"]:
+            return 0
+        return (entry["expire_time"] - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+    def _find_existing(self, display_name):
+        """Reuses a live cache created by an earlier process for the same prefix."""
+        try:
+            for cached in self.client.caches.list():
+                if cached.display_name == display_name:
+                    entry = self._to_entry(cached)
+                    if self._seconds_left(entry) > RENEW_MARGIN_SECONDS:
+                        logger.info(f"Reusing existing context cache {cached.name} ({display_name}).")
+                        return entry
+        except Exception as e:
+            logger.warning(f"Could not list existing context caches: {e}")
+        return None
+
+    def _create(self, display_name, model_str, system_text, file_parts, as_system_instruction):
+        start_time = time.time()
+        try:
+            if as_system_instruction:
+                config = types.CreateCachedContentConfig(
+                    display_name=display_name,
+                    system_instruction=system_text,
+                    contents=[types.Content(role="user", parts=list(file_parts))],
+                    ttl=f"{self.ttl_seconds}s",
+                )
+            else:
+                prefix_parts = [types.Part.from_text(text=system_text)]
+                prefix_parts.extend(file_parts)
+                prefix_parts.append(types.Part.from_text(text="--- End of Provided Documents ---"))
+                config = types.CreateCachedContentConfig(
+                    display_name=display_name,
+                    contents=[types.Content(role="user", parts=prefix_parts)],
+                    ttl=f"{self.ttl_seconds}s",
+                )
+            cached = self.client.caches.create(model=model_str, config=config)
+        except Exception as e:
+            # Typical causes: prefix below the model's minimum cacheable size, or a model alias without caching support
+            logger.warning(f"Context cache creation failed for {display_name}; using full context instead: {e}")
+            return None
+        entry = self._to_entry(cached)
+        logger.info(f"Created context cache {cached.name} ({entry['token_count']} tokens) in {time.time() - start_time:.2f}s.")
+        return entry
+
+    def _renew(self, entry):
+        try:
+            cached = self.client.caches.update(
+                name=entry["name"],
+                config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+            )
+            logger.info(f"Renewed context cache {entry['name']} for {self.ttl_seconds}s.")
+            renewed = self._to_entry(cached)
+            renewed["token_count"] = renewed["token_count"] or entry["token_count"]
+            return renewed
+        except Exception as e:
+            logger.warning(f"Could not renew context cache {entry['name']}: {e}")
+            return None
+
+    def _delete_matching(self, predicate):
+        try:
+            for cached in self.client.caches.list():
+                display_name = cached.display_name or ""
+                if display_name.startswith(DISPLAY_NAME_PREFIX) and predicate(display_name):
+                    self.client.caches.delete(name=cached.name)
+                    logger.info(f"Deleted stale context cache {cached.name} ({display_name}).")
+        except Exception as e:
+            logger.warning(f"Could not clean up stale context caches: {e}")
+
+def is_missing_cache_error(error):
+    """True if a generate call failed because its cached_content does not exist (any more) on the server."""
+    if not isinstance(error, errors.APIError):
+        return False
+    # The API answers a missing cache with 404, or 403 "CachedContent not found (or permission denied)"
+    return error.code in (403, 404) or "cachedcontent" in str(error).lower().replace(" ", "")
+
+def cached_token_count(usage_metadata):
+    """Returns the number of prompt tokens served from the context cache (0 if none)."""
+    if not usage_metadata:
+        return 0
+    return getattr(usage_metadata, "cached_content_token_count", None) or 0
@@ -0,0 +1,100 @@
+import concurrent.futures
+import logging
+import os
+import random
+import socket
+import time
+import httpx
+from google import genai
+from google.genai import types
+import metrics
+import upload_registry
+
+logger = logging.getLogger(__name__)
+
+# --- Concurrency and Retry Settings ---
+DEFAULT_MAX_WORKERS = int(os.environ.get("UPLOAD_MAX_WORKERS", 8))
+MAX_ATTEMPTS = int(os.environ.get("UPLOAD_MAX_ATTEMPTS", 4))
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 16.0
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+MIME_TYPES = {".txt": "text/plain", ".csv": "text/csv", ".md": "text/markdown", ".pdf": "application/pdf"}
+
+def load_drive_file_ids(prefix="GDRIVE_"):
+    """{display name: Drive file id} from GDRIVE_<NAME> environment variables (GDRIVE_SUPPORTED_DRONES -> "Supported Drones")."""
+    file_ids = {}
+    for key, value in os.environ.items():
+        if key.startswith(prefix):
+            name_parts = key[len(prefix):].split('_')
+            file_ids[' '.join(part.capitalize() for part in name_parts)] = value
+    return file_ids
+
+def make_genai_client(api_key=None):
+    """GenAI client for GEMINI_API_KEY, pointed at GEMINI_BASE_URL when set (e.g. benchmarks/fake_gemini.py)."""
+    base_url = os.environ.get("GEMINI_BASE_URL")
+    return genai.Client(
+        api_key=api_key or os.environ.get("GEMINI_API_KEY"),
+        http_options=types.HttpOptions(base_url=base_url) if base_url else None,
+    )
+
+def mime_type_for(file_path):
+    """MIME type from the file extension (None lets the upload response decide)."""
+    return MIME_TYPES.get(os.path.splitext(file_path)[1].lower())
+
+def part_sort_key(name, file_path):
+    """Documents first, then CSV sheets, each alphabetically, so the prompt prefix is identical on every run."""
+    return (file_path.lower().endswith(".csv"), name)
+
+def _is_retryable(error):
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS_CODES
+    # Dropped connections and timeouts are transient as well
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError, socket.timeout))
+
+def _upload_one(client, name, file_path, max_attempts):
+    """Returns (part or None, timing) for one file, retrying transient errors with backoff and jitter."""
+    start_time = time.perf_counter()
+    for attempt in range(1, max_attempts + 1):
+        try:
+            # Byte-identical files uploaded by an earlier run (or another process) are reused while still live
+            uploaded = upload_registry.get_or_upload(client, file_path)
+            part = types.Part.from_uri(file_uri=uploaded["uri"], mime_type=mime_type_for(file_path) or uploaded["mime_type"])
+            status = "reused" if uploaded["reused"] else "uploaded"
+            break
+        except Exception as error:
+            if attempt >= max_attempts or not _is_retryable(error):
+                logger.error(f"Failed to upload {file_path} ({name}) to GenAI after {attempt} attempt(s): {error}")
+                part, status = None, "failed"
+                break
+            delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1))) * random.uniform(0.75, 1.25)
+            logger.warning(f"Upload of {name} failed ({error}); retry {attempt}/{max_attempts - 1} in {delay:.1f}s")
+            time.sleep(delay)
+    seconds = time.perf_counter() - start_time
+    metrics.observe("upload_seconds", seconds, status=status)
+    timing = {"name": name, "path": file_path, "status": status, "attempts": attempt, "seconds": round(seconds, 2)}
+    return part, timing
+
+def upload_context_files(client, file_paths, max_workers=None, max_attempts=MAX_ATTEMPTS):
+    """Uploads {name: local path} to the GenAI Files API concurrently.
+
+    Returns (parts, timings). Parts follow part_sort_key no matter which upload finishes first;
+    failed files are left out. timings lists {"name", "path", "status", "attempts", "seconds"} per
+    file in the same order, status being 'uploaded', 'reused' or 'failed'. Wall time is bounded by
+    the slowest file rather than the sum.
+    """
+    ordered = sorted(file_paths.items(), key=lambda item: part_sort_key(*item))
+    if not ordered:
+        return [], []
+    max_workers = max(1, min(max_workers or DEFAULT_MAX_WORKERS, len(ordered)))
+    start_time = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload") as executor:
+        results = list(executor.map(lambda item: _upload_one(client, item[0], item[1], max_attempts), ordered))
+    parts = [part for part, _ in results if part is not None]
+    timings = [timing for _, timing in results]
+    logger.info(
+        f"Prepared {len(parts)}/{len(ordered)} context files in {time.perf_counter() - start_time:.2f}s "
+        f"(sum of per-file times {sum(timing['seconds'] for timing in timings):.2f}s, {max_workers} workers)."
+    )
+    return parts, timings
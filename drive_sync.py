@@ -0,0 +1,242 @@
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import metrics
+# The Drive client stack (googleapiclient, httplib2, google-auth) is imported inside the functions that
+# call Drive, so entry points running from already-synced files never load it.
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILENAME = ".drive_manifest.json"
+METADATA_FIELDS = "id, name, mimeType, modifiedTime, md5Checksum, version"
+
+# --- Concurrency and Retry Settings ---
+DEFAULT_MAX_WORKERS = int(os.environ.get("DRIVE_MAX_WORKERS", 4))
+MAX_RETRIES = int(os.environ.get("DRIVE_MAX_RETRIES", 4))
+RETRY_BASE_DELAY_SECONDS = 1.0
+RETRY_MAX_DELAY_SECONDS = 16.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Google-native types are exported; plain text files are downloaded as-is
+EXPORT_MIME_TYPES = {
+    'application/vnd.google-apps.document': "text/plain",
+    'application/vnd.google-apps.spreadsheet': "text/csv",
+}
+
+# --- Manifest Handling ---
+def load_manifest(download_dir):
+    """Loads the per-file Drive metadata recorded by the last sync ({} if missing or unreadable)."""
+    manifest_path = os.path.join(download_dir, MANIFEST_FILENAME)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read Drive manifest {manifest_path}: {e}. All files will be re-checked.")
+        return {}
+
+def save_manifest(download_dir, manifest):
+    """Writes the manifest atomically (temp file + rename) so a crash never leaves it truncated."""
+    manifest_path = os.path.join(download_dir, MANIFEST_FILENAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, manifest_path)
+
+def manifest_local_paths(download_dir, file_ids):
+    """Returns {name: local path} for configured files recorded in the manifest that still exist on disk."""
+    manifest = load_manifest(download_dir)
+    paths = {}
+    for name, file_id in file_ids.items():
+        entry = manifest.get(file_id)
+        if entry and os.path.exists(entry.get("local_path", "")):
+            paths[name] = entry["local_path"]
+    return paths
+
+def _is_unchanged(entry, metadata):
+    """True if the recorded entry matches Drive's current version and the local copy still exists."""
+    if not entry or not os.path.exists(entry.get("local_path", "")):
+        return False
+    # Google-native files have no md5Checksum; version and modifiedTime change on every edit
+    for field in ("version", "modifiedTime", "md5Checksum", "mimeType"):
+        if entry.get(field) != metadata.get(field):
+            return False
+    return True
+
+# --- Download ---
+def local_path_for(local_filename_base, mime_type, text_extension="txt"):
+    """Maps a Drive MIME type to the local file path it is saved under (None if unsupported)."""
+    if mime_type == 'application/vnd.google-apps.spreadsheet':
+        return f"{local_filename_base}.csv"
+    if mime_type in ('application/vnd.google-apps.document', 'text/plain'):
+        return f"{local_filename_base}.{text_extension}"
+    return None
+
+def _export_to_file(service, file_id, metadata, local_filename):
+    """Streams the export/download into a .part file and renames it into place (raises on failure)."""
+    mime_type = metadata.get('mimeType')
+    original_name = metadata.get('name')
+    if mime_type in EXPORT_MIME_TYPES:
+        logger.info(f"  Exporting '{original_name}' ({mime_type}) as {EXPORT_MIME_TYPES[mime_type]}...")
+        request = service.files().export_media(fileId=file_id, mimeType=EXPORT_MIME_TYPES[mime_type])
+    else:
+        logger.info(f"  Downloading plain text file '{original_name}' directly...")
+        request = service.files().get_media(fileId=file_id)
+
+    from googleapiclient.http import MediaIoBaseDownload
+    temp_filename = local_filename + ".part"
+    try:
+        with io.FileIO(temp_filename, "wb") as fh:
+            downloader = MediaIoBaseDownload(fh, request)
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
+                if status:
+                    logger.debug(f"  Download {int(status.progress() * 100)}%.")
+        os.replace(temp_filename, local_filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+# --- Thread-Safe Services and Retries ---
+def build_drive_service(creds):
+    """Builds a Drive service with its own httplib2 connection (httplib2.Http is not thread-safe)."""
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    return build("drive", "v3", http=AuthorizedHttp(creds, http=httplib2.Http()), cache_discovery=False)
+
+def make_service_factory(creds):
+    """Returns a zero-argument callable that builds a fresh, independently connected Drive service."""
+    return lambda: build_drive_service(creds)
+
+def _is_retryable(error):
+    import httplib2
+    from googleapiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES
+    # Dropped connections and timeouts are transient as well
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, httplib2.HttpLib2Error))
+
+def _with_retries(fn, description, max_retries=MAX_RETRIES):
+    """Calls fn(), retrying 429/5xx and connection errors with exponential backoff and jitter."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as error:
+            if attempt >= max_retries or not _is_retryable(error):
+                raise
+            delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt)) * random.uniform(0.5, 1.5)
+            logger.warning(f"  {description} failed ({error}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+# --- Sync Engine ---
+def _sync_one(get_service, name, file_id, entry, local_filename_base, text_extension):
+    """Checks one file against its manifest entry and downloads it if changed.
+
+    Returns (status, manifest entry or None) where status is 'downloaded', 'unchanged', 'kept' or 'failed'.
+    """
+    start_time = time.time()
+    try:
+        service = get_service()
+        metadata = _with_retries(
+            lambda: service.files().get(fileId=file_id, fields=METADATA_FIELDS).execute(),
+            f"Metadata for '{name}'",
+        )
+        expected_path = local_path_for(local_filename_base, metadata.get('mimeType'), text_extension)
+        if not expected_path:
+            logger.warning(f"Skipping file '{name}' (ID: {file_id}). Unsupported MIME type for conversion: {metadata.get('mimeType')}")
+            return "failed", None
+        if _is_unchanged(entry, metadata) and entry.get("local_path") == expected_path:
+            logger.info(f"Unchanged: '{name}' (version {metadata.get('version')}), using {entry['local_path']}")
+            return "unchanged", entry
+
+        logger.info(f"Processing '{name}' from Google Drive (ID: {file_id})...")
+        _with_retries(lambda: _export_to_file(service, file_id, metadata, expected_path), f"Download of '{name}'")
+    except Exception as error:
+        logger.error(f"Could not sync '{name}' (ID: {file_id}): {error}")
+        if entry and os.path.exists(entry.get("local_path", "")):
+            logger.warning(f"Keeping previously synced copy of '{name}': {entry['local_path']}")
+            return "kept", entry
+        return "failed", None
+
+    # The file may have moved (e.g., Doc converted to Sheet); drop the stale copy
+    if entry and entry.get("local_path") not in (None, expected_path) and os.path.exists(entry["local_path"]):
+        os.remove(entry["local_path"])
+    logger.info(f"Finished '{name}' in {time.time() - start_time:.2f}s. Saved to {expected_path}")
+    return "downloaded", {
+        "name": name,
+        "local_path": expected_path,
+        "mimeType": metadata.get('mimeType'),
+        "modifiedTime": metadata.get('modifiedTime'),
+        "md5Checksum": metadata.get('md5Checksum'),
+        "version": metadata.get('version'),
+    }
+
+def _timed_sync_one(*args):
+    """_sync_one, recording its duration in the download_seconds histogram by status."""
+    start_time = time.perf_counter()
+    status, entry = _sync_one(*args)
+    metrics.observe("download_seconds", time.perf_counter() - start_time, status=status)
+    return status, entry
+
+def sync_drive_files(service_factory, file_ids, download_dir, local_filename_bases, text_extension="txt", max_workers=None):
+    """Brings `download_dir` up to date with Drive, downloading only files that changed.
+
+    `file_ids` maps display names to Drive IDs and `local_filename_bases` maps the same names to
+    paths without extension. Files are checked and downloaded concurrently by at most `max_workers`
+    threads (default DRIVE_MAX_WORKERS), each calling `service_factory()` once for its own Drive
+    service. Unchanged files (same version/modifiedTime/md5Checksum as recorded in the manifest) are
+    reused as-is. Returns {name: local path} for every file available locally.
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    manifest = load_manifest(download_dir)
+    new_manifest = {}
+    processed_files_paths = {}
+    counts = {"downloaded": 0, "unchanged": 0, "kept": 0, "failed": 0}
+    max_workers = max(1, min(max_workers or DEFAULT_MAX_WORKERS, len(file_ids) or 1))
+
+    thread_state = threading.local()
+    def get_service():
+        if not hasattr(thread_state, "service"):
+            thread_state.service = service_factory()
+        return thread_state.service
+
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive-sync") as executor:
+        future_to_name = {
+            executor.submit(_timed_sync_one, get_service, name, file_id, manifest.get(file_id), local_filename_bases[name], text_extension): name
+            for name, file_id in file_ids.items()
+        }
+        for future in concurrent.futures.as_completed(future_to_name):
+            name = future_to_name[future]
+            status, entry = future.result()
+            counts[status] += 1
+            if entry:
+                new_manifest[file_ids[name]] = entry
+                processed_files_paths[name] = entry["local_path"]
+
+    # Files no longer configured are removed only after everything else has synced
+    for file_id, entry in manifest.items():
+        if file_id not in new_manifest and file_id not in file_ids.values():
+            stale_path = entry.get("local_path")
+            if stale_path and os.path.exists(stale_path):
+                logger.info(f"Removing file no longer configured: {stale_path}")
+                os.remove(stale_path)
+
+    save_manifest(download_dir, new_manifest)
+    logger.info(
+        f"Drive sync complete in {time.time() - start_time:.2f}s ({max_workers} workers): "
+        f"{counts['downloaded']} downloaded, {counts['unchanged']} unchanged, {counts['kept']} kept, {counts['failed']} unavailable."
+    )
+    return processed_files_paths
@@ -0,0 +1,362 @@
+import csv
+import difflib
+import logging
+import os
+import re
+from model_router import TROUBLESHOOTING, inquiry_message
+
+logger = logging.getLogger(__name__)
+
+FUZZY_CUTOFF = float(os.environ.get("DRONE_FUZZY_CUTOFF", 0.85)) # difflib ratio; model numbers must still agree exactly
+MAX_NGRAM_WORDS = 5
+VENDOR_WORDS = {"dji", "autel", "skydio", "parrot", "drone"}
+# Words that turn a listed model into a different one ("Mavic 3" + "Pro"); a match followed by one is not trusted
+VARIANT_WORDS = {"pro", "plus", "classic", "enterprise", "cine", "thermal", "advanced", "max", "se", "zoom", "dual", "rtk", "ultra", "fpv", "t", "e", "m", "s", "v2"}
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+DIGITS = re.compile(r"\d+")
+# Bare "support" is left out: "Hi support team" and "I emailed support" are not compatibility questions
+COMPATIBILITY_PATTERN = re.compile(
+    r"\b(compatib\w*|supported|supports|(do|does)\s+(you|skyebrowse|it|the\s+app|your\s+app)\s+support|work(s|ing)?\s+with|"
+    r"work\s+on|use\s+(it\s+|this\s+|that\s+)?with|fly\s+with|can\s+i\s+use|does\s+.+\s+work)\b",
+    re.IGNORECASE,
+)
+SENTENCE_BREAK = re.compile(r"(?<=[.?!])\s+|\n+")
+NOT_SUPPORTED_PATTERN = re.compile(r"\b(not\s+(yet\s+|currently\s+)?(supported|compatible)|unsupported|incompatible|no\s+support)\b")
+SEMI_SUPPORTED_PATTERN = re.compile(r"\b(semi|partial(ly)?|limited)\b")
+FULLY_SUPPORTED_PATTERN = re.compile(r"\b(full(y)?|supported|compatible)\b")
+# Words a plain support-level cell may contain ("Not Supported by Flight App"); anything else is a qualifier
+LEVEL_CELL_WORDS = {"fully", "full", "semi", "partially", "partial", "limited", "not", "yet", "currently", "supported",
+                    "unsupported", "compatible", "incompatible", "no", "support", "by", "the", "our", "flight", "app", "skyebrowse"}
+KNOWN_CONTROLLERS = ["RC Pro", "RC Plus", "RC-N1", "RC-N2", "RC 2", "DJI RC", "Smart Controller", "Standard Controller"]
+
+# Support-level explanations, as given in the worked examples of sysprompts.md
+LEVEL_EXPLANATIONS = {
+    "full": "This means it should work with both the automated SkyeBrowse Orbit mode and the WideBrowse grid mode in our flight app.",
+    "semi": "This means it should work with our automated SkyeBrowse Orbit mode in the flight app, but not the automated WideBrowse grid mode due to drone limitations. For larger areas you would need to fly a manual grid pattern and then use the Universal Upload feature on our website.",
+    "none": "You can still fly it manually, record a video and upload it using the Universal Upload option on our website.",
+}
+
+def model_key(text):
+    """Alias key for a drone model: lowercase alphanumerics with vendor words dropped ("DJI Air 2S" and "air2s" -> "air2s")."""
+    return "".join(token for token in TOKEN_PATTERN.findall(text.lower()) if token not in VENDOR_WORDS)
+
+def controller_key(text):
+    """Key for a controller name; vendor words are kept so "DJI RC" stays distinct from "RC Pro"."""
+    return "".join(TOKEN_PATTERN.findall(text.lower()))
+
+def support_level(text):
+    """'full', 'semi', 'none' or None for a support-level cell (whole words, so "see notes" is not "not")."""
+    text = text.lower()
+    if NOT_SUPPORTED_PATTERN.search(text):
+        return "none"
+    if SEMI_SUPPORTED_PATTERN.search(text):
+        return "semi"
+    if FULLY_SUPPORTED_PATTERN.search(text):
+        return "full"
+    return None
+
+def is_qualified_level(text):
+    """True if a support-level cell says more than the level ("Supported (see notes)", "Fully Supported - RC Pro only")."""
+    return any(token not in LEVEL_CELL_WORDS for token in TOKEN_PATTERN.findall(text.lower()))
+
+def compatibility_sentences(text):
+    """Sentences of the customer's message that ask about compatibility; [] for troubleshooting inquiries.
+
+    A message that also reports an error, crash or failure needs the full documents, not the sheet rows.
+    """
+    message = inquiry_message(text)
+    if TROUBLESHOOTING.search(message):
+        return []
+    return [sentence for sentence in SENTENCE_BREAK.split(message) if COMPATIBILITY_PATTERN.search(sentence)]
+
+def is_compatibility_question(text):
+    return bool(compatibility_sentences(text))
+
+def _find_column(header, *needles):
+    for position, column in enumerate(header):
+        if any(needle in column.lower() for needle in needles):
+            return position
+    return None
+
+def _names_controller(text):
+    key = controller_key(text)
+    return bool(key) and any(controller_key(name) == key.replace("only", "") for name in KNOWN_CONTROLLERS)
+
+def _split_model_cell(cell):
+    """'Mini 3 Pro (RC Pro only)' -> ('Mini 3 Pro', 'RC Pro only')."""
+    match = re.match(r"^\s*([^(\[]+?)\s*[(\[]([^)\]]*)[)\]]\s*$", cell)
+    if match:
+        return match.group(1), match.group(2).strip()
+    return cell.strip(), ""
+
+def parse_drone_rows(text):
+    """Rows of the exported Supported Drones sheet as [{"model", "support", "controller", "notes"}].
+
+    Understands a table with model / support / controller / notes columns (support may instead come
+    from section rows such as "Semi Supported" above a block of models), and the layout with one
+    column per support level listing model names underneath.
+    """
+    rows = [[cell.strip() for cell in row] for row in csv.reader(text.splitlines())]
+    rows = [row for row in rows if any(row)]
+    if not rows:
+        return []
+    header, body = rows[0], rows[1:]
+    model_col = _find_column(header, "drone", "model", "aircraft", "name")
+    support_col = _find_column(header, "support", "status", "compatib")
+    controller_col = _find_column(header, "controller", "remote")
+    notes_col = _find_column(header, "note", "comment", "requirement")
+    alias_col = _find_column(header, "alias", "also known")
+
+    entries = []
+    if model_col is None or model_col == support_col:
+        # One column per support level
+        for row in body:
+            for column, cell in zip(header, row):
+                if cell:
+                    model, notes = _split_model_cell(cell)
+                    controller, notes = (notes, "") if _names_controller(notes) else ("", notes)
+                    entries.append({"model": model, "support": column, "controller": controller, "notes": notes, "aliases": []})
+        return entries
+
+    section = ""
+    for row in body:
+        cells = row + [""] * (len(header) - len(row))
+        filled = [cell for cell in cells if cell]
+        if len(filled) == 1 and support_level(filled[0]) and not cells[model_col]:
+            section = filled[0] # Section heading row
+            continue
+        if len(filled) == 1 and support_level(filled[0]) and support_col is None and cells[model_col] == filled[0]:
+            section = filled[0]
+            continue
+        if not cells[model_col]:
+            continue
+        model, inline_notes = _split_model_cell(cells[model_col])
+        controller = cells[controller_col] if controller_col is not None else ""
+        if not controller and _names_controller(inline_notes):
+            controller, inline_notes = inline_notes, "" # "Phantom 4 Pro (RC Plus)"
+        notes = "; ".join(part for part in (inline_notes, cells[notes_col] if notes_col is not None else "") if part)
+        entries.append({
+            "model": model,
+            "support": (cells[support_col] if support_col is not None else "") or section,
+            "controller": controller,
+            "notes": notes,
+            "aliases": [alias.strip() for alias in re.split(r"[,;/]", cells[alias_col]) if alias.strip()] if alias_col is not None else [],
+        })
+    return entries
+
+class DroneIndex:
+    """Supported-drones rows indexed by normalized model alias, for answering compatibility questions locally.
+
+    `lookup` finds the models named in an inquiry (longest exact alias first, then a fuzzy match that
+    must keep the same model numbers, so "Mavic 3" never matches "Mavic 3 Enterprise" or "Mavic 2")
+    and narrows their rows to the controller mentioned, if any. A listed model followed by a variant word
+    ("Mavic 3 Pro" when only "Mavic 3" is listed) is not matched at all.
+    """
+
+    def __init__(self, rows, source="Supported Drones"):
+        self.rows = rows
+        self.source = source
+        self._by_alias = {} # model key -> [row indexes]
+        for position, row in enumerate(rows):
+            for alias in [row["model"]] + row.get("aliases", []):
+                key = model_key(alias)
+                if key:
+                    self._by_alias.setdefault(key, []).append(position)
+        self._controllers = {controller_key(name): name for name in KNOWN_CONTROLLERS}
+        for row in rows:
+            for name in re.split(r"[,;/]| or ", row["controller"]):
+                if name.strip():
+                    self._controllers[controller_key(name)] = name.strip()
+        self._max_alias_length = max((len(key) for key in self._by_alias), default=0)
+        self._variant_tokens = set() # Non-numeric words after a model's family name ("Mini 3 Pro" -> "pro")
+        for row in rows:
+            words = [token for token in TOKEN_PATTERN.findall(row["model"].lower()) if token not in VENDOR_WORDS]
+            self._variant_tokens.update(token for token in words[1:] if not token.isdigit())
+
+    @classmethod
+    def from_csv(cls, path, source="Supported Drones"):
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return cls(parse_drone_rows(f.read()), source)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _spans(self, tokens, key_fn, known):
+        """Non-overlapping (start, end, key) spans of `tokens` whose key is in `known`, longest first."""
+        spans, taken = [], set()
+        for length in range(min(MAX_NGRAM_WORDS, len(tokens)), 0, -1):
+            for start in range(len(tokens) - length + 1):
+                if taken.intersection(range(start, start + length)):
+                    continue
+                key = key_fn(" ".join(tokens[start:start + length]))
+                if key and key in known:
+                    spans.append((start, start + length, key))
+                    taken.update(range(start, start + length))
+        return spans, taken
+
+    def _extends(self, token):
+        return token in VARIANT_WORDS or token in self._variant_tokens or token.isdigit()
+
+    def _fuzzy_model(self, tokens, taken):
+        """Closest alias to any unclaimed n-gram, provided its digits are identical; (key, ratio) or (None, 0)."""
+        best, best_ratio = None, 0.0
+        aliases = list(self._by_alias)
+        for length in range(min(MAX_NGRAM_WORDS, len(tokens)), 0, -1):
+            for start in range(len(tokens) - length + 1):
+                if taken.intersection(range(start, start + length)):
+                    continue
+                key = model_key(" ".join(tokens[start:start + length]))
+                if len(key) < 4 or len(key) > self._max_alias_length + 3:
+                    continue
+                for candidate in difflib.get_close_matches(key, aliases, n=3, cutoff=FUZZY_CUTOFF):
+                    if DIGITS.findall(candidate) != DIGITS.findall(key) or candidate.startswith(key) or key.startswith(candidate):
+                        continue # A different model number or a variant ("mavic3" vs "mavic3e"), not a typo
+                    ratio = difflib.SequenceMatcher(None, key, candidate).ratio()
+                    if ratio > best_ratio:
+                        best, best_ratio = candidate, ratio
+        return best, best_ratio
+
+    def lookup(self, text):
+        """Matched rows for the drones named in `text`, or None.
+
+        Returns {"models", "controller", "rows", "fuzzy"}: the sheet names matched, the controller
+        mentioned (or None), the rows that apply to it, and whether a model was only a fuzzy match.
+        """
+        if not self.rows:
+            return None
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        controller_spans, controller_tokens = self._spans(tokens, controller_key, self._controllers)
+        # Controller names ("RC 2") must not be read as models, but a model may share words with one
+        model_spans, taken = self._spans(tokens, model_key, self._by_alias)
+        extended = [span for span in model_spans if span[1] < len(tokens) and self._extends(tokens[span[1]])]
+        if extended:
+            return None # "Mavic 3 Pro" when only "Mavic 3" is listed: leave it to the model rather than generalize
+        fuzzy = False
+        if not model_spans:
+            key, _ = self._fuzzy_model(tokens, taken | controller_tokens)
+            if not key:
+                return None
+            model_spans, fuzzy = [(0, 0, key)], True
+
+        controller = self._controllers[controller_spans[0][2]] if controller_spans else None
+        models, rows = [], []
+        for _, _, key in model_spans:
+            model_rows = [self.rows[position] for position in self._by_alias[key]]
+            if controller:
+                wanted = controller_key(controller)
+                specific = [row for row in model_rows if wanted in controller_key(row["controller"] + " " + row["notes"])]
+                general = [row for row in model_rows if not row["controller"]]
+                model_rows = specific or general or model_rows
+            for row in model_rows:
+                if row not in rows:
+                    rows.append(row)
+            if model_rows[0]["model"] not in models:
+                models.append(model_rows[0]["model"])
+        return {"models": models, "controller": controller, "rows": rows, "fuzzy": fuzzy}
+
+def format_rows(match):
+    """The matched sheet rows as prompt text, one row per line."""
+    lines = []
+    for row in match["rows"]:
+        fields = [f"Drone: {row['model']}", f"Support: {row['support'] or 'unspecified'}"]
+        if row["controller"]:
+            fields.append(f"Controller: {row['controller']}")
+        if row["notes"]:
+            fields.append(f"Notes: {row['notes']}")
+        lines.append("; ".join(fields))
+    if match["controller"]:
+        lines.append(f"(Controller mentioned by the customer: {match['controller']})")
+    return "\n".join(lines)
+
+def template_answer(match):
+    """A direct answer for one exactly-matched model with a single support level, or None to defer to the model."""
+    if not match or match["fuzzy"] or len(match["models"]) != 1:
+        return None
+    levels = {support_level(row["support"]) for row in match["rows"]}
+    if len(levels) != 1 or None in levels:
+        return None
+    if any(is_qualified_level(row["support"]) for row in match["rows"]):
+        return None # The cell carries a condition or note the template would drop
+    level = levels.pop()
+    controllers = {row["controller"] for row in match["rows"] if row["controller"]}
+    if len(controllers) > 1 or (controllers and not match["controller"]):
+        return None # Support depends on a controller the customer did not name
+    model = match["models"][0]
+    subject = f"the {model} with the {match['controller']} controller" if match["controller"] else f"the {model}"
+    if level == "none":
+        answer = f"Our compatibility information shows that {subject} is not supported by the SkyeBrowse flight app."
+    else:
+        answer = f"Our compatibility information shows {subject} as '{'Fully' if level == 'full' else 'Semi'} Supported'."
+    answer += " " + LEVEL_EXPLANATIONS[level]
+    notes = sorted({row["notes"] for row in match["rows"] if row["notes"]})
+    if notes:
+        answer += " Please note: " + "; ".join(notes).rstrip(".") + "."
+    return answer
+
+def _has_support_column(path):
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            header = next(csv.reader(f), [])
+    except OSError:
+        return False
+    return _find_column(header, "support", "compatib") is not None
+
+def find_drones_csv(file_paths):
+    """(name, path) of the Supported Drones sheet among {name: path}, or (None, None).
+
+    A sheet qualifies by its name or by a support/compatibility column; other sheets (such as Links)
+    are never used as a fallback.
+    """
+    sheets = [(name, path) for name, path in sorted(file_paths.items()) if path.lower().endswith(".csv")]
+    for name, path in sheets:
+        if "drone" in name.lower():
+            return name, path
+    for name, path in sheets:
+        if _has_support_column(path):
+            return name, path
+    return None, None
+
+def load_drone_index(file_paths):
+    """DroneIndex over the exported Supported Drones sheet, or None if there is none (or it can't be read)."""
+    name, path = find_drones_csv(file_paths)
+    if not path:
+        logger.info("No Supported Drones sheet found; drone lookup disabled.")
+        return None
+    try:
+        index = DroneIndex.from_csv(path, source=name)
+    except OSError as e:
+        logger.warning(f"Could not read {path} for drone lookup: {e}")
+        return None
+    logger.info(f"Drone lookup: {len(index)} rows from {path}.")
+    return index
+
+def match_compatibility_inquiry(index, inquiry_text):
+    """Lookup result for a drone compatibility question, or None when the inquiry is about something else.
+
+    Only models named in the sentences that ask about compatibility count, so a troubleshooting email
+    that mentions a drone elsewhere keeps the full documents.
+    """
+    if not index:
+        return None
+    sentences = compatibility_sentences(inquiry_text)
+    return index.lookup("\n".join(sentences)) if sentences else None
+
+# --- Regression Cases (python drone_lookup.py) ---
+# (inquiry, should short-circuit to the sheet rows) against a one-row sheet listing the Mavic 3
+REGRESSION_INQUIRIES = [
+    ("Does the Mavic 3 work with SkyeBrowse?", True),
+    ("Is the DJI Mavic 3 supported by the flight app?", True),
+    ("Hi support team, my Mavic 3 uploads keep failing with error 500 after the latest update.", False),
+    ("Name: Sam\nCompany: Acme\nPhone: 555-123-4567\nMessage: I emailed support twice. My Mavic 3 flight app crashes", False),
+    ("Hi support team, I fly a Mavic 3. How long does processing take?", False),
+]
+
+if __name__ == "__main__":
+    index = DroneIndex(parse_drone_rows("Drone Model,Support Level\nMavic 3,Fully Supported"))
+    failures = [(text, expected) for text, expected in REGRESSION_INQUIRIES
+                if bool(match_compatibility_inquiry(index, text)) != expected]
+    for text, expected in failures:
+        print(f"FAIL (expected {'match' if expected else 'no match'}): {text!r}")
+    print(f"{len(REGRESSION_INQUIRIES) - len(failures)}/{len(REGRESSION_INQUIRIES)} regression inquiries passed.")
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,97 @@
+import logging
+import os
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 6000))
+DEFAULT_KEEP_RECENT_TURNS = int(os.environ.get("HISTORY_KEEP_RECENT_TURNS", 3)) # User/model exchanges kept verbatim
+SUMMARY_MODEL = os.environ.get("HISTORY_SUMMARY_MODEL", "models/gemini-2.0-flash-lite-001")
+SUMMARY_HEADER = "--- Summary of Earlier Conversation ---"
+CHARS_PER_TOKEN = 4 # Rough estimate for English text; uploaded files are not counted
+
+SUMMARY_INSTRUCTION = (
+    "Summarize the earlier part of this customer support conversation for the agent continuing it. "
+    "Keep the customer's name, company, drone and controller models, the problems raised, links already "
+    "sent and anything promised. Write at most 150 words of plain prose."
+)
+
+def estimate_tokens(contents):
+    """Approximate token count of the text parts in a list of Content (file references count as zero)."""
+    return sum(len(part.text or "") for content in contents for part in (content.parts or [])) // CHARS_PER_TOKEN
+
+def _turn_text(content):
+    """Text of a turn without any summary part previously folded into it."""
+    return "\n".join(part.text for part in (content.parts or []) if part.text and not part.text.startswith(SUMMARY_HEADER))
+
+class HistoryManager:
+    """Keeps a conversation within a token budget by summarizing its middle.
+
+    The first exchange (the turn carrying the documents or first inquiry, and its answer) and the
+    most recent `keep_recent_turns` exchanges stay verbatim. When the turns after the first exchange
+    exceed `budget_tokens`, everything between is folded into a rolling summary written by a cheap
+    model. The summary is attached as a leading part of the oldest kept user turn, so roles still
+    alternate. One manager per conversation, since it carries the rolling summary.
+    """
+
+    def __init__(self, client, budget_tokens=DEFAULT_TOKEN_BUDGET, keep_recent_turns=DEFAULT_KEEP_RECENT_TURNS, summary_model=SUMMARY_MODEL):
+        self.client = client
+        self.budget_tokens = budget_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.summary_model = summary_model
+        self.summary = ""
+
+    def _summarize(self, folded):
+        transcript = "\n\n".join(f"{content.role.upper()}: {_turn_text(content)}" for content in folded)
+        if self.summary:
+            transcript = f"EARLIER SUMMARY: {self.summary}\n\n{transcript}"
+        try:
+            response = self.client.models.generate_content(
+                model=self.summary_model,
+                contents=[types.Content(role="user", parts=[types.Part.from_text(text=transcript)])],
+                config=types.GenerateContentConfig(
+                    system_instruction=SUMMARY_INSTRUCTION,
+                    temperature=0,
+                    max_output_tokens=400,
+                ),
+            )
+            if response.text:
+                return response.text.strip()
+            logger.warning("History summarizer returned no text; keeping excerpts instead.")
+        except Exception as e:
+            logger.warning(f"History summarization failed ({e}); keeping excerpts instead.")
+        # Fallback: short excerpts of each folded turn are better than dropping them silently
+        excerpts = [f"{content.role}: {_turn_text(content)[:200]}" for content in folded]
+        return " ".join(filter(None, [self.summary] + excerpts))
+
+    def trim(self, conversation_history):
+        """Returns (history, stats) with the middle summarized if the budget is exceeded.
+
+        stats is {"before_tokens", "after_tokens", "summarized_turns"} (estimated text tokens of the
+        whole history). The input list is not modified.
+        """
+        before_tokens = estimate_tokens(conversation_history)
+        stats = {"before_tokens": before_tokens, "after_tokens": before_tokens, "summarized_turns": 0}
+        head, tail = conversation_history[:2], conversation_history[2:]
+        recent_count = 2 * self.keep_recent_turns
+        if not self.budget_tokens or len(tail) <= recent_count or estimate_tokens(tail) <= self.budget_tokens:
+            return conversation_history, stats
+
+        split = len(tail) - recent_count
+        folded, recent = tail[:split], tail[split:]
+        if recent and recent[0].role != "user": # Keep exchanges whole so the kept part starts with a user turn
+            folded, recent = folded + recent[:1], recent[1:]
+        self.summary = self._summarize(folded)
+
+        summary_part = types.Part.from_text(text=f"{SUMMARY_HEADER}\n{self.summary}")
+        if recent:
+            first = recent[0]
+            kept_parts = [part for part in first.parts if not (part.text and part.text.startswith(SUMMARY_HEADER))]
+            recent = [types.Content(role=first.role, parts=[summary_part] + kept_parts)] + recent[1:]
+        else:
+            recent = [types.Content(role="user", parts=[summary_part])]
+
+        trimmed = head + recent
+        stats.update(after_tokens=estimate_tokens(trimmed), summarized_turns=len(folded))
+        logger.info(f"History trimmed: ~{before_tokens} -> ~{stats['after_tokens']} tokens ({len(folded)} turns summarized).")
+        return trimmed, stats
@@ -0,0 +1,91 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL_SECONDS = float(os.environ.get("KB_REFRESH_SECONDS", 0)) # 0: only refresh when notified
+MIN_TRIGGER_GAP_SECONDS = float(os.environ.get("KB_REFRESH_MIN_GAP_SECONDS", 10)) # Coalesces bursts of push notifications
+
+class BackgroundRefresher:
+    """Runs `refresh_fn` on a daemon thread every `interval_seconds` and whenever `trigger()` is called.
+
+    `refresh_fn()` returns True if it installed something new. Refreshes never overlap: triggers that
+    arrive while one is running (or within MIN_TRIGGER_GAP_SECONDS of the last) fold into one more
+    run. Exceptions are logged and counted; the thread keeps going and the next run retries.
+    """
+
+    def __init__(self, refresh_fn, interval_seconds=DEFAULT_INTERVAL_SECONDS, name="kb-refresh"):
+        self.refresh_fn = refresh_fn
+        self.interval_seconds = interval_seconds
+        self.name = name
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._running = False
+        self._last_started = 0.0
+        self._stats = {"runs": 0, "changes": 0, "failures": 0, "triggers": 0,
+                       "last_run_at": None, "last_change_at": None, "last_error": None, "last_duration_s": None}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+            self._thread.start()
+            every = f"every {self.interval_seconds:g}s" if self.interval_seconds > 0 else "on notification only"
+            logger.info(f"Knowledge-base refresher started ({every}).")
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def trigger(self):
+        """Requests a refresh as soon as possible (returns immediately)."""
+        with self._lock:
+            self._stats["triggers"] += 1
+        self._wake.set()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval_seconds if self.interval_seconds > 0 else None)
+            if self._stopped.is_set():
+                break
+            gap = self._last_started + MIN_TRIGGER_GAP_SECONDS - time.monotonic()
+            if gap > 0 and self._wake.is_set():
+                time.sleep(gap) # Let a burst of notifications settle into one run
+            self._wake.clear()
+            self.run_once()
+
+    def run_once(self):
+        """Runs one refresh on the calling thread; returns refresh_fn's result (False on error)."""
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+        self._last_started = time.monotonic()
+        start_time = time.time()
+        changed = False
+        try:
+            changed = bool(self.refresh_fn())
+            error = None
+        except Exception as e:
+            logger.error(f"Knowledge-base refresh failed: {e}", exc_info=True)
+            error = f"{type(e).__name__}: {e}"
+        with self._lock:
+            self._running = False
+            self._stats["runs"] += 1
+            self._stats["last_run_at"] = round(start_time, 3)
+            self._stats["last_duration_s"] = round(time.time() - start_time, 2)
+            self._stats["last_error"] = error
+            if error:
+                self._stats["failures"] += 1
+            if changed:
+                self._stats["changes"] += 1
+                self._stats["last_change_at"] = round(time.time(), 3)
+        return changed
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, running=self._running, interval_seconds=self.interval_seconds)
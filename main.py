@@ -1,38 +1,86 @@
 import json
 from dotenv import load_dotenv
 import os
-import io
-import shutil # Added for directory deletion
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google import genai
+from context_prep import load_drive_file_ids, make_genai_client, upload_context_files
+from drive_sync import sync_drive_files, manifest_local_paths, make_service_factory, MANIFEST_FILENAME
 from google.genai import types
-from googleapiclient.errors import HttpError
 import argparse
 import time
+import logging
+from context_cache import ContextCacheManager, compute_kb_version, cached_token_count, is_missing_cache_error
+from retrieval import load_or_build_index, INDEX_FILENAME
+from prompt_registry import PromptRegistry, INQUIRY_MARKER_PART
+from model_router import ModelRouter, TIER_CHOICES, cache_model_key
+import metrics
+from drone_lookup import load_drone_index, match_compatibility_inquiry, format_rows, template_answer
+from response_cache import ResponseCache, cache_namespace
+from history import HistoryManager, DEFAULT_TOKEN_BUDGET
+from batch import run_batch_file, DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE
 extension = "txt"
 format = "email" # chat or email
 
 load_dotenv(override=True)
 
+# --- Logging (shared modules report progress through logging) ---
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("google_genai").setLevel(logging.WARNING)
+
+# --- Context Cache State ---
+knowledge_base_version = None # Hash of the prepared files, set by prepare_context_files
+context_cache = None # ContextCacheManager, created once the client is ready
+prepared_file_paths = {} # {name: local path} of the files used as context, set by prepare_context_files
+
+# --- Retrieval State ---
+retrieval_index = None # RetrievalIndex when -r is used; otherwise the full documents are sent
+retrieval_top_k = 6
+
+# --- Drone Lookup State ---
+drone_index = None # DroneIndex over the Supported Drones sheet; compatibility inquiries get only its matching rows
+drone_answers = False # Answer unambiguous compatibility inquiries from a template, without a model call
+
+# --- System Prompts ---
+prompt_registry = PromptRegistry() # Loaded (and validated) at startup, reloaded when sys_prompts.json changes
+
+# --- Model Routing ---
+model_router = ModelRouter() # Replaced in __main__ with the -m choice; keeps per-tier latency and cost totals
+
+# --- Response Cache State ---
+response_cache = None # ResponseCache for first-turn inquiries (exact + semantic hits)
+
 # --- Argument Parsing ---
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate a response to a customer inquiry using Google Drive resources and GenAI.")
     parser.add_argument("-i", "--inquiry", help="The customer inquiry text (will prompt if not provided).")
     parser.add_argument("-d", "--download", action="store_true", help="Download files from Google Drive (otherwise use local files).")
-    parser.add_argument("-m", "--model", choices=['flash', 'flash-lite', 'pro'], default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', or 'pro'). Defaults to 'flash'.")
+    parser.add_argument("-m", "--model", choices=TIER_CHOICES, default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', 'pro', or 'auto' to pick the cheapest adequate tier per inquiry). Defaults to 'flash'.")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the server-side context cache and send the full documents with every request.")
+    parser.add_argument("--no-response-cache", action="store_true", help="Always call the model, even for inquiries answered earlier in the session.")
+    parser.add_argument("-r", "--retrieval", action="store_true", help="Send only the knowledge-base passages most relevant to each inquiry (falls back to full documents when nothing matches).")
+    parser.add_argument("--top-k", type=int, default=6, help="Number of passages to attach per inquiry in retrieval mode. Defaults to 6.")
+    parser.add_argument("--embeddings", action="store_true", help="In retrieval mode, combine BM25 with embedding similarity (requires embedding API calls).")
+    parser.add_argument("--no-drone-lookup", action="store_true", help="Send the full documents for drone compatibility questions instead of only the matching Supported Drones rows.")
+    parser.add_argument("--drone-answers", action="store_true", help="Answer compatibility questions that name one listed drone (and its controller, where that matters) directly from the sheet, without calling the model.")
+    parser.add_argument("--history-budget", type=int, default=DEFAULT_TOKEN_BUDGET, help=f"Token budget for earlier turns before they are summarized (0 keeps the full history). Defaults to {DEFAULT_TOKEN_BUDGET}.")
+    parser.add_argument("--batch", metavar="IN_JSONL", help="Answer every {\"id\", \"inquiry\"} line of a JSONL file concurrently instead of prompting.")
+    parser.add_argument("--out", metavar="OUT_JSONL", help="Output JSONL for --batch (defaults to <input>.responses.jsonl). Ids already answered there are skipped, so re-running resumes.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help=f"Concurrent requests in batch mode. Defaults to {DEFAULT_CONCURRENCY}.")
+    parser.add_argument("--rpm", type=float, default=DEFAULT_REQUESTS_PER_MINUTE, help=f"Requests-per-minute budget in batch mode. Defaults to {DEFAULT_REQUESTS_PER_MINUTE:g}.")
+    parser.add_argument("--metrics-out", metavar="JSON", help="Write the session's latency histograms and token counters here on exit (default METRICS_JSON; they are always printed).")
     args = parser.parse_args()
     return args
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 
-def get_drive_service():
+def get_drive_credentials():
+    """Loads (or obtains) Drive credentials; each download thread builds its own service from them."""
+    # google-auth is only needed when syncing from Drive, so it is imported here rather than at startup
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
-    if os.path.exists("token.json"):
+    if os.path.exists("./keys/token.json"):
         creds = Credentials.from_authorized_user_file("./keys/token.json", SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -42,66 +90,14 @@ def get_drive_service():
             creds = flow.run_local_server(port=0)
         with open("./keys/token.json", "w") as token:
             token.write(creds.to_json())
-    return build("drive", "v3", credentials=creds)
-
-def download_google_doc(service, file_id, local_filename_base):
-    try:
-        # Get file metadata to check MIME type
-        file_metadata = service.files().get(fileId=file_id, fields='mimeType, name').execute()
-        mime_type = file_metadata.get('mimeType')
-        original_name = file_metadata.get('name')
-        print(f"  File '{original_name}' has MIME type: {mime_type}")
-
-        request = None
-        local_filename = f"{local_filename_base}.{extension}" # Default download extension
-
-        if mime_type == 'application/vnd.google-apps.document':
-            print(f"  Exporting Google Doc '{original_name}' as text/plain...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/plain")
-        elif mime_type == 'text/plain':
-            print(f"  Downloading plain text file '{original_name}' directly...")
-            request = service.files().get_media(fileId=file_id)
-        elif mime_type == 'application/vnd.google-apps.spreadsheet':
-            print(f"  Exporting Google Sheet '{original_name}' as text/csv...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/csv")
-            local_filename = f"{local_filename_base}.csv" # Change extension for CSV
-        else:
-            print(f"  WARNING: Skipping file '{original_name}' (ID: {file_id}). Unsupported MIME type for conversion: {mime_type}")
-            return None
-
-        # Proceed with download if request is valid
-        if request:
-            fh = io.FileIO(local_filename, "wb")
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if status:
-                    print(f"  Download {int(status.progress() * 100)}%.")
-            fh.close()
-            return local_filename
-        else:
-             # Should not happen if logic above is correct, but included for safety
-             print(f"  ERROR: Could not create download request for file '{original_name}' (ID: {file_id})")
-             return None
-
-    except HttpError as error:
-        print(f"  An error occurred downloading file ID {file_id}: {error}")
-        return None
+    return creds
 
 def prepare_context_files(download_flag):
     """Handles local file check or Drive download, and uploads files to GenAI API once."""
+    global knowledge_base_version, prepared_file_paths
     print("--- Preparing Context Files ---")
     # --- Load File IDs from Environment Variables ---
-    file_ids = {}
-    prefix = "GDRIVE_"
-    for key, value in os.environ.items():
-        if key.startswith(prefix):
-            # Convert GDRIVE_FILE_ID_SOME_NAME to "Some Name"
-            name_parts = key[len(prefix):].split('_')
-            name = ' '.join(part.capitalize() for part in name_parts)
-            # Specific adjustments removed
-            file_ids[name] = value
+    file_ids = load_drive_file_ids() # GDRIVE_SOME_NAME=<id> -> "Some Name"
 
     if not file_ids:
         print("ERROR: No Google Drive file IDs found in environment variables (expected format: GDRIVE_SOME_NAME=...).")
@@ -124,7 +120,7 @@ def prepare_context_files(download_flag):
     dir_is_empty = True
     if dir_exists:
         try:
-            if not os.listdir(download_dir):
+            if not [f for f in os.listdir(download_dir) if f not in (MANIFEST_FILENAME, INDEX_FILENAME)]:
                 dir_is_empty = True
             else:
                 dir_is_empty = False
@@ -147,23 +143,6 @@ def prepare_context_files(download_flag):
         download_flag = True
         print("Forcing download due to missing or empty directory.")
 
-    # --- Clean directory ONLY if download flag is explicitly set at the start ---
-    # Note: We use the original download_flag from args here, not the potentially modified one
-    original_download_flag = args.download # Assuming args is accessible or passed appropriately
-                                          # If not accessible, need to refactor to pass original flag
-    if original_download_flag: # Check the *original* intent from the command line
-        print(f"Download flag is set. Attempting to clean directory: {download_dir}")
-        if dir_exists:
-            try:
-                shutil.rmtree(download_dir)
-                print(f"Successfully deleted existing directory: {download_dir}")
-                dir_exists = False # Update status
-                dir_is_empty = True
-            except OSError as e:
-                print(f"Warning: Error deleting directory {download_dir}: {e}. Proceeding may result in outdated files.")
-        else:
-            print(f"Directory {download_dir} did not exist, no deletion needed.")
-
     # --- Ensure download directory exists before proceeding ---
     if not dir_exists:
         try:
@@ -173,99 +152,198 @@ def prepare_context_files(download_flag):
             print(f"ERROR: Error creating directory {download_dir}: {e}. Cannot proceed.")
             return None, None # Cannot proceed if directory creation fails
 
-    # --- Download or Use Local Files based on initial check/flag ---
+    # --- Sync or Use Local Files based on initial check/flag ---
     if should_download: # Use the calculated flag
-        print("--- Downloading Files from Google Drive ---")
-        drive_service = get_drive_service()
-        if not drive_service:
-            print("ERROR: Failed to get Google Drive service. Cannot download files.")
-            return None, None # Cannot proceed without Drive service
-        for name, file_id in file_ids.items():
-            # Use expected_local_files to determine the base path before extension
-            local_filename_base = os.path.splitext(expected_local_files[name])[0]
-            # local_filename_base = os.path.join(download_dir, name) # Old way
-            print(f"Processing '{name}' from Google Drive (ID: {file_id})...")
-            downloaded_path = download_google_doc(drive_service, file_id, local_filename_base)
-            if downloaded_path:
-                processed_files_paths[name] = downloaded_path
-                # print(f"Finished processing '{name}'. Saved to {downloaded_path}")
-            else:
-                print(f"Skipped file '{name}' due to download/conversion issue.")
+        # Only files whose Drive version changed since the last sync are downloaded; each file is
+        # written to a temp file and renamed into place, so a failed refresh keeps the old copies.
+        print("--- Syncing Files from Google Drive ---")
+        drive_creds = get_drive_credentials()
+        if not drive_creds:
+            print("ERROR: Failed to get Google Drive credentials. Cannot download files.")
+            return None, None # Cannot proceed without Drive access
+        local_filename_bases = {name: os.path.splitext(path)[0] for name, path in expected_local_files.items()}
+        # Files are fetched concurrently (DRIVE_MAX_WORKERS threads), retrying 429/5xx with backoff
+        processed_files_paths = sync_drive_files(make_service_factory(drive_creds), file_ids, download_dir, local_filename_bases, text_extension=extension)
     else:
         # This block now only runs if original download_flag was False AND dir existed AND dir was not empty
         print("--- Skipping Google Drive Download - Using Existing Local Files ---")
+        synced_paths = manifest_local_paths(download_dir, file_ids)
         for name, expected_path in expected_local_files.items():
-            if os.path.exists(expected_path):
-                print(f"Found local file: {expected_path}")
-                processed_files_paths[name] = expected_path
+            local_path = synced_paths.get(name, expected_path)
+            if os.path.exists(local_path):
+                print(f"Found local file: {local_path}")
+                processed_files_paths[name] = local_path
             else:
-                print(f"Local file not found: {expected_path}. It will not be used.")
+                print(f"Local file not found: {local_path}. It will not be used.")
 
     # --- Proceed with GenAI Client Init and Upload ---
     if not processed_files_paths:
          print("No local or downloaded files found/processed. Cannot proceed.")
          return None, None
 
+    knowledge_base_version = compute_kb_version(processed_files_paths)
+    prepared_file_paths = processed_files_paths
+    print(f"Knowledge base version: {knowledge_base_version}")
+
     # --- Initialize GenAI Client ---
     print("--- Initializing GenAI Client --- ")
     try:
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
+        client = make_genai_client()
     except Exception as e:
         print(f"Failed to initialize GenAI client: {e}")
         return None, None
 
-    # --- Upload Files to GenAI API Sequentially ---
-    print("--- Uploading Files Sequentially to GenAI API --- ")
-    genai_file_parts = []
-
-    def upload_single_file(name, file_path):
-        try:
-            print(f"✅ Uploading {file_path} ({name}) to GenAI API...")
-            # Determine MIME type based on file extension
-            if file_path.lower().endswith(f'.{extension}'):
-                mime_type = 'text/plain'
-            elif file_path.lower().endswith('.csv'):
-                mime_type = 'text/csv'
-            else:
-                # Fallback or raise an error if other types are possible and need specific handling
-                mime_type = None # Let the library try to guess, or handle error
-                print(f"Warning: Could not determine MIME type for {file_path}, attempting upload without it.")
-
-            genai_file = client.files.upload(file=file_path)
-            # print(f"Successfully uploaded {name} ({genai_file.name})")
-            return types.Part.from_uri(file_uri=genai_file.uri, mime_type=mime_type)
-        except Exception as e:
-             print(f"Failed to upload {file_path} ({name}) to GenAI: {e}")
-             return None # Return None on failure
-
-    # Upload text files first (exported Google Docs)
-    print("Uploading text files...")
-    for name, file_path in processed_files_paths.items():
-        if file_path.lower().endswith(f'.{extension}'):
-            result = upload_single_file(name, file_path)
-            if result:
-                genai_file_parts.append(result)
-
-    # Upload CSV files next (exported Google Sheets)
-    # print("Uploading CSV files...")
-    # for name, file_path in processed_files_paths.items():
-    #     if file_path.lower().endswith('.csv'):
-    #         result = upload_single_file(name, file_path)
-    #         if result:
-    #             genai_file_parts.append(result)
+    # --- Upload Files to GenAI API Concurrently ---
+    # Documents come before CSV sheets in a fixed order, however the uploads finish
+    print("--- Uploading Files to GenAI API --- ")
+    genai_file_parts, upload_timings = upload_context_files(client, processed_files_paths)
+    for timing in upload_timings:
+        icon = "❌" if timing["status"] == "failed" else "✅"
+        print(f"{icon} {timing['name']} ({timing['path']}): {timing['status']} in {timing['seconds']:.2f}s")
 
     if not genai_file_parts:
         print("No files were successfully uploaded to GenAI. Aborting.")
         exit()
         # return client, None # Return client in case user wants to try generation without files?
 
-    print(f"Using Gemini {model_name}")
     return client, genai_file_parts
 
 
-def generate_response(client, file_parts, inquiry_text, model_name, conversation_history):
+def load_system_prompt():
+    """Returns the current system instruction for the configured format (see prompt_registry.py)."""
+    try:
+        return prompt_registry.text(format)
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load system prompts: {e}. Exiting.")
+        exit()
+
+def first_turn_parts(inquiry_text):
+    """User parts for the first turn of a conversation (the documents live in the prefix)."""
+    return [
+        INQUIRY_MARKER_PART,
+        types.Part.from_text(text=inquiry_text),
+    ]
+
+def last_user_text(conversation_history):
+    """Returns the text of the most recent user turn (its final part), or an empty string."""
+    for content in reversed(conversation_history):
+        if content.role == "user" and content.parts:
+            return content.parts[-1].text or ""
+    return ""
+
+def build_context_prefix(client, file_parts, system_text, model_str, query_text, index=None, cache=None, top_k=6, drone_match=None):
+    """Builds the static prompt prefix placed before the conversation.
+
+    Returns (prefix_contents, cache_name, context_mode) where context_mode is 'drone lookup' (only
+    the Supported Drones rows for a compatibility question), 'retrieval' (top-k passages only),
+    'cached' (prefix served from the context cache) or 'full' (all documents inline).
+    """
+    if drone_match:
+        rows_part = types.Part.from_text(text=f"--- {drone_index.source} (matching entries) ---\n{format_rows(drone_match)}")
+        prefix_parts = prompt_registry.prefix_parts(system_text, [rows_part], reuse=False)
+        return [types.Content(role="user", parts=prefix_parts)], None, f"drone lookup ({len(drone_match['rows'])} rows)"
+
+    if index:
+        passages = index.search(query_text, top_k=top_k, client=client)
+        if passages:
+            passage_parts = [types.Part.from_text(text="--- Relevant Knowledge Base Passages ---")]
+            for passage in passages:
+                passage_parts.append(types.Part.from_text(text=f"[Source: {passage['source']}]\n{passage['text']}"))
+            prefix_parts = prompt_registry.prefix_parts(system_text, passage_parts, reuse=False)
+            return [types.Content(role="user", parts=prefix_parts)], None, f"retrieval ({len(passages)} passages)"
+        print("No relevant passages found; falling back to full documents.")
+
+    cache_name = None
+    if cache and file_parts:
+        cache_name = cache.get_cache_name(model_str, knowledge_base_version, system_text, file_parts)
+    if cache_name:
+        return [], cache_name, "cached"
+
+    # The prompt + documents prefix is built once per prompt version and reused across requests
+    return [types.Content(role="user", parts=prompt_registry.prefix_parts(system_text, file_parts))], None, "full"
+
+def inline_prefix_after_cache_error(error, cache_name, file_parts, system_text):
+    """The full-documents prefix to retry with when `error` means the context cache is gone; None otherwise."""
+    if not (cache_name and context_cache and is_missing_cache_error(error)):
+        return None
+    print(f"\nContext cache {cache_name} is no longer available; retrying with the documents inline.")
+    context_cache.forget(cache_name)
+    return [types.Content(role="user", parts=prompt_registry.prefix_parts(system_text, file_parts))]
+
+def generate_content(client, model_str, prefix_contents, turns, config, file_parts, system_text):
+    """One generate_content call, retried once with the documents inline if its context cache is gone."""
+    try:
+        return client.models.generate_content(model=model_str, contents=prefix_contents + turns, config=config)
+    except Exception as e:
+        prefix = inline_prefix_after_cache_error(e, config.cached_content, file_parts, system_text)
+        if prefix is None:
+            raise
+        return client.models.generate_content(model=model_str, contents=prefix + turns, config=config.model_copy(update={"cached_content": None}))
+
+def stream_content(client, model_str, prefix_contents, turns, config, file_parts, system_text):
+    """Chunks of one streamed call, retried once inline if its context cache is gone before the first chunk."""
+    started = False
+    try:
+        for chunk in client.models.generate_content_stream(model=model_str, contents=prefix_contents + turns, config=config):
+            started = True
+            yield chunk
+    except Exception as e:
+        prefix = None if started else inline_prefix_after_cache_error(e, config.cached_content, file_parts, system_text)
+        if prefix is None:
+            raise
+        yield from client.models.generate_content_stream(model=model_str, contents=prefix + turns, config=config.model_copy(update={"cached_content": None}))
+
+def usage_to_dict(usage_metadata):
+    """Converts GenAI usage metadata into a JSON-serializable dict (or None)."""
+    if not usage_metadata:
+        return None
+    return {
+        "input_tokens": usage_metadata.prompt_token_count,
+        "output_tokens": usage_metadata.candidates_token_count,
+        "total_tokens": usage_metadata.total_token_count,
+        "cached_tokens": cached_token_count(usage_metadata),
+    }
+
+def answer_inquiry(client, file_parts, inquiry_text):
+    """Answers one standalone inquiry without streaming or printing (used by batch mode).
+
+    Returns (response_text, usage dict or None, source) where source is 'cache:<layer>' or the
+    context mode. Generation errors propagate so the batch runner can retry them.
+    """
+    system_text = load_system_prompt()
+
+    drone_match = match_compatibility_inquiry(drone_index, inquiry_text)
+    if drone_answers and template_answer(drone_match):
+        return template_answer(drone_match), None, "drone lookup:template"
+
+    namespace = None
+    if response_cache:
+        namespace = cache_namespace(knowledge_base_version, f"{format}\n{system_text}", cache_model_key(model_router.mode))
+        cached_response, cache_layer = response_cache.lookup(inquiry_text, namespace)
+        if cached_response:
+            return cached_response, None, f"cache:{cache_layer}"
+
+    model_str = model_router.choose(inquiry_text, drone_match=drone_match)["model"]
+    prefix_contents, cache_name, context_mode = build_context_prefix(
+        client, file_parts, system_text, model_str, inquiry_text,
+        index=retrieval_index, cache=context_cache, top_k=retrieval_top_k, drone_match=drone_match,
+    )
+    turns = [types.Content(role="user", parts=first_turn_parts(inquiry_text))]
+    start_time = time.perf_counter()
+    response = generate_content(
+        client, model_str, prefix_contents, turns,
+        types.GenerateContentConfig(temperature=0, response_mime_type="text/plain", cached_content=cache_name),
+        file_parts, system_text,
+    )
+    model_router.record(model_str, (time.perf_counter() - start_time) * 1000, response.usage_metadata)
+    response_text = response.text or ""
+    if not response_text:
+        raise ValueError("empty response from model")
+    if namespace:
+        response_cache.store(inquiry_text, namespace, response_text)
+    return response_text, usage_to_dict(response.usage_metadata), context_mode
+
+def generate_response(client, file_parts, inquiry_text, conversation_history):
     """Generates a response, maintaining conversation history."""
     print("\n📤 Inquiry\n")
     print(inquiry_text + "\n")
@@ -280,73 +358,83 @@ def generate_response(client, file_parts, inquiry_text, model_name, conversation
         return None, conversation_history
 
     try:
-        # Use the model_name argument passed to the function
-        if model_name == 'flash':
-            model_str = "models/gemini-2.0-flash-001"
-        elif model_name == 'flash-lite':
-            model_str = "models/gemini-2.0-flash-lite-001"
-        elif model_name == 'pro':
-            model_str = "models/gemini-2.5-pro-exp-03-25"
-        else:
-            # Default to pro if unspecified or invalid
-            model_str = "models/gemini-2.5-pro-exp-03-25"
-            print(f"Warning: Invalid model '{model_name}' specified. Defaulting to {model_str}")
-
         # --- Construct the prompt based on history ---
-        if not conversation_history: # First turn
-            try:
-                with open("sys_prompts.json", "r") as f:
-                    sys_prompts = json.load(f)
-            except FileNotFoundError:
-                print("Error: sys_prompts.json not found. Exiting.")
-                exit()
-            
-            if format == "chat":
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_chat"])]
-            elif format == "email":
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_email"])]
-            elif format == "voice":
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_voice"])]
-            else:
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_chat"])]
-
-            if file_parts:
-                initial_user_parts.extend(file_parts)
-            initial_user_parts.append(types.Part.from_text(text="--- End of Provided Documents ---"))
-            initial_user_parts.append(types.Part.from_text(text="--- User Inquiry ---"))
-            initial_user_parts.append(types.Part.from_text(text=inquiry_text))
-
-            # Add the combined initial prompt as the first user message
-            conversation_history.append(types.Content(role="user", parts=initial_user_parts))
-            contents = conversation_history # Send the history including the new message
+        # The system prompt and documents form a static prefix: served from the context cache when
+        # available, otherwise sent in front of the conversation on every request. In retrieval mode
+        # the prefix carries only the passages relevant to this inquiry (and the previous one).
+        system_text = load_system_prompt()
+
+        # --- Drone compatibility lookup (the matching sheet rows stand in for the documents) ---
+        # First turn only: mid-conversation the rest of the knowledge base stays in the context
+        drone_match = match_compatibility_inquiry(drone_index, inquiry_text) if not conversation_history else None
+        templated = template_answer(drone_match) if drone_answers and not conversation_history else None
+        if templated:
+            print("⚡ Answered from the supported drones list\n")
+            print(templated, end="")
+            conversation_history.append(types.Content(role="user", parts=first_turn_parts(inquiry_text)))
+            conversation_history.append(types.Content(role="model", parts=[types.Part.from_text(text=templated)]))
+            return None, conversation_history
+
+        # --- Response cache (first turn only; follow-ups depend on the conversation) ---
+        namespace = None
+        if response_cache and not conversation_history:
+            namespace = cache_namespace(knowledge_base_version, f"{format}\n{system_text}", cache_model_key(model_router.mode))
+            cached_response, cache_layer = response_cache.lookup(inquiry_text, namespace)
+            if cached_response:
+                print(f"⚡ Served from response cache ({cache_layer} match)\n")
+                print(cached_response, end="")
+                conversation_history.append(types.Content(role="user", parts=first_turn_parts(inquiry_text)))
+                conversation_history.append(types.Content(role="model", parts=[types.Part.from_text(text=cached_response)]))
+                return None, conversation_history
+
+        # --- Model routing (a fixed tier unless -m auto) ---
+        route = model_router.choose(inquiry_text, history_turns=len(conversation_history) // 2, drone_match=drone_match)
+        model_str = route["model"]
+        if model_router.mode == "auto":
+            print(f"🧭 Model: {route['tier']} ({route['reason']})\n")
+
+        query_text = inquiry_text
+        if conversation_history:
+            query_text = f"{last_user_text(conversation_history)}\n{inquiry_text}"
+        prefix_contents, cache_name, context_mode = build_context_prefix(
+            client, file_parts, system_text, model_str, query_text,
+            index=retrieval_index, cache=context_cache, top_k=retrieval_top_k, drone_match=drone_match,
+        )
+        print(f"📚 Context: {context_mode}\n")
 
+        if not conversation_history: # First turn
+            conversation_history.append(types.Content(role="user", parts=first_turn_parts(inquiry_text)))
         else: # Subsequent turn
             # Append only the new user inquiry
             conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)]))
-            contents = conversation_history # Send the whole history
 
         # Define generation config
         generate_content_config = types.GenerateContentConfig(
             temperature=0,
             response_mime_type="text/plain",
+            cached_content=cache_name,
         )
 
-        stream = client.models.generate_content_stream(
-            model=model_str,
-            contents=contents, # Send the potentially updated history
-            config=generate_content_config,
+        start_time = time.perf_counter()
+        stream = stream_content( # Send the potentially updated history after the prefix
+            client, model_str, prefix_contents, conversation_history, generate_content_config, file_parts, system_text,
         )
 
         for chunk in stream:
             if chunk.text:
+                if not response_text:
+                    metrics.observe("time_to_first_token_seconds", time.perf_counter() - start_time, model=model_str)
                 print(chunk.text, end="")
                 response_text += chunk.text
             if hasattr(chunk, 'usage_metadata') and chunk.usage_metadata:
                 last_usage_metadata = chunk.usage_metadata
+        model_router.record(model_str, (time.perf_counter() - start_time) * 1000, last_usage_metadata)
 
         # Append the complete model response to the history
         if response_text:
              conversation_history.append(types.Content(role="model", parts=[types.Part.from_text(text=response_text)]))
+             if namespace:
+                 response_cache.store(inquiry_text, namespace, response_text)
 
     except Exception as e:
         print(f"\nAn error occurred during generation: {e}")
@@ -359,6 +447,13 @@ if __name__ == "__main__":
     args = parse_arguments()
     model_name = args.model
 
+    # Fail fast on a missing or malformed prompt file rather than on the first inquiry
+    try:
+        prompt_registry.load()
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load system prompts: {e}. Exiting.")
+        exit()
+
     # Prepare files and client ONCE
     genai_client, prepared_file_parts = prepare_context_files(args.download)
 
@@ -366,8 +461,47 @@ if __name__ == "__main__":
         print("Exiting due to issue with GenAI client initialization.")
         exit()
 
-    # Initialize conversation history
+    print(f"Using Gemini {model_name}")
+    model_router = ModelRouter(model_name)
+
+    if not args.no_cache:
+        context_cache = ContextCacheManager(genai_client)
+
+    if not args.no_response_cache:
+        response_cache = ResponseCache(client=genai_client)
+
+    if not args.no_drone_lookup:
+        drone_index = load_drone_index(prepared_file_paths)
+        drone_answers = args.drone_answers
+
+    if args.retrieval:
+        retrieval_top_k = args.top_k
+        retrieval_index = load_or_build_index(
+            "drive", prepared_file_paths, knowledge_base_version, client=genai_client, use_embeddings=args.embeddings
+        )
+
+    # --- Batch mode: answer a JSONL backlog concurrently and exit ---
+    if args.batch:
+        if args.concurrency < 1 or not args.rpm > 0:
+            print("Error: --concurrency and --rpm must be positive. Exiting.")
+            exit()
+        out_path = args.out or f"{os.path.splitext(args.batch)[0]}.responses.jsonl"
+        print(f"Batch mode: {args.batch} -> {out_path} ({args.concurrency} concurrent, {args.rpm:g} requests/min)")
+        summary = run_batch_file(
+            args.batch, out_path,
+            lambda inquiry: answer_inquiry(genai_client, prepared_file_parts, inquiry),
+            concurrency=args.concurrency, requests_per_minute=args.rpm,
+        )
+        print("\n=== Batch Summary ===")
+        print(json.dumps(summary, indent=2))
+        print("Model routing:", json.dumps(model_router.stats(), indent=2))
+        print("=======================")
+        metrics.report_session("main --batch", args.metrics_out)
+        exit()
+
+    # Initialize conversation history (older turns are summarized once over the token budget)
     conversation_history = []
+    history_manager = HistoryManager(genai_client, budget_tokens=args.history_budget)
 
     # Main inquiry loop
     while True:
@@ -391,11 +525,11 @@ if __name__ == "__main__":
 
         # Process this single inquiry, passing and updating history
         start_time = time.time()
+        conversation_history, history_stats = history_manager.trim(conversation_history)
         final_usage_metadata, conversation_history = generate_response(
             genai_client,
             prepared_file_parts,
             inquiry_to_use,
-            args.model,
             conversation_history # Pass current history
         )
         end_time = time.time()
@@ -404,10 +538,23 @@ if __name__ == "__main__":
         # Print summary for this inquiry
         print(f"\n\n=== Summary ===")
         print(f"Time taken: {duration:.2f} seconds")
+        if history_stats["summarized_turns"]:
+            print(f"History Tokens (est.): {history_stats['before_tokens']} -> {history_stats['after_tokens']} ({history_stats['summarized_turns']} earlier turns summarized)")
+        else:
+            print(f"History Tokens (est.): {history_stats['before_tokens']}")
         if final_usage_metadata:
             print(f"Input Tokens: {final_usage_metadata.prompt_token_count}")
             print(f"Output Tokens: {final_usage_metadata.candidates_token_count}")
             print(f"Total Tokens: {final_usage_metadata.total_token_count}")
+            cached_tokens = cached_token_count(final_usage_metadata)
+            if cached_tokens:
+                share = cached_tokens / final_usage_metadata.prompt_token_count if final_usage_metadata.prompt_token_count else 0
+                print(f"Cached Tokens: {cached_tokens} ({share:.0%} of input served from context cache)")
         else:
-            print("Token usage metadata not available for this inquiry.")
+            print("Token usage metadata not available for this inquiry (served from cache or generation failed).")
+        if model_router.mode == "auto":
+            tiers = model_router.stats()["tiers"]
+            print("Session by tier: " + ", ".join(f"{tier} {t['requests']} req, {t['avg_latency_ms']:.0f} ms avg, ${t['cost_usd']:.4f}" for tier, t in tiers.items()))
         print("=======================")
+
+    metrics.report_session("main", args.metrics_out)
@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "skyebot"
+METRICS_JSON = os.environ.get("METRICS_JSON") # CLIs write their end-of-session snapshot here when set
+# Upper bounds in seconds; wide enough for both sub-second cache hits and long pro generations
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# --- Metric Definitions ---
+HISTOGRAMS = {
+    "queue_seconds": "Time an inquiry waited before its model call (stage: rate_limit, generation_slot).",
+    "time_to_first_token_seconds": "Time from sending a streamed request to its first text chunk.",
+    "generation_seconds": "Total time of one model call.",
+    "upload_seconds": "Time to upload or reuse one context file.",
+    "download_seconds": "Time to sync one Drive file.",
+    "tts_seconds": "Time to synthesize one text segment (cache hits excluded).",
+    "stt_seconds": "Time from the end of speech to the final transcript.",
+}
+COUNTERS = {
+    "requests_total": "Model calls by model.",
+    "tokens_total": "Tokens by model and kind (prompt, cached, candidates).",
+}
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+def _format_bound(bound):
+    return f"{bound:g}"
+
+class MetricsRegistry:
+    """Thread-safe histograms and counters, rendered in the Prometheus text format or as JSON.
+
+    Metrics are created on first use; names in HISTOGRAMS and COUNTERS get their help text.
+    Values are kept per label set, so keep labels low-cardinality (model, stage, status).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {} # name -> {label key: {"counts": [per bucket + overflow], "sum", "count"}}
+        self._counters = {} # name -> {label key: value}
+        self.started_at = time.time()
+
+    def observe(self, name, seconds, **labels):
+        """Adds one duration (in seconds) to histogram `name`."""
+        if seconds is None:
+            return
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self._lock:
+            series = self._histograms.setdefault(name, {}).setdefault(
+                _label_key(labels), {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            )
+            series["counts"][index] += 1
+            series["sum"] += seconds
+            series["count"] += 1
+
+    def inc(self, name, amount=1, **labels):
+        """Adds `amount` to counter `name`."""
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the `with` block, also when it raises."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def record_usage(self, model, usage_metadata):
+        """Counts one model call and its prompt, cached and candidate tokens."""
+        self.inc("requests_total", model=model)
+        if not usage_metadata:
+            return
+        self.inc("tokens_total", usage_metadata.prompt_token_count or 0, model=model, kind="prompt")
+        self.inc("tokens_total", getattr(usage_metadata, "cached_content_token_count", None) or 0, model=model, kind="cached")
+        self.inc("tokens_total", usage_metadata.candidates_token_count or 0, model=model, kind="candidates")
+
+    def _percentile(self, counts, count, p):
+        """Estimates a percentile by interpolating inside the bucket that holds it (None if empty)."""
+        if not count:
+            return None
+        rank, seen = p / 100 * count, 0
+        for i, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return round(lower + (upper - lower) * (rank - seen) / bucket_count, 3)
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = f"{NAMESPACE}_{name}"
+                lines += [f"# HELP {full_name} {COUNTERS.get(name, name)}", f"# TYPE {full_name} counter"]
+                for key, value in sorted(series.items()):
+                    lines.append(f"{full_name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                full_name = f"{NAMESPACE}_{name}"
+                lines += [f"# HELP {full_name} {HISTOGRAMS.get(name, name)}", f"# TYPE {full_name} histogram"]
+                for key, data in sorted(series.items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets, data["counts"]):
+                        cumulative += bucket_count
+                        lines.append(f"{full_name}_bucket{_format_labels(key, [('le', _format_bound(bound))])} {cumulative}")
+                    lines.append(f"{full_name}_bucket{_format_labels(key, [('le', '+Inf')])} {data['count']}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {data['sum']:.6f}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {data['count']}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, include_buckets=False):
+        """JSON-serializable counters and per-series histogram summaries (count, sum, avg, p50, p95)."""
+        with self._lock:
+            counters = {
+                name: [{"labels": dict(key), "value": value} for key, value in sorted(series.items())]
+                for name, series in sorted(self._counters.items())
+            }
+            histograms = {}
+            for name, series in sorted(self._histograms.items()):
+                histograms[name] = []
+                for key, data in sorted(series.items()):
+                    entry = {
+                        "labels": dict(key),
+                        "count": data["count"],
+                        "sum_s": round(data["sum"], 3),
+                        "avg_s": round(data["sum"] / data["count"], 3) if data["count"] else None,
+                        "p50_s": self._percentile(data["counts"], data["count"], 50),
+                        "p95_s": self._percentile(data["counts"], data["count"], 95),
+                    }
+                    if include_buckets:
+                        entry["buckets"] = dict(zip([_format_bound(b) for b in self.buckets] + ["+Inf"], data["counts"]))
+                    histograms[name].append(entry)
+        return {"started_at": round(self.started_at, 3), "counters": counters, "histograms": histograms}
+
+    def dump_json(self, path, **extra):
+        """Writes snapshot(include_buckets=True) plus `extra` fields to `path`."""
+        data = dict(extra, generated_at=round(time.time(), 3), **self.snapshot(include_buckets=True))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+
+# --- Process-Wide Registry ---
+# Shared by every module in the process, so uploads, downloads, speech and generation land in one place.
+REGISTRY = MetricsRegistry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+timer = REGISTRY.timer
+record_usage = REGISTRY.record_usage
+render_prometheus = REGISTRY.render_prometheus
+snapshot = REGISTRY.snapshot
+
+def report_session(entry_point, path=None):
+    """End-of-session output for the CLIs: prints the snapshot as JSON and writes the full one to `path` (or METRICS_JSON)."""
+    print("\n=== Session Metrics ===")
+    print(json.dumps(snapshot(), indent=2))
+    path = path or METRICS_JSON
+    if path:
+        try:
+            REGISTRY.dump_json(path, entry_point=entry_point)
+            print(f"Metrics written to {path}")
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+    print("=======================")
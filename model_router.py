@@ -0,0 +1,168 @@
+import logging
+import os
+import re
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- Tier Table ---
+# The one place model versions live; explicit versions are required for context caching.
+# Prices are USD per million tokens (list prices; cached input is billed at CACHED_INPUT_RATE).
+MODEL_TIERS = {
+    "flash-lite": {
+        "model": os.environ.get("MODEL_FLASH_LITE", "models/gemini-2.0-flash-lite-001"),
+        "input_per_million": 0.075, "output_per_million": 0.30,
+    },
+    "flash": {
+        "model": os.environ.get("MODEL_FLASH", "models/gemini-2.0-flash-001"),
+        "input_per_million": 0.10, "output_per_million": 0.40,
+    },
+    "pro": {
+        "model": os.environ.get("MODEL_PRO", "models/gemini-2.5-pro-exp-03-25"),
+        "input_per_million": 1.25, "output_per_million": 10.00,
+    },
+}
+TIER_CHOICES = list(MODEL_TIERS) + ["auto"]
+DEFAULT_TIER = "flash"
+CACHED_INPUT_RATE = 0.25
+
+# --- Routing Heuristics ---
+LITE_MAX_WORDS = int(os.environ.get("ROUTER_LITE_MAX_WORDS", 30))
+PRO_MIN_WORDS = int(os.environ.get("ROUTER_PRO_MIN_WORDS", 80))
+PRO_MIN_TURNS = int(os.environ.get("ROUTER_PRO_MIN_TURNS", 2))
+
+MESSAGE_FIELD = re.compile(r"^\s*message\s*:\s*(.+)", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+LINK_REQUEST = re.compile(
+    r"\b(link|url|download|website|sign\s?up|log\s?in|pricing|price|where\s+(can|do)\s+i\s+(find|get))\b", re.IGNORECASE
+)
+TROUBLESHOOTING = re.compile(
+    r"\b(error|crash\w*|fail\w*|not\s+working|doesn'?t\s+work|won'?t|can'?t|cannot|unable|stuck|freez\w*|bug|broken|"
+    r"issue|problem|disconnect\w*|black\s+screen|keeps)\b",
+    re.IGNORECASE,
+)
+
+def resolve_model_str(tier):
+    """Model version for a tier name, defaulting (with a warning) to DEFAULT_TIER."""
+    if tier not in MODEL_TIERS:
+        logger.warning(f"Unknown model tier '{tier}'; using {DEFAULT_TIER}.")
+        tier = DEFAULT_TIER
+    return MODEL_TIERS[tier]["model"]
+
+def tier_for_model(model_str):
+    for tier, spec in MODEL_TIERS.items():
+        if spec["model"] == model_str:
+            return tier
+    return model_str
+
+def cache_model_key(mode):
+    """Model component of a response-cache namespace: the model itself, or every tier when routing."""
+    if mode == "auto":
+        return "auto:" + ",".join(spec["model"] for spec in MODEL_TIERS.values())
+    return resolve_model_str(mode)
+
+def inquiry_message(inquiry_text):
+    """The customer's message, without the Name/Company/Phone header of a web-form inquiry."""
+    match = MESSAGE_FIELD.search(inquiry_text)
+    return match.group(1) if match else inquiry_text
+
+def classify_inquiry(inquiry_text, history_turns=0, drone_match=None):
+    """(tier, reason) for an inquiry using local heuristics only.
+
+    flash-lite: drone lookups that are not troubleshooting (the prompt is a few sheet rows) and short
+    link or info requests.
+    pro: troubleshooting that is long, asks several questions or has gone back and forth.
+    flash: everything else.
+    """
+    message = inquiry_message(inquiry_text)
+    words = len(message.split())
+    troubleshooting = bool(TROUBLESHOOTING.search(message))
+    if drone_match and not troubleshooting:
+        return "flash-lite", "drone lookup match"
+    if words <= LITE_MAX_WORDS and LINK_REQUEST.search(message) and not troubleshooting and not history_turns:
+        return "flash-lite", f"short link/info request ({words} words)"
+    if troubleshooting:
+        if words >= PRO_MIN_WORDS:
+            return "pro", f"long troubleshooting inquiry ({words} words)"
+        if history_turns >= PRO_MIN_TURNS:
+            return "pro", f"troubleshooting thread ({history_turns} earlier turns)"
+        if message.count("?") >= 3:
+            return "pro", f"troubleshooting with {message.count('?')} questions"
+    return "flash", "default"
+
+def estimate_cost(tier, usage_metadata):
+    """USD cost of one request from its usage metadata (0.0 if unknown)."""
+    spec = MODEL_TIERS.get(tier)
+    if not spec or not usage_metadata:
+        return 0.0
+    input_tokens = usage_metadata.prompt_token_count or 0
+    output_tokens = usage_metadata.candidates_token_count or 0
+    cached_tokens = min(getattr(usage_metadata, "cached_content_token_count", None) or 0, input_tokens)
+    billed_input = (input_tokens - cached_tokens) + cached_tokens * CACHED_INPUT_RATE
+    return (billed_input * spec["input_per_million"] + output_tokens * spec["output_per_million"]) / 1_000_000
+
+class ModelRouter:
+    """Picks the model per inquiry and keeps per-tier latency, token and cost totals.
+
+    `mode` is a tier name (every inquiry uses it) or 'auto' (classify_inquiry decides). Thread-safe,
+    so one router can serve the batch runner and the worker's concurrent requests.
+    """
+
+    def __init__(self, mode=DEFAULT_TIER):
+        self.mode = mode if mode in TIER_CHOICES else DEFAULT_TIER
+        self._lock = threading.Lock()
+        self._tiers = {} # tier -> running totals
+        self._reasons = {} # reason -> count
+
+    def choose(self, inquiry_text, history_turns=0, drone_match=None, mode=None):
+        """Returns {"tier", "model", "reason"} for the inquiry and logs the decision.
+
+        `mode` overrides the router's own for this call (for callers that pass the -m choice along).
+        """
+        mode = mode or self.mode
+        if mode == "auto":
+            tier, reason = classify_inquiry(inquiry_text, history_turns, drone_match)
+        else:
+            tier, reason = mode, "fixed by -m"
+        reason_key = reason.split(" (")[0] # Counted without the per-inquiry detail
+        with self._lock:
+            self._reasons[reason_key] = self._reasons.get(reason_key, 0) + 1
+        route = {"tier": tier, "model": resolve_model_str(tier), "reason": reason}
+        if mode == "auto":
+            logger.info(f"Routed to {tier} ({route['model']}): {reason}")
+        return route
+
+    def record(self, model_str, latency_ms, usage_metadata=None):
+        """Adds one finished request to the totals of its tier and logs its latency and cost.
+
+        Also feeds the process-wide generation-time histogram and token counters (metrics.py).
+        """
+        tier = tier_for_model(model_str)
+        cost = estimate_cost(tier, usage_metadata)
+        input_tokens = (usage_metadata.prompt_token_count or 0) if usage_metadata else 0
+        output_tokens = (usage_metadata.candidates_token_count or 0) if usage_metadata else 0
+        with self._lock:
+            totals = self._tiers.setdefault(tier, {"requests": 0, "latency_ms": 0.0, "input_tokens": 0, "output_tokens": 0, "cost_usd": 0.0})
+            totals["requests"] += 1
+            totals["latency_ms"] += latency_ms
+            totals["input_tokens"] += input_tokens
+            totals["output_tokens"] += output_tokens
+            totals["cost_usd"] += cost
+        metrics.observe("generation_seconds", latency_ms / 1000, model=model_str)
+        metrics.record_usage(model_str, usage_metadata)
+        logger.info(f"{tier}: {latency_ms:.0f} ms, {input_tokens} in / {output_tokens} out tokens, ${cost:.5f}")
+
+    def stats(self):
+        """Per-tier requests, average latency, tokens and cost, plus how often each routing reason fired."""
+        with self._lock:
+            tiers = {
+                tier: {
+                    "requests": totals["requests"],
+                    "avg_latency_ms": round(totals["latency_ms"] / totals["requests"], 1),
+                    "input_tokens": totals["input_tokens"],
+                    "output_tokens": totals["output_tokens"],
+                    "cost_usd": round(totals["cost_usd"], 5),
+                }
+                for tier, totals in self._tiers.items()
+            }
+            return {"mode": self.mode, "tiers": tiers, "reasons": dict(self._reasons)}
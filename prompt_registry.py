@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+PROMPTS_FILE = os.environ.get("SYS_PROMPTS_FILE", "sys_prompts.json")
+FALLBACK_FILE = "sysprompts.md" # Used when the JSON file is missing
+RELOAD_CHECK_SECONDS = float(os.environ.get("PROMPT_RELOAD_CHECK_SECONDS", 2)) # How often the file's mtime is checked
+FORMATS = ("email", "chat", "voice")
+MAX_PREFIXES = 16 # Prebuilt prefixes kept per prompt version (one per prompt x file set in practice)
+
+# sysprompts.md sections ("# <heading>") that hold each format's prompt
+MD_SECTION_FORMATS = {"more thinking": "email", "chat": "chat", "voice": "voice"}
+
+# Markers shared by every prompt layout
+INQUIRY_MARKER = "--- User Inquiry ---"
+END_OF_DOCUMENTS_MARKER = "--- End of Provided Documents ---"
+INQUIRY_MARKER_PART = types.Part.from_text(text=INQUIRY_MARKER)
+END_OF_DOCUMENTS_PART = types.Part.from_text(text=END_OF_DOCUMENTS_MARKER)
+
+def parse_prompts_json(text):
+    """{format: prompt} from sys_prompts.json ({"system_instruction_<format>": "..."})."""
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object of system_instruction_<format> keys")
+    return {key[len("system_instruction_"):]: value for key, value in data.items() if key.startswith("system_instruction_")}
+
+def parse_prompts_markdown(text):
+    """{format: prompt} from the '# <heading>' sections of sysprompts.md named in MD_SECTION_FORMATS."""
+    prompts, heading, lines = {}, None, []
+    for line in text.splitlines() + ["# "]:
+        if line.startswith("# "):
+            if heading in MD_SECTION_FORMATS:
+                prompts[MD_SECTION_FORMATS[heading]] = "\n".join(lines).strip()
+            heading, lines = line[2:].strip().lower(), []
+        else:
+            lines.append(line)
+    return prompts
+
+def validate_prompts(prompts, path):
+    """Raises ValueError unless every format has a non-empty string prompt."""
+    missing = [fmt for fmt in FORMATS if not isinstance(prompts.get(fmt), str) or not prompts[fmt].strip()]
+    if missing:
+        raise ValueError(f"{path} has no system prompt for: {', '.join(missing)}")
+    unknown = sorted(set(prompts) - set(FORMATS))
+    if unknown:
+        logger.warning(f"{path}: ignoring prompts for unknown formats {unknown}")
+
+class PromptRegistry:
+    """System prompts for every format, loaded once and reloaded when the file changes.
+
+    Reads `path` (sys_prompts.json), or `fallback_path` (sysprompts.md) if that is missing. Lookups
+    check the file's mtime at most every RELOAD_CHECK_SECONDS; a changed file is re-read and
+    validated, and an invalid edit is logged and ignored so requests keep the last good prompts.
+    The static Part objects built from the prompts are reused until the next reload.
+    """
+
+    def __init__(self, path=PROMPTS_FILE, fallback_path=FALLBACK_FILE):
+        self.path = path
+        self.fallback_path = fallback_path
+        self.version = None # Short hash of the loaded prompts
+        self._lock = threading.Lock()
+        self._prompts = None
+        self._source = None # (path, mtime, size) of the loaded file
+        self._next_check = 0.0
+        self._parts = {} # prompt text -> Part
+        self._prefixes = {} # (prompt text, file part ids) -> [Part, ...]
+
+    def _current_file(self):
+        for path in (self.path, self.fallback_path):
+            try:
+                stat = os.stat(path)
+                return path, stat.st_mtime, stat.st_size
+            except OSError:
+                continue
+        raise FileNotFoundError(f"{self.path} not found (nor {self.fallback_path})")
+
+    def _read(self, source):
+        path = source[0]
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        prompts = parse_prompts_json(text) if path.endswith(".json") else parse_prompts_markdown(text)
+        validate_prompts(prompts, path)
+        return prompts, hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+    def load(self):
+        """Loads and validates the prompts now; raises FileNotFoundError or ValueError (JSONDecodeError included)."""
+        with self._lock:
+            source = self._current_file()
+            prompts, version = self._read(source)
+            self._install(source, prompts, version)
+        logger.info(f"Loaded system prompts from {source[0]} (version {version}).")
+
+    def _install(self, source, prompts, version):
+        """Swaps in new prompts; callers hold the lock."""
+        self._prompts, self._source, self.version = prompts, source, version
+        self._parts.clear()
+        self._prefixes.clear()
+        self._next_check = time.monotonic() + RELOAD_CHECK_SECONDS
+
+    def _refresh(self):
+        """Loads on first use and reloads a changed file; callers hold the lock."""
+        if self._prompts is not None and time.monotonic() < self._next_check:
+            return
+        self._next_check = time.monotonic() + RELOAD_CHECK_SECONDS
+        try:
+            source = self._current_file()
+        except FileNotFoundError:
+            if self._prompts is None:
+                raise
+            return # Deleted mid-run: keep serving what was loaded
+        if source == self._source:
+            return
+        try:
+            prompts, version = self._read(source)
+        except (OSError, ValueError) as e:
+            if self._prompts is None:
+                raise
+            logger.error(f"Ignoring invalid edit to {source[0]}: {e}. Keeping prompt version {self.version}.")
+            self._source = source # Don't re-read the same broken file on every check
+            return
+        if self._prompts is not None:
+            logger.info(f"Reloaded system prompts from {source[0]} (version {self.version} -> {version}).")
+        self._install(source, prompts, version)
+
+    def text(self, fmt):
+        """Current system prompt for `fmt` ('chat' for an unknown format)."""
+        with self._lock:
+            self._refresh()
+            return self._prompts.get(fmt) or self._prompts["chat"]
+
+    def part_for(self, text):
+        """Shared Part for a prompt text, built once per prompt version."""
+        with self._lock:
+            part = self._parts.get(text)
+            if part is None:
+                part = self._parts[text] = types.Part.from_text(text=text)
+            return part
+
+    def system_part(self, fmt):
+        return self.part_for(self.text(fmt))
+
+    def prefix_parts(self, text, file_parts=None, reuse=True):
+        """[prompt, *file_parts, end-of-documents marker] as a new list of shared Parts.
+
+        With `reuse` the list is cached per prompt text and file-part set (the uploaded documents),
+        so repeated requests only copy it; pass reuse=False for parts built for a single request.
+        """
+        if not reuse:
+            return [self.part_for(text)] + list(file_parts or ()) + [END_OF_DOCUMENTS_PART]
+        key = (text, tuple(id(part) for part in file_parts or ()))
+        with self._lock:
+            prefix = self._prefixes.get(key)
+        if prefix is None:
+            prefix = [self.part_for(text)] + list(file_parts or ()) + [END_OF_DOCUMENTS_PART]
+            with self._lock:
+                if len(self._prefixes) >= MAX_PREFIXES:
+                    self._prefixes.clear()
+                self._prefixes[key] = prefix
+        return list(prefix)
+
+    def stats(self):
+        with self._lock:
+            return {"source": self._source[0] if self._source else None, "version": self.version,
+                    "formats": sorted(self._prompts) if self._prompts else []}
@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from retrieval import embed_texts, cosine_similarity
+from model_router import inquiry_message
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 512))
+DEFAULT_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 24 * 3600))
+DEFAULT_SIMILARITY_THRESHOLD = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.95))
+EMBEDDING_MEMO_SIZE = 64
+
+NAME_FIELD = re.compile(r"^\s*name\s*:\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+HEADER_FIELD = re.compile(r"^\s*([a-z][\w ]*?)\s*:\s*(.+?)\s*$", re.IGNORECASE | re.MULTILINE)
+URL_PATTERN = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+
+def normalize_inquiry(text):
+    """Lowercases, strips punctuation and collapses whitespace so trivially different inquiries match."""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+def cache_namespace(kb_version, prompt_text, model_str):
+    """Cache namespace: answers are only valid for one knowledge-base version, prompt and model."""
+    prompt_key = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12]
+    return f"{kb_version}:{prompt_key}:{model_str}"
+
+def message_key(inquiry):
+    """Normalized customer message, without the Name/Company/Phone header of a web-form inquiry."""
+    return normalize_inquiry(inquiry_message(inquiry))
+
+def identifying_tokens(inquiry):
+    """URLs and tokens containing a digit (model numbers like "3", "m30t", "v2") in the customer's message.
+
+    Embeddings barely separate "Mavic 2" from "Mavic 3", so a semantic hit also needs these to match.
+    The web-form header is left out, since a phone number would make every customer's tokens differ.
+    """
+    text = NAME_FIELD.sub(" ", inquiry_message(inquiry))
+    urls = {url.rstrip(".,;:!?)]}>'\"").lower() for url in URL_PATTERN.findall(text)}
+    words = normalize_inquiry(URL_PATTERN.sub(" ", text)).split()
+    return frozenset(urls | {word for word in words if any(ch.isdigit() for ch in word)})
+
+def _customer_first_name(inquiry):
+    match = NAME_FIELD.search(inquiry)
+    return match.group(1).split()[0].strip(",") if match else None
+
+def _customer_details(inquiry):
+    """{field: value} of the web-form header other than Name (Company, Phone, ...); {} for a plain message."""
+    message = inquiry_message(inquiry)
+    if message is inquiry:
+        return {}
+    header = inquiry[:inquiry.rfind(message)]
+    return {
+        field.lower(): value for field, value in HEADER_FIELD.findall(header)
+        if field.lower() not in ("name", "message")
+    }
+
+class ResponseCache:
+    """Response cache for repeated inquiries, checked before generation.
+
+    Layers: exact match on the normalized customer message (web-form header excluded), then embedding similarity above a threshold
+    (when a GenAI client is available) among entries with the same identifying tokens (model numbers,
+    URLs), with LRU eviction and a TTL on every entry. All keys live in a
+    namespace built from the knowledge-base version, prompt and model, so a doc refresh or prompt
+    change never serves stale answers.
+    """
+
+    def __init__(self, client=None, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD, semantic=True):
+        self.client = client
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.semantic = semantic and client is not None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (namespace, normalized) -> entry dict, least recently used first
+        self._embedding_memo = OrderedDict() # normalized text -> embedding, avoids embedding twice per miss
+        self._counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def _embed(self, normalized):
+        with self._lock:
+            if normalized in self._embedding_memo:
+                return self._embedding_memo[normalized]
+        vectors = embed_texts(self.client, [normalized])
+        vector = vectors[0] if vectors else None
+        with self._lock:
+            self._embedding_memo[normalized] = vector
+            while len(self._embedding_memo) > EMBEDDING_MEMO_SIZE:
+                self._embedding_memo.popitem(last=False)
+        return vector
+
+    def _is_expired(self, entry, now):
+        return now - entry["created_at"] > self.ttl_seconds
+
+    def lookup(self, inquiry, namespace):
+        """Returns (response_text, layer) on a hit, where layer is 'exact' or 'semantic'; (None, None) on a miss."""
+        normalized = message_key(inquiry)
+        key = (namespace, normalized)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._is_expired(entry, now):
+                del self._entries[key]
+                self._counters["expired"] += 1
+                entry = None
+            response = self._personalize(entry, inquiry) if entry else None
+            if response is not None:
+                self._entries.move_to_end(key)
+                self._counters["exact_hits"] += 1
+                return response, "exact"
+            has_candidates = self.semantic and any(ns == namespace for ns, _ in self._entries)
+
+        if has_candidates:
+            vector = self._embed(normalized)
+            if vector:
+                identifiers = identifying_tokens(inquiry)
+                best_key, best_score = None, 0.0
+                with self._lock:
+                    for candidate_key, candidate in self._entries.items():
+                        if candidate_key[0] != namespace or not candidate.get("embedding") or self._is_expired(candidate, now):
+                            continue
+                        if candidate["identifiers"] != identifiers:
+                            continue # Same wording about a different model or link is a different question
+                        score = cosine_similarity(vector, candidate["embedding"])
+                        if score > best_score:
+                            best_key, best_score = candidate_key, score
+                    if best_key and best_score >= self.similarity_threshold:
+                        candidate = self._entries[best_key]
+                        response = self._personalize(candidate, inquiry)
+                        if response is not None:
+                            self._entries.move_to_end(best_key)
+                            self._counters["semantic_hits"] += 1
+                            logger.info(f"Semantic response-cache hit (similarity {best_score:.3f}).")
+                            return response, "semantic"
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None, None
+
+    @staticmethod
+    def _personalize(entry, inquiry):
+        """Swaps the greeting name of a cached email answer for the new customer's (None if unsafe).
+
+        An answer that mentions the previous customer's details (company, phone, ...) is never reused
+        for someone else.
+        """
+        new_details = _customer_details(inquiry)
+        response_text = entry["response"].lower()
+        for field, value in entry.get("customer_details", {}).items():
+            if new_details.get(field) != value and value.lower() in response_text:
+                return None
+        old_name, new_name = entry.get("customer_name"), _customer_first_name(inquiry)
+        if old_name == new_name:
+            return entry["response"]
+        if old_name and new_name and entry["response"].startswith(old_name):
+            return new_name + entry["response"][len(old_name):]
+        return None # Greeting can't be adapted; treat as a miss rather than address the wrong person
+
+    def store(self, inquiry, namespace, response_text):
+        """Caches a generated response for this inquiry under the given namespace."""
+        if not response_text:
+            return
+        normalized = message_key(inquiry)
+        embedding = self._embed(normalized) if self.semantic else None
+        with self._lock:
+            self._entries[(namespace, normalized)] = {
+                "response": response_text,
+                "embedding": embedding,
+                "customer_name": _customer_first_name(inquiry),
+                "customer_details": _customer_details(inquiry),
+                "identifiers": identifying_tokens(inquiry),
+                "created_at": time.time(),
+            }
+            self._entries.move_to_end((namespace, normalized))
+            self._counters["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def stats(self):
+        """Returns hit/miss counters, hit rate and current size."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["size"] = len(self._entries)
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["exact_hits"] + stats["semantic_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
@@ -0,0 +1,223 @@
+import csv
+import io
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".retrieval_index.json"
+INDEX_FORMAT_VERSION = 1
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHUNK_MAX_CHARS = 1200
+CHUNK_OVERLAP_CHARS = 200
+MIN_BM25_SCORE = 1.0 # Below this the best match is too weak; callers fall back to full context
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60 # Reciprocal-rank-fusion constant for combining BM25 and embedding rankings
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from", "have", "how", "i",
+    "if", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "was", "we",
+    "what", "when", "which", "with", "you", "your",
+}
+
+def tokenize(text):
+    """Lowercases and splits text into alphanumeric terms, dropping common stopwords."""
+    return [term for term in TOKEN_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+# --- Chunking ---
+def _split_long(text, max_chars, overlap):
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(len(text), start + max_chars)
+        if end < len(text): # Prefer breaking at a sentence or word boundary
+            boundary = max(text.rfind(". ", start, end), text.rfind("\n", start, end))
+            if boundary <= start:
+                boundary = text.rfind(" ", start, end)
+            if boundary > start:
+                end = boundary + 1
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [chunk for chunk in chunks if chunk]
+
+def chunk_text(text, max_chars=CHUNK_MAX_CHARS, overlap=CHUNK_OVERLAP_CHARS):
+    """Splits prose into passages of up to `max_chars`, packing whole paragraphs where possible."""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    chunks, current = [], ""
+    for paragraph in paragraphs:
+        if len(paragraph) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.extend(_split_long(paragraph, max_chars, overlap))
+        elif len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            current = paragraph
+        else:
+            current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+def chunk_csv(text, max_chars=CHUNK_MAX_CHARS):
+    """Groups CSV rows into passages, repeating the header row in each so passages stand alone."""
+    rows = list(csv.reader(io.StringIO(text)))
+    if not rows:
+        return []
+    header, body = rows[0], rows[1:]
+    header_line = ", ".join(header)
+    chunks, current = [], []
+    for row in body:
+        line = "; ".join(f"{column}: {value}" for column, value in zip(header, row) if value.strip())
+        if not line:
+            continue
+        if current and sum(len(r) + 1 for r in current) + len(line) > max_chars:
+            chunks.append(header_line + "\n" + "\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        chunks.append(header_line + "\n" + "\n".join(current))
+    return chunks
+
+def cosine_similarity(a, b):
+    """Cosine similarity of two equal-length vectors (0.0 if either is all zeros)."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class RetrievalIndex:
+    """BM25 (and optionally embedding) index over knowledge-base passages, persisted per KB version."""
+
+    def __init__(self, passages, kb_version, embeddings=None):
+        self.passages = passages # [{"source": name, "text": passage}]
+        self.kb_version = kb_version
+        self.embeddings = embeddings # Parallel list of vectors, or None
+        self._term_freqs = [Counter(tokenize(p["text"])) for p in passages]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0
+        doc_freqs = Counter()
+        for tf in self._term_freqs:
+            doc_freqs.update(tf.keys())
+        n = len(passages)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    @classmethod
+    def build(cls, file_paths, kb_version, client=None, use_embeddings=False):
+        """Chunks every file in {name: path} and builds the index (embedding passages if requested)."""
+        passages = []
+        for name in sorted(file_paths):
+            try:
+                with open(file_paths[name], "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            except OSError as e:
+                logger.warning(f"Could not read {file_paths[name]} for retrieval index: {e}")
+                continue
+            chunks = chunk_csv(text) if file_paths[name].lower().endswith(".csv") else chunk_text(text)
+            passages.extend({"source": name, "text": chunk} for chunk in chunks)
+
+        embeddings = None
+        if use_embeddings and client and passages:
+            embeddings = embed_texts(client, [p["text"] for p in passages])
+        logger.info(f"Built retrieval index: {len(passages)} passages from {len(file_paths)} files{' with embeddings' if embeddings else ''}.")
+        return cls(passages, kb_version, embeddings)
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({
+                "format": INDEX_FORMAT_VERSION,
+                "kb_version": self.kb_version,
+                "passages": self.passages,
+                "embeddings": self.embeddings,
+            }, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("format") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"unsupported index format {data.get('format')}")
+        return cls(data["passages"], data["kb_version"], data.get("embeddings"))
+
+    def _bm25_scores(self, query):
+        terms = tokenize(query)
+        scores = []
+        for tf, length in zip(self._term_freqs, self._lengths):
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    norm = freq * (BM25_K1 + 1) / (freq + BM25_K1 * (1 - BM25_B + BM25_B * length / (self._avg_length or 1)))
+                    score += self._idf[term] * norm
+            scores.append(score)
+        return scores
+
+    def search(self, query, top_k=6, client=None):
+        """Returns up to `top_k` passages ({"source", "text", "score"}), best first; [] if nothing matches well."""
+        if not self.passages:
+            return []
+        bm25 = self._bm25_scores(query)
+        if max(bm25) < MIN_BM25_SCORE and not self.embeddings:
+            return []
+        ranked = sorted(range(len(bm25)), key=lambda i: bm25[i], reverse=True)
+
+        if self.embeddings and client:
+            query_vectors = embed_texts(client, [query])
+            if query_vectors:
+                similarities = [cosine_similarity(query_vectors[0], vector) for vector in self.embeddings]
+                by_embedding = sorted(range(len(similarities)), key=lambda i: similarities[i], reverse=True)
+                fused = Counter()
+                for rank, i in enumerate(ranked):
+                    fused[i] += 1 / (RRF_K + rank)
+                for rank, i in enumerate(by_embedding):
+                    fused[i] += 1 / (RRF_K + rank)
+                return [dict(self.passages[i], score=round(score, 5)) for i, score in fused.most_common(top_k)]
+
+        return [dict(self.passages[i], score=round(bm25[i], 3)) for i in ranked[:top_k] if bm25[i] > 0]
+
+def embed_texts(client, texts, batch_size=100):
+    """Embeds texts with the GenAI embedding model (None if embedding fails)."""
+    vectors = []
+    try:
+        for start in range(0, len(texts), batch_size):
+            result = client.models.embed_content(model=EMBEDDING_MODEL, contents=texts[start:start + batch_size])
+            vectors.extend(embedding.values for embedding in result.embeddings)
+    except Exception as e:
+        logger.warning(f"Embedding request failed; using BM25 only: {e}")
+        return None
+    return vectors
+
+def load_or_build_index(index_dir, file_paths, kb_version, client=None, use_embeddings=False):
+    """Loads the saved index for this KB version, rebuilding (and saving) it if missing or stale.
+
+    Embeddings saved by an earlier --embeddings run are only used when `use_embeddings` is set, so a
+    BM25-only run never calls the embedding API.
+    """
+    path = os.path.join(index_dir, INDEX_FILENAME)
+    try:
+        index = RetrievalIndex.load(path)
+        if index.kb_version == kb_version and (index.embeddings or not use_embeddings):
+            if not use_embeddings:
+                index.embeddings = None
+            logger.info(f"Loaded retrieval index ({len(index.passages)} passages) for KB version {kb_version}.")
+            return index
+        logger.info("Retrieval index is out of date; rebuilding.")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Could not load retrieval index {path}: {e}. Rebuilding.")
+
+    index = RetrievalIndex.build(file_paths, kb_version, client=client, use_embeddings=use_embeddings)
+    try:
+        index.save(path)
+    except OSError as e:
+        logger.warning(f"Could not save retrieval index {path}: {e}")
+    return index
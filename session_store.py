@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", 1000))
+DEFAULT_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 14 * 24 * 3600)) # Email threads go quiet for days
+DEFAULT_MAX_SESSION_CHARS = int(os.environ.get("SESSION_MAX_CHARS", 24000)) # ~6k tokens of earlier turns per thread
+DEFAULT_DB_PATH = os.environ.get("SESSION_DB_PATH") # Unset keeps sessions in memory only
+
+# --- Backends (store {"turns": [...], "updated_at": float} per thread id) ---
+class MemoryBackend:
+    """In-process LRU dict holding at most `max_sessions` threads."""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+
+    def get(self, thread_id):
+        session = self._sessions.get(thread_id)
+        if session is not None:
+            self._sessions.move_to_end(thread_id)
+        return session
+
+    def update(self, thread_id, modify):
+        """Stores modify(current session or None) and returns the thread ids evicted to stay within max_sessions."""
+        self._sessions[thread_id] = modify(self._sessions.get(thread_id))
+        self._sessions.move_to_end(thread_id)
+        evicted = []
+        while len(self._sessions) > self.max_sessions:
+            evicted.append(self._sessions.popitem(last=False)[0])
+        return evicted
+
+    def delete(self, thread_id):
+        self._sessions.pop(thread_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+class SqliteBackend:
+    """SQLite table keyed by thread id, so sessions survive restarts and are shared by worker processes."""
+
+    def __init__(self, db_path, max_sessions):
+        self.max_sessions = max_sessions
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer across processes
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (thread_id TEXT PRIMARY KEY, turns TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._conn.commit()
+
+    def get(self, thread_id):
+        row = self._conn.execute("SELECT turns, updated_at FROM sessions WHERE thread_id = ?", (thread_id,)).fetchone()
+        return {"turns": json.loads(row[0]), "updated_at": row[1]} if row else None
+
+    def update(self, thread_id, modify):
+        """Read-modify-write in one BEGIN IMMEDIATE transaction, so other processes can't interleave and lose a turn."""
+        self._conn.execute("BEGIN IMMEDIATE") # Takes the database write lock before reading
+        try:
+            session = modify(self.get(thread_id))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (thread_id, turns, updated_at) VALUES (?, ?, ?)",
+                (thread_id, json.dumps(session["turns"]), session["updated_at"]),
+            )
+            evicted = [row[0] for row in self._conn.execute(
+                "SELECT thread_id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?", (self.max_sessions,)
+            )]
+            self._conn.executemany("DELETE FROM sessions WHERE thread_id = ?", [(t,) for t in evicted])
+        except BaseException:
+            self._conn.rollback()
+            raise
+        self._conn.commit()
+        return evicted
+
+    def delete(self, thread_id):
+        with self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE thread_id = ?", (thread_id,))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+# --- Session Store ---
+class SessionStore:
+    """Per-thread conversation history for the webhook worker.
+
+    Each email thread keeps its earlier exchanges as plain {"role", "text"} turns (documents are never
+    stored). Sessions expire `ttl_seconds` after their last update, the least recently used are
+    evicted beyond `max_sessions`, and the oldest exchanges are dropped once a session exceeds
+    `max_session_chars`. Use `with lock(thread_id):` around read-generate-append so concurrent
+    requests for the same thread are applied in order.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_session_chars=DEFAULT_MAX_SESSION_CHARS, db_path=DEFAULT_DB_PATH):
+        self.ttl_seconds = ttl_seconds
+        self.max_session_chars = max_session_chars
+        self._backend = SqliteBackend(db_path, max_sessions) if db_path else MemoryBackend(max_sessions)
+        self._lock = threading.Lock() # Guards the backend and the lock table
+        self._thread_locks = {} # thread_id -> [lock, requests holding or waiting for it]
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "truncated": 0}
+        logger.info(f"Session store: {'SQLite at ' + db_path if db_path else 'in memory'}, up to {max_sessions} threads, TTL {ttl_seconds}s.")
+
+    @contextmanager
+    def lock(self, thread_id):
+        """Holds the lock serializing requests for one thread; it is dropped once no request uses it."""
+        with self._lock:
+            entry = self._thread_locks.setdefault(thread_id, [threading.Lock(), 0])
+            entry[1] += 1 # Counted before acquiring, so a waiting request keeps the same lock alive
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._thread_locks[thread_id]
+
+    def get(self, thread_id):
+        """Earlier turns of the thread ([{"role", "text"}], oldest first); [] if unknown or expired."""
+        with self._lock:
+            session = self._backend.get(thread_id)
+            if session and time.time() - session["updated_at"] > self.ttl_seconds:
+                self._backend.delete(thread_id)
+                self._counters["expired"] += 1
+                session = None
+            self._counters["hits" if session else "misses"] += 1
+            return list(session["turns"]) if session else []
+
+    def append(self, thread_id, user_text, model_text):
+        """Records one exchange, dropping the oldest exchanges if the session exceeds its size cap."""
+        def add_exchange(session):
+            turns = list(session["turns"]) if session and time.time() - session["updated_at"] <= self.ttl_seconds else []
+            turns += [{"role": "user", "text": user_text}, {"role": "model", "text": model_text}]
+            while len(turns) > 2 and sum(len(turn["text"]) for turn in turns) > self.max_session_chars:
+                turns = turns[2:]
+                self._counters["truncated"] += 1
+            return {"turns": turns, "updated_at": time.time()}
+
+        with self._lock:
+            evicted = self._backend.update(thread_id, add_exchange)
+            self._counters["evicted"] += len(evicted)
+
+    def delete(self, thread_id):
+        with self._lock:
+            self._backend.delete(thread_id)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, sessions=len(self._backend))
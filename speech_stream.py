@@ -0,0 +1,403 @@
+import concurrent.futures
+import logging
+import math
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import wave
+from array import array
+from collections import deque
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30 # WebRTC VAD accepts 10, 20 or 30 ms frames of 16-bit mono PCM
+STT_CHUNK_MS = 100 # Audio per streaming_recognize request (Google recommends ~100 ms)
+LANGUAGE_CODE = os.environ.get("STT_LANGUAGE_CODE", "en-US")
+VAD_BACKEND = os.environ.get("VAD_BACKEND", "auto") # auto (webrtc if installed), webrtc or energy
+SPEECH_START_MS = int(os.environ.get("VAD_SPEECH_START_MS", 90)) # Voiced audio needed before an utterance begins
+END_SILENCE_MS = int(os.environ.get("VAD_END_SILENCE_MS", 700)) # Trailing silence that ends an utterance
+PREROLL_MS = 300 # Audio kept from before the detected start so the first syllable is not clipped
+MAX_UTTERANCE_SECONDS = float(os.environ.get("VAD_MAX_UTTERANCE_SECONDS", 30))
+NO_SPEECH_TIMEOUT_SECONDS = float(os.environ.get("VAD_NO_SPEECH_TIMEOUT_SECONDS", 8)) # Below the API's audio timeout
+STABLE_PARTIAL = 0.8 # Interim result stability treated as settled
+SPECULATE_SILENCE_MS = int(os.environ.get("SPECULATE_SILENCE_MS", 250)) # A pause this long also marks a partial as settled
+BARGE_IN_SPEECH_MS = int(os.environ.get("BARGE_IN_SPEECH_MS", 250)) # Caller speech that interrupts the assistant
+
+# --- Audio Sources (yield FRAME_MS frames of 16-bit mono PCM) ---
+class MicrophoneSource:
+    """Live microphone frames from a sounddevice input stream."""
+
+    def __init__(self, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS, device=None):
+        import sounddevice as sd # PortAudio is loaded here, so file replay works on machines without audio devices
+        self.sample_rate = sample_rate
+        self._frames = queue.Queue()
+        self._stream = sd.RawInputStream(
+            samplerate=sample_rate, channels=1, dtype="int16", blocksize=sample_rate * frame_ms // 1000,
+            device=device, callback=lambda indata, frames, time_info, status: self._frames.put(bytes(indata)),
+        )
+
+    def frames(self):
+        self._stream.start()
+        try:
+            while True:
+                yield self._frames.get()
+        finally:
+            self._stream.stop()
+
+    def close(self):
+        self._stream.close()
+
+class FileReplaySource:
+    """Frames from a 16-bit mono WAV file, paced like a live microphone unless `realtime` is False."""
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, frame_ms=FRAME_MS, realtime=True):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self.frame_seconds = frame_ms / 1000
+        self.realtime = realtime
+        with wave.open(path, "rb") as wav:
+            if wav.getnchannels() != 1 or wav.getsampwidth() != 2 or wav.getframerate() != sample_rate:
+                raise ValueError(
+                    f"{path} must be 16-bit mono PCM at {sample_rate} Hz "
+                    f"(convert with: ffmpeg -i input -ac 1 -ar {sample_rate} -sample_fmt s16 output.wav)"
+                )
+
+    def frames(self):
+        with wave.open(self.path, "rb") as wav:
+            next_time = time.monotonic()
+            while True:
+                frame = wav.readframes(self.frame_bytes // 2)
+                if len(frame) < self.frame_bytes:
+                    return # The trailing partial frame is dropped (WebRTC VAD needs whole frames)
+                if self.realtime:
+                    next_time += self.frame_seconds
+                    time.sleep(max(0, next_time - time.monotonic()))
+                yield frame
+
+    def close(self):
+        pass
+
+# --- Voice Activity Detection ---
+class EnergyVAD:
+    """Marks frames as speech when their RMS energy clears an adaptive noise floor."""
+
+    def __init__(self, ratio=3.0, min_rms=300):
+        self.ratio = ratio
+        self.min_rms = min_rms
+        self.noise_floor = 0.0 # Starts at min_rms alone, so speech in the very first frames still counts
+
+    def is_speech(self, frame, sample_rate=SAMPLE_RATE):
+        samples = array("h", frame)
+        if sys.byteorder == "big":
+            samples.byteswap() # WAV and sounddevice PCM is little-endian
+        rms = math.sqrt(sum(sample * sample for sample in samples) / len(samples)) if samples else 0
+        speech = rms > max(self.min_rms, self.noise_floor * self.ratio)
+        if not speech:
+            self.noise_floor = 0.95 * self.noise_floor + 0.05 * rms # Follow slow changes in background noise
+        return speech
+
+class WebRtcVAD:
+    """WebRTC's GMM voice detector (the optional `webrtcvad` package); more robust to noise than energy."""
+
+    def __init__(self, aggressiveness=2):
+        import webrtcvad
+        self._vad = webrtcvad.Vad(aggressiveness)
+
+    def is_speech(self, frame, sample_rate=SAMPLE_RATE):
+        return self._vad.is_speech(frame, sample_rate)
+
+def make_vad(kind=None):
+    """Builds the VAD named by `kind` or VAD_BACKEND; 'auto' uses WebRTC when webrtcvad is installed."""
+    kind = kind or VAD_BACKEND
+    if kind in ("auto", "webrtc"):
+        try:
+            return WebRtcVAD()
+        except ImportError:
+            if kind == "webrtc":
+                raise
+    return EnergyVAD()
+
+class Endpointer:
+    """Cuts one utterance out of a frame stream using a VAD.
+
+    Nothing is passed on until SPEECH_START_MS of consecutive speech is seen (the preceding PREROLL_MS
+    is passed on with it); the utterance ends after END_SILENCE_MS of silence, at MAX_UTTERANCE_SECONDS,
+    or when the source ends. `reason` tells which, or 'no_speech' if speech never started within
+    NO_SPEECH_TIMEOUT_SECONDS. `silence_ms` is the current trailing silence while speech is running.
+    """
+
+    def __init__(self, vad, frame_ms=FRAME_MS, sample_rate=SAMPLE_RATE, speech_start_ms=SPEECH_START_MS,
+                 end_silence_ms=END_SILENCE_MS, max_utterance_seconds=MAX_UTTERANCE_SECONDS,
+                 no_speech_timeout_seconds=NO_SPEECH_TIMEOUT_SECONDS):
+        self.vad = vad
+        self.frame_ms = frame_ms
+        self.sample_rate = sample_rate
+        self.speech_start_ms = speech_start_ms
+        self.end_silence_ms = end_silence_ms
+        self.max_utterance_ms = max_utterance_seconds * 1000
+        self.no_speech_timeout_ms = no_speech_timeout_seconds * 1000
+        self.started = False
+        self.speech_ms = 0
+        self.silence_ms = 0
+        self.reason = None
+        self.ended_at = None # time.perf_counter() when the utterance ended
+
+    def segment(self, frames):
+        """Yields the frames of one utterance."""
+        preroll = deque(maxlen=max(1, PREROLL_MS // self.frame_ms))
+        voiced_ms = waited_ms = 0
+        self.reason = "source_end"
+        for frame in frames:
+            is_speech = self.vad.is_speech(frame, self.sample_rate)
+            if not self.started:
+                preroll.append(frame)
+                voiced_ms = voiced_ms + self.frame_ms if is_speech else 0
+                waited_ms += self.frame_ms
+                if voiced_ms >= self.speech_start_ms:
+                    self.started = True
+                    self.speech_ms = voiced_ms
+                    yield from preroll
+                elif waited_ms >= self.no_speech_timeout_ms:
+                    self.reason = "no_speech"
+                    break
+                continue
+            yield frame
+            self.speech_ms += self.frame_ms
+            self.silence_ms = 0 if is_speech else self.silence_ms + self.frame_ms
+            if self.silence_ms >= self.end_silence_ms:
+                self.reason = "endpoint"
+                break
+            if self.speech_ms >= self.max_utterance_ms:
+                self.reason = "max_length"
+                break
+        self.ended_at = time.perf_counter()
+
+# --- Streaming Recognition ---
+def _chunked_requests(frames, speech, chunk_ms=STT_CHUNK_MS, frame_ms=FRAME_MS):
+    buffer = bytearray()
+    for frame in frames:
+        buffer += frame
+        if len(buffer) * frame_ms >= chunk_ms * len(frame):
+            yield speech.StreamingRecognizeRequest(audio_content=bytes(buffer))
+            buffer.clear()
+    if buffer:
+        yield speech.StreamingRecognizeRequest(audio_content=bytes(buffer))
+
+def transcribe_utterance(source, on_partial=None, vad=None, language_code=LANGUAGE_CODE, client=None):
+    """Streams one utterance from `source` to Google Cloud streaming recognition.
+
+    Frames go to the API while the user is still talking, so only the tail after the endpoint is
+    waited on. `on_partial(text, settled)` is called for each interim transcript; `settled` is True
+    once the recognizer marks it stable or the speaker has paused for SPECULATE_SILENCE_MS.
+    Returns (transcript or None, stats).
+    """
+    from google.cloud import speech # Imported here so VAD and file replay work without the Speech client installed
+
+    client = client or speech.SpeechClient()
+    endpointer = Endpointer(vad or make_vad(), sample_rate=source.sample_rate)
+    streaming_config = speech.StreamingRecognitionConfig(
+        config=speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=source.sample_rate,
+            language_code=language_code,
+        ),
+        interim_results=True,
+    )
+    finals = []
+    stats = {"partials": 0, "speech_ms": 0, "final_after_endpoint_ms": None, "reason": None}
+    try:
+        requests = _chunked_requests(endpointer.segment(source.frames()), speech)
+        for response in client.streaming_recognize(config=streaming_config, requests=requests):
+            interim = []
+            settled = endpointer.silence_ms >= SPECULATE_SILENCE_MS
+            for result in response.results:
+                if not result.alternatives:
+                    continue
+                if result.is_final:
+                    finals.append(result.alternatives[0].transcript)
+                else:
+                    interim.append(result.alternatives[0].transcript)
+                    settled = settled or result.stability >= STABLE_PARTIAL
+            if interim and on_partial:
+                stats["partials"] += 1
+                on_partial("".join(finals + interim).strip(), settled)
+    finally:
+        source.close()
+    stats.update(speech_ms=endpointer.speech_ms, reason=endpointer.reason)
+    if endpointer.ended_at is not None and endpointer.started:
+        stats["final_after_endpoint_ms"] = round((time.perf_counter() - endpointer.ended_at) * 1000)
+        metrics.observe("stt_seconds", stats["final_after_endpoint_ms"] / 1000)
+    transcript = "".join(finals).strip()
+    return transcript or None, stats
+
+# --- Speculative Start ---
+def _normalize(text):
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+class SpeculativeStart:
+    """Starts `start_fn(text)` in the background for a settled partial transcript.
+
+    When the final transcript matches the speculated one (ignoring case and punctuation), `claim`
+    hands over the already-running result, so the reply starts before recognition has finished.
+    Superseded or unclaimed results are passed to `discard_fn`. At most `max_starts` speculations
+    run per utterance, since each one is a paid model request.
+    """
+
+    def __init__(self, start_fn, discard_fn=None, min_words=2, max_starts=2):
+        self.start_fn = start_fn
+        self.discard_fn = discard_fn
+        self.min_words = min_words
+        self.max_starts = max_starts
+        self.starts = 0
+        self.hit = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_starts, thread_name_prefix="speculate")
+        self._future = None
+        self._key = None
+        self._text = None
+
+    def offer(self, text, settled):
+        key = _normalize(text)
+        if not settled or key == self._key or len(key.split()) < self.min_words or self.starts >= self.max_starts:
+            return
+        self._drop()
+        self._key, self._text = key, text
+        self._future = self._executor.submit(self.start_fn, text)
+        self.starts += 1
+
+    def _drop(self):
+        future, self._future, self._key = self._future, None, None
+        if future and self.discard_fn:
+            future.add_done_callback(lambda done: done.exception() is None and self.discard_fn(done.result()))
+
+    def claim(self, final_text):
+        """Returns (text, result): the speculated text and its result on a match, else (final_text, None)."""
+        try:
+            if final_text and self._future and _normalize(final_text) == self._key:
+                try:
+                    result = self._future.result()
+                    self._future = None
+                    self.hit = True
+                    return self._text, result
+                except Exception as e:
+                    logger.warning(f"Speculative start failed ({e}); starting normally.")
+            self._drop()
+            return final_text, None
+        finally:
+            self._executor.shutdown(wait=False)
+
+# --- Barge-In ---
+class CancelToken:
+    """Cooperative cancellation shared by the stages of one spoken reply.
+
+    Stages poll `cancelled` between steps; `add_callback` registers work that must happen at once
+    (stopping playback), run on the thread that calls `cancel`.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+        self.cancelled_at = None # time.perf_counter() of the first cancel
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"Cancel callback failed: {e}")
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def elapsed_ms(self):
+        """Milliseconds since the cancel, or None if not cancelled."""
+        return None if self.cancelled_at is None else round((time.perf_counter() - self.cancelled_at) * 1000)
+
+class _HandoverSource:
+    """The barge-in microphone stream, replaying the frames that triggered it before continuing live."""
+
+    def __init__(self, sample_rate, buffered, frames, source):
+        self.sample_rate = sample_rate
+        self._buffered = buffered
+        self._frames = frames
+        self._source = source
+
+    def frames(self):
+        yield from self._buffered
+        yield from self._frames
+
+    def close(self):
+        self._frames.close()
+        self._source.close()
+
+class BargeInMonitor:
+    """Listens while the assistant is answering and cancels `token` once the caller starts talking.
+
+    Speech has to last BARGE_IN_SPEECH_MS to count. Without headphones the assistant's own voice can
+    reach the microphone, so the voice assistants only start a monitor with --barge-in. After a
+    barge-in, `stop` returns a source that continues the same microphone stream (including the
+    speech that triggered it), so the interruption can be transcribed without losing its start.
+    """
+
+    def __init__(self, token, vad=None, speech_ms=BARGE_IN_SPEECH_MS, source_factory=MicrophoneSource):
+        self.token = token
+        self.vad = vad or make_vad()
+        self.speech_ms = speech_ms
+        self.triggered = False
+        self._source = source_factory()
+        self._frames = None
+        self._buffered = deque(maxlen=max(1, PREROLL_MS // FRAME_MS) + speech_ms // FRAME_MS)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="barge-in")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        self._frames = self._source.frames()
+        voiced_ms = 0
+        try:
+            for frame in self._frames:
+                if self._stopped.is_set():
+                    break
+                self._buffered.append(frame)
+                voiced_ms = voiced_ms + FRAME_MS if self.vad.is_speech(frame, self._source.sample_rate) else 0
+                if voiced_ms >= self.speech_ms:
+                    self.triggered = True
+                    self.token.cancel("barge_in")
+                    return # Leave the stream open for stop() to hand over
+        except Exception as e:
+            logger.warning(f"Barge-in monitor stopped: {e}")
+        self._frames.close()
+        self._source.close()
+
+    def stop(self):
+        """Stops listening; returns a source continuing the caller's speech after a barge-in, else None."""
+        self._stopped.set()
+        self._thread.join()
+        if not self.triggered:
+            return None
+        return _HandoverSource(self._source.sample_rate, list(self._buffered), self._frames, self._source)
@@ -0,0 +1,195 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", ".tts_cache")
+DEFAULT_MEMORY_BYTES = int(float(os.environ.get("TTS_CACHE_MEMORY_MB", 64)) * 1024 * 1024)
+DEFAULT_DISK_BYTES = int(float(os.environ.get("TTS_CACHE_DISK_MB", 512)) * 1024 * 1024)
+PREWARM_FILE = os.environ.get("TTS_PREWARM_FILE", "tts_phrases.txt") # One phrase per line; '#' starts a comment
+PREWARM_MAX_PHRASES = int(os.environ.get("TTS_PREWARM_MAX_PHRASES", 50)) # Each uncached phrase costs a TTS request
+
+SENTENCE = re.compile(r"[^.?!\n]+[.?!]")
+
+def normalize_speech_text(text):
+    """Unicode-normalizes and collapses whitespace; case and punctuation are kept because they change the audio."""
+    text = unicodedata.normalize("NFKC", text).replace("’", "'").replace("“", '"').replace("”", '"')
+    return " ".join(text.split())
+
+def tts_cache_key(text, voice, audio_config=None):
+    """Content address of one synthesis: sha256 over the normalized text, voice and audio settings."""
+    payload = json.dumps({"text": normalize_speech_text(text), "voice": voice, "config": audio_config or {}}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class TtsCache:
+    """Synthesized audio keyed by tts_cache_key, in two tiers.
+
+    Memory is an LRU bounded by total bytes; disk keeps one file per key under `cache_dir`, evicted
+    least recently used (by mtime) beyond `disk_bytes`, and survives restarts. Disk hits are promoted
+    to memory. Files are written to a temp name and renamed, so concurrent processes sharing the
+    directory never read a partial clip. `disk_bytes=0` keeps the cache in memory only.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_bytes=DEFAULT_MEMORY_BYTES, disk_bytes=DEFAULT_DISK_BYTES):
+        self.cache_dir = cache_dir if disk_bytes else None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> audio bytes, least recently used first
+        self._memory_size = 0
+        self._disk = OrderedDict() # key -> file size, least recently used first
+        self._disk_size = 0
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if self.cache_dir:
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def _scan_disk(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".audio")]
+        except OSError as e:
+            logger.warning(f"TTS cache directory {self.cache_dir} unavailable ({e}); caching in memory only.")
+            self.cache_dir = None
+            return
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            self._disk[entry.name[:-len(".audio")]] = entry.stat().st_size
+            self._disk_size += entry.stat().st_size
+        logger.info(f"TTS cache: {len(self._disk)} clips ({self._disk_size // 1024} KB) on disk in {self.cache_dir}.")
+
+    def _remember(self, key, audio):
+        """Adds to the memory tier; callers hold the lock."""
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = audio
+        self._memory_size += len(audio)
+        while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+            self._memory_size -= len(self._memory.popitem(last=False)[1])
+            self._counters["evictions"] += 1
+
+    def get(self, key):
+        """Audio bytes for the key, or None."""
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return audio
+            on_disk = key in self._disk
+        audio = None
+        if on_disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    audio = f.read()
+                os.utime(self._path(key)) # Keeps disk eviction least recently used across restarts
+            except OSError:
+                pass # Removed by another process; fall through to a miss
+        with self._lock:
+            if audio:
+                self._disk.move_to_end(key)
+                self._remember(key, audio)
+                self._counters["disk_hits"] += 1
+                return audio
+            if on_disk:
+                self._disk_size -= self._disk.pop(key, 0)
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, audio):
+        if not audio:
+            return
+        with self._lock:
+            self._remember(key, audio)
+            self._counters["stores"] += 1
+            if not self.cache_dir or key in self._disk:
+                return
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            logger.warning(f"Could not write TTS cache file: {e}")
+            return
+        with self._lock:
+            self._disk[key] = len(audio)
+            self._disk_size += len(audio)
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def get_or_synthesize(self, text, voice, audio_config, synthesize):
+        """Returns (audio, hit) where hit is True if no synthesis was needed; `synthesize(text)` may return None."""
+        key = tts_cache_key(text, voice, audio_config)
+        audio = self.get(key)
+        if audio is not None:
+            return audio, True
+        audio = synthesize(text)
+        self.put(key, audio)
+        return audio, False
+
+    def prewarm(self, phrases, voice, audio_config, synthesize, max_workers=3):
+        """Makes sure each phrase is cached, synthesizing only those missing from both tiers.
+
+        Blocking; run it in a background thread at startup. Returns the number synthesized.
+        """
+        keys = {tts_cache_key(phrase, voice, audio_config): phrase for phrase in phrases}
+        missing = [(key, phrase) for key, phrase in keys.items() if self.get(key) is None] # Disk hits are loaded into memory
+        if not missing:
+            return 0
+
+        def synthesize_into_cache(item):
+            audio = synthesize(item[1])
+            self.put(item[0], audio)
+            return bool(audio)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-prewarm") as executor:
+            synthesized = sum(executor.map(synthesize_into_cache, missing))
+        logger.info(f"TTS cache pre-warmed {synthesized} of {len(missing)} uncached phrases.")
+        return synthesized
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, memory_clips=len(self._memory), memory_kb=self._memory_size // 1024,
+                         disk_clips=len(self._disk), disk_kb=self._disk_size // 1024)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+        return stats
+
+# --- Pre-warm Phrases ---
+def load_phrases(path=PREWARM_FILE):
+    """Phrases listed one per line in `path` (missing file: none)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    except FileNotFoundError:
+        return []
+
+def kb_phrases(paths, max_phrases=PREWARM_MAX_PHRASES, min_words=3, max_words=25):
+    """Sentences that recur across the knowledge-base documents (boilerplate an answer tends to repeat), most frequent first."""
+    counts = Counter()
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                text = f.read()
+        except OSError:
+            continue
+        for match in SENTENCE.finditer(text):
+            sentence = normalize_speech_text(match.group())
+            if min_words <= len(sentence.split()) <= max_words and "http" not in sentence: # URLs aren't read out verbatim
+                counts[sentence] += 1
+    return [sentence for sentence, count in counts.most_common(max_phrases) if count > 1]
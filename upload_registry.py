@@ -0,0 +1,124 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_PATH = os.environ.get("GENAI_UPLOAD_REGISTRY", ".genai_uploads.json")
+EXPIRY_MARGIN_SECONDS = 600 # Re-upload files that expire within this window rather than risk a mid-session expiry
+
+def file_sha256(file_path):
+    """Returns the hex SHA-256 of a file's contents."""
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _api_key_fingerprint():
+    # Uploaded files belong to the API key's project, so entries are scoped per key
+    api_key = os.environ.get("GEMINI_API_KEY", "")
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:8]
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _parse_time(value):
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+def _is_live(expiration_time):
+    expires = _parse_time(expiration_time)
+    return expires is not None and (expires - _now()).total_seconds() > EXPIRY_MARGIN_SECONDS
+
+class UploadRegistry:
+    """Maps file contents (SHA-256) to GenAI uploads so restarts reuse files that are still live.
+
+    Entries record the uploaded file's name, URI, MIME type and expiry. The registry is persisted as
+    JSON and merged with the on-disk copy on every save, so the CLIs and the worker can share it.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read upload registry {self.path}: {e}. Starting empty.")
+            return {}
+
+    def _save(self):
+        """Merges with the on-disk registry, drops expired entries and writes atomically."""
+        merged = self._load()
+        merged.update(self._entries)
+        merged = {key: entry for key, entry in merged.items() if _is_live(entry.get("expiration_time"))}
+        self._entries = merged
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(merged, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save upload registry {self.path}: {e}")
+
+    def get_or_upload(self, client, file_path):
+        """Returns {"name", "uri", "mime_type", "expiration_time", "reused"} for the file, uploading only if needed.
+
+        A registry hit is confirmed with a cheap files.get call; missing, expired, failed or changed
+        files are uploaded again. Upload errors propagate to the caller.
+        """
+        key = f"{_api_key_fingerprint()}:{file_sha256(file_path)}"
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry and _is_live(entry.get("expiration_time")):
+            try:
+                remote = client.files.get(name=entry["name"])
+                state = getattr(remote.state, "name", remote.state)
+                if state == "ACTIVE" and _is_live(remote.expiration_time):
+                    logger.info(f"Reusing upload {entry['name']} for {file_path} (expires {entry['expiration_time']})")
+                    return dict(entry, reused=True)
+                logger.info(f"Registered upload {entry['name']} is {state}; uploading {file_path} again.")
+            except Exception as e:
+                logger.info(f"Registered upload {entry['name']} is no longer available ({e}); uploading {file_path} again.")
+
+        genai_file = client.files.upload(file=file_path)
+        expiration_time = _parse_time(genai_file.expiration_time) or (_now() + datetime.timedelta(hours=47))
+        entry = {
+            "name": genai_file.name,
+            "uri": genai_file.uri,
+            "mime_type": genai_file.mime_type,
+            "expiration_time": expiration_time.isoformat(),
+            "source_path": file_path,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._save()
+        return dict(entry, reused=False)
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+def get_or_upload(client, file_path):
+    """Module-level convenience wrapper around a shared UploadRegistry instance."""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = UploadRegistry()
+    return _default_registry.get_or_upload(client, file_path)
@@ -1,72 +1,123 @@
-import json
 from dotenv import load_dotenv
 import os
-import io
-import shutil # Added for directory deletion
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google import genai
+from prompt_registry import PromptRegistry, INQUIRY_MARKER_PART
+from model_router import ModelRouter, TIER_CHOICES
+import metrics
+from context_prep import load_drive_file_ids, make_genai_client, upload_context_files
+from drive_sync import sync_drive_files, manifest_local_paths, make_service_factory, MANIFEST_FILENAME
+from history import HistoryManager, DEFAULT_TOKEN_BUDGET
 from google.genai import types
-from googleapiclient.errors import HttpError
 import argparse
 import time
-import pygame
-from pydub import AudioSegment
+import logging
 import httpx
-import sounddevice as sd
-import soundfile as sf
-from google.cloud import speech
 import re # Add import for regex
+import base64
+import queue
+import threading
+import concurrent.futures
+import itertools
+import glob
+from tts_cache import TtsCache, load_phrases, kb_phrases
+from speech_stream import MicrophoneSource, FileReplaySource, SpeculativeStart, CancelToken, BargeInMonitor, transcribe_utterance
 extension = "txt"
 format = "voice" # voice or chat or email
 
 load_dotenv(override=True)
 
-# --- Audio Recording Settings ---
-SAMPLE_RATE = 16000 # Sample rate for recording (Hz) - common for STT
-CHANNELS = 1       # Mono audio
-AUDIO_FILENAME = "temp_input_audio.wav"
+# --- Logging (shared modules report progress through logging) ---
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("google_genai").setLevel(logging.WARNING)
+
+# --- System Prompts ---
+prompt_registry = PromptRegistry() # Loaded (and validated) at startup, reloaded when sys_prompts.json changes
+
+# --- Model Routing ---
+model_router = ModelRouter() # The tier comes from -m on each call; keeps per-tier latency and cost totals
+
+# --- Speech Input Settings ---
+SPECULATE = os.environ.get("DISABLE_SPECULATION", "").lower() not in ("1", "true", "yes") # Start the model on settled partial transcripts
+
+# --- TTS Pipeline Settings ---
+TTS_VOICE = {"languageCode": "en-US", "name": "en-US-Chirp3-HD-Leda"}
+TTS_AUDIO_CONFIG = {"audioEncoding": "LINEAR16", "speakingRate": 1}
+tts_cache = None # TtsCache for repeated sentences (memory + disk), created at startup unless --no-tts-cache
+TTS_MAX_CONCURRENCY = int(os.environ.get("TTS_MAX_CONCURRENCY", 3)) # Sentences synthesized ahead of playback
+tts_http_client = None # Shared keep-alive httpx.Client for TTS requests, created on first use
+tts_http_client_lock = threading.Lock()
+pygame = None # The pygame module once init_audio_output() has started its mixer; None means audio output is disabled
 
 # --- Initialize Pygame Mixer ---
-try:
-    pygame.mixer.init(frequency=24000, size=-16, channels=1)
-    print("Pygame mixer initialized successfully.")
-except pygame.error as e:
-    print(f"Error initializing pygame mixer: {e}. Audio output will be disabled.")
-    pygame = None # Disable pygame if initialization fails
+def init_audio_output():
+    """Imports pygame, starts its mixer and reserves channel 0 for TTS playback.
+
+    Called at startup rather than on import, so --help and other modules importing this one don't
+    load SDL or open the audio device. Returns the channel (None if it could not be reserved).
+    """
+    global pygame
+    try:
+        import pygame as pygame_module
+        pygame_module.mixer.init(frequency=24000, size=-16, channels=1)
+        print("Pygame mixer initialized successfully.")
+    except (ImportError, RuntimeError) as e: # pygame.error is a RuntimeError
+        print(f"Error initializing pygame mixer: {e}. Audio output will be disabled.")
+        return None
+    pygame = pygame_module
+    try:
+        # Allocate a specific channel (e.g., channel 0)
+        tts_channel = pygame.mixer.Channel(0)
+        print("Reserved Pygame mixer channel 0 for TTS playback.")
+        return tts_channel
+    except pygame.error as e:
+        print(f"Error getting pygame channel: {e}. Audio queueing might not work.")
+        # stream_audio falls back to playing without a dedicated channel
+        return None
 
 # --- Text-to-Speech Function ---
+def get_tts_http_client():
+    """Returns the shared TTS client, so sentences reuse warm TLS connections instead of reconnecting."""
+    global tts_http_client
+    with tts_http_client_lock:
+        if tts_http_client is None:
+            tts_http_client = httpx.Client(
+                timeout=20.0,
+                limits=httpx.Limits(max_connections=TTS_MAX_CONCURRENCY, max_keepalive_connections=TTS_MAX_CONCURRENCY),
+            )
+        return tts_http_client
+
 def text_to_speech(text):
+    """Convert text to audio, from the TTS cache when this sentence was spoken before"""
+    if not pygame: # Check if pygame initialization failed
+        print("Warning: Pygame not initialized. Skipping text-to-speech.")
+        return None
+    if tts_cache:
+        audio_data, _ = tts_cache.get_or_synthesize(text, TTS_VOICE["name"], TTS_AUDIO_CONFIG, synthesize_speech)
+        return audio_data
+    return synthesize_speech(text)
+
+def synthesize_speech(text):
     """Convert text to audio using Google TTS service"""
     tts_api_key = os.environ.get("GOOGLE_TTS_API_KEY")
     if not tts_api_key:
         print("Warning: GOOGLE_TTS_API_KEY environment variable not set. Cannot perform text-to-speech.")
         return None
-    if not pygame: # Check if pygame initialization failed
-        print("Warning: Pygame not initialized. Skipping text-to-speech.")
-        return None
 
     try:
-        response = httpx.post(
+        tts_start = time.perf_counter()
+        response = get_tts_http_client().post(
             "https://texttospeech.googleapis.com/v1/text:synthesize",
             headers={"X-Goog-Api-Key": tts_api_key},
             json={
                 "input": {"text": text},
-                "voice": {"languageCode": "en-US", "name": "en-US-Chirp3-HD-Leda"},
-                "audioConfig": {
-                    "audioEncoding": "LINEAR16",
-                    "speakingRate": 1
-                }
+                "voice": TTS_VOICE,
+                "audioConfig": TTS_AUDIO_CONFIG,
             },
-            timeout=20.0
         )
         response.raise_for_status() # Raise an exception for bad status codes
+        metrics.observe("tts_seconds", time.perf_counter() - tts_start, engine="google")
         audio_content_base64 = response.json().get('audioContent')
         if audio_content_base64:
-            import base64
             return base64.b64decode(audio_content_base64)
         else:
             print("Warning: No audio content received from TTS API.")
@@ -78,7 +129,7 @@ def text_to_speech(text):
         print(f"TTS API returned error status: {exc.response.status_code} - {exc.response.text}")
         return None
     except Exception as e:
-        print(f"An unexpected error occurred in text_to_speech: {e}")
+        print(f"An unexpected error occurred in synthesize_speech: {e}")
         return None
 
 # --- Audio Streaming Function ---
@@ -88,6 +139,7 @@ def stream_audio(audio_data, tts_channel):
         return # Don't proceed if no audio data or pygame is disabled
 
     try:
+        from pydub import AudioSegment # Imported on first playback; pydub probes for ffmpeg when loaded
         audio = AudioSegment(
             data=audio_data,
             sample_width=2, # 16 bits = 2 bytes
@@ -116,66 +168,148 @@ def stream_audio(audio_data, tts_channel):
     except Exception as e:
         print(f"Error playing/queueing audio chunk: {e}")
 
-# --- Audio Recording Function ---
-def record_audio(filename=AUDIO_FILENAME, duration=5, samplerate=SAMPLE_RATE, channels=CHANNELS):
-    """Records audio from the microphone for a specified duration."""
-    print(f"Recording for {duration} seconds... Speak now!")
-    try:
-        recording = sd.rec(int(duration * samplerate), samplerate=samplerate, channels=channels, dtype='int16')
-        sd.wait() # Wait until recording is finished
-        sf.write(filename, recording, samplerate)
-        print(f"Recording saved to {filename}")
-        return filename
-    except Exception as e:
-        print(f"Error during audio recording: {e}")
-        return None
-
-# --- Speech-to-Text Function ---
-def speech_to_text(audio_file_path):
-    """Transcribes audio file using Google Cloud Speech-to-Text."""
-    # Requires GOOGLE_APPLICATION_CREDENTIALS environment variable to be set
-    # to the path of your service account key file.
-    try:
-        client = speech.SpeechClient()
-        with io.open(audio_file_path, "rb") as audio_file:
-            content = audio_file.read()
-
-        audio = speech.RecognitionAudio(content=content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=SAMPLE_RATE,
-            language_code="en-US",
-        )
+# --- Speech Pipeline ---
+class SpeechPipeline:
+    """Synthesizes sentences concurrently while playing them back strictly in order.
+
+    `submit` hands a sentence to a pool of TTS_MAX_CONCURRENCY requests and returns immediately, so
+    the model stream is never blocked on synthesis. A playback thread takes the futures in submission
+    order (the reorder buffer) and queues each clip on the TTS channel as soon as the channel's single
+    queue slot frees up. Playback gaps caused by slow synthesis are counted as stalls. `cancel` stops
+    playback and drops everything not yet heard.
+    """
+
+    def __init__(self, tts_channel, max_workers=TTS_MAX_CONCURRENCY):
+        self.tts_channel = tts_channel
+        self.start_time = time.perf_counter()
+        self.first_audio_ms = None
+        self.sentences = 0
+        self.stalls = 0
+        self.cancelled = False
+        self._handed_over = [] # Sentences queued on the channel, in order
+        self._heard = None # Sentences that had started playing when cancel() was called
+        self._lock = threading.Lock() # Orders queueing against cancel()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts")
+        self._pending = queue.Queue() # (future, sentence) in submission order; None ends playback
+        self._player = threading.Thread(target=self._play_in_order, daemon=True)
+        self._player.start()
+
+    def submit(self, sentence):
+        if self.cancelled:
+            return
+        self.sentences += 1
+        self._pending.put((self._executor.submit(text_to_speech, sentence), sentence))
+
+    def _channel_busy(self):
+        return bool(pygame and self.tts_channel and self.tts_channel.get_busy())
+
+    def _play_in_order(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            future, sentence = item
+            if self.first_audio_ms is not None and not future.done() and not self._channel_busy():
+                self.stalls += 1 # Playback ran dry waiting on synthesis
+            try:
+                audio_data = future.result() # text_to_speech reports its own errors and returns None
+            except concurrent.futures.CancelledError:
+                continue
+            if not audio_data:
+                continue
+            # A channel holds one queued sound; wait for the slot rather than replacing the queued clip
+            while pygame and self.tts_channel and self.tts_channel.get_queue() is not None and not self.cancelled:
+                time.sleep(0.01)
+            with self._lock:
+                if self.cancelled:
+                    continue
+                stream_audio(audio_data, self.tts_channel)
+                self._handed_over.append(sentence)
+            if self.first_audio_ms is None:
+                self.first_audio_ms = (time.perf_counter() - self.start_time) * 1000
+
+    def close(self):
+        """Waits until every submitted sentence has been handed to the mixer (playback may continue)."""
+        self._pending.put(None)
+        self._player.join()
+        self._executor.shutdown(wait=False)
+
+    def cancel(self):
+        """Stops playback at once and drops queued and unsynthesized sentences (in-flight requests finish unheard)."""
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            queued = 1 if pygame and self.tts_channel and self.tts_channel.get_queue() is not None else 0
+            self._heard = self._handed_over[:len(self._handed_over) - queued]
+            if pygame and self.tts_channel:
+                self.tts_channel.stop() # Also clears the queued sound
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+        self._pending.put(None)
 
-        print("Transcribing audio...")
-        response = client.recognize(config=config, audio=audio)
+    def is_playing(self):
+        return self._channel_busy()
 
-        if not response.results:
-            print("Transcription failed: No speech detected or recognized.")
-            return None
+    def spoken_text(self):
+        """The sentences the caller heard at least the start of (all of them unless cancelled)."""
+        return " ".join(self._heard if self._heard is not None else self._handed_over)
 
-        transcript = "".join(result.alternatives[0].transcript for result in response.results)
-        print(f"Transcription: {transcript}")
-        return transcript
+# --- Speech-to-Text Function ---
+def listen_for_inquiry(input_audio=None, on_partial=None, source=None):
+    """Streams one spoken inquiry from the microphone (or a WAV file) to Google Cloud Speech-to-Text.
 
+    Recording stops when the speaker pauses. `source` continues an audio stream that is already
+    open (the caller interrupting an answer). Requires GOOGLE_APPLICATION_CREDENTIALS to point to a
+    service account key with the Speech-to-Text API enabled.
+    """
+    try:
+        if source:
+            print("Listening to the interruption...")
+        else:
+            source = FileReplaySource(input_audio) if input_audio else MicrophoneSource()
+            print(f"Replaying {input_audio}..." if input_audio else "Listening... speak now (recording stops when you pause).")
+        transcript, stats = transcribe_utterance(source, on_partial=on_partial)
     except Exception as e:
         print(f"Error during speech-to-text: {e}")
         print("Ensure GOOGLE_APPLICATION_CREDENTIALS is set correctly and Speech-to-Text API is enabled.")
         return None
 
+    if not transcript:
+        print("Transcription failed: No speech detected or recognized." if stats["reason"] != "no_speech" else "No speech detected.")
+        return None
+    print(f"Transcription: {transcript}")
+    print(f"🎙️ Speech: {stats['speech_ms'] / 1000:.1f}s, final transcript {stats['final_after_endpoint_ms']} ms after you stopped ({stats['reason']})")
+    return transcript
+
 # --- Argument Parsing ---
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate a response to a customer inquiry using Google Drive resources and GenAI.")
     parser.add_argument("-i", "--inquiry", help="The customer inquiry text (will prompt if not provided).")
     parser.add_argument("-d", "--download", action="store_true", help="Download files from Google Drive (otherwise use local files).")
-    parser.add_argument("-m", "--model", choices=['flash', 'flash-lite', 'pro'], default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', or 'pro'). Defaults to 'flash'.")
+    parser.add_argument("-m", "--model", choices=TIER_CHOICES, default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', 'pro', or 'auto' to pick the cheapest adequate tier per inquiry). Defaults to 'flash'.")
+    parser.add_argument("--barge-in", action="store_true", help="Stop an answer when the caller talks over it. Use with headphones: on open speakers the assistant hears itself and cuts its own answers short.")
+    parser.add_argument("--no-tts-cache", action="store_true", help="Synthesize every sentence instead of reusing cached audio.")
+    parser.add_argument("--input-audio", help="Replay this 16 kHz mono WAV file instead of recording from the microphone (for testing).")
+    parser.add_argument("--history-budget", type=int, default=DEFAULT_TOKEN_BUDGET, help=f"Token budget for earlier turns before they are summarized (0 keeps the full history). Defaults to {DEFAULT_TOKEN_BUDGET}.")
+    parser.add_argument("--metrics-out", metavar="JSON", help="Write the session's latency histograms and token counters here on exit (default METRICS_JSON; they are always printed).")
     args = parser.parse_args()
     return args
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 
-def get_drive_service():
+def get_drive_credentials():
+    """Loads (or obtains) Drive credentials; each download thread builds its own service from them."""
+    # google-auth is only needed when syncing from Drive, so it is imported here rather than at startup
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
     if os.path.exists("./keys/token.json"):
         creds = Credentials.from_authorized_user_file("./keys/token.json", SCOPES)
@@ -187,66 +321,13 @@ def get_drive_service():
             creds = flow.run_local_server(port=0)
         with open("./keys/token.json", "w") as token:
             token.write(creds.to_json())
-    return build("drive", "v3", credentials=creds)
-
-def download_google_doc(service, file_id, local_filename_base):
-    try:
-        # Get file metadata to check MIME type
-        file_metadata = service.files().get(fileId=file_id, fields='mimeType, name').execute()
-        mime_type = file_metadata.get('mimeType')
-        original_name = file_metadata.get('name')
-        print(f"  File '{original_name}' has MIME type: {mime_type}")
-
-        request = None
-        local_filename = f"{local_filename_base}.{extension}" # Default download extension
-
-        if mime_type == 'application/vnd.google-apps.document':
-            print(f"  Exporting Google Doc '{original_name}' as text/plain...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/plain")
-        elif mime_type == 'text/plain':
-            print(f"  Downloading plain text file '{original_name}' directly...")
-            request = service.files().get_media(fileId=file_id)
-        elif mime_type == 'application/vnd.google-apps.spreadsheet':
-            print(f"  Exporting Google Sheet '{original_name}' as text/csv...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/csv")
-            local_filename = f"{local_filename_base}.csv" # Change extension for CSV
-        else:
-            print(f"  WARNING: Skipping file '{original_name}' (ID: {file_id}). Unsupported MIME type for conversion: {mime_type}")
-            return None
-
-        # Proceed with download if request is valid
-        if request:
-            fh = io.FileIO(local_filename, "wb")
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if status:
-                    print(f"  Download {int(status.progress() * 100)}%.")
-            fh.close()
-            return local_filename
-        else:
-             # Should not happen if logic above is correct, but included for safety
-             print(f"  ERROR: Could not create download request for file '{original_name}' (ID: {file_id})")
-             return None
-
-    except HttpError as error:
-        print(f"  An error occurred downloading file ID {file_id}: {error}")
-        return None
+    return creds
 
 def prepare_context_files(download_flag):
     """Handles local file check or Drive download, and uploads files to GenAI API once."""
     print("--- Preparing Context Files ---")
     # --- Load File IDs from Environment Variables ---
-    file_ids = {}
-    prefix = "GDRIVE_"
-    for key, value in os.environ.items():
-        if key.startswith(prefix):
-            # Convert GDRIVE_FILE_ID_SOME_NAME to "Some Name"
-            name_parts = key[len(prefix):].split('_')
-            name = ' '.join(part.capitalize() for part in name_parts)
-            # Specific adjustments removed
-            file_ids[name] = value
+    file_ids = load_drive_file_ids() # GDRIVE_SOME_NAME=<id> -> "Some Name"
 
     if not file_ids:
         print("ERROR: No Google Drive file IDs found in environment variables (expected format: GDRIVE_SOME_NAME=...).")
@@ -269,7 +350,7 @@ def prepare_context_files(download_flag):
     dir_is_empty = True
     if dir_exists:
         try:
-            if not os.listdir(download_dir):
+            if not [f for f in os.listdir(download_dir) if f != MANIFEST_FILENAME]:
                 dir_is_empty = True
             else:
                 dir_is_empty = False
@@ -292,23 +373,6 @@ def prepare_context_files(download_flag):
         download_flag = True
         print("Forcing download due to missing or empty directory.")
 
-    # --- Clean directory ONLY if download flag is explicitly set at the start ---
-    # Note: We use the original download_flag from args here, not the potentially modified one
-    original_download_flag = args.download # Assuming args is accessible or passed appropriately
-                                          # If not accessible, need to refactor to pass original flag
-    if original_download_flag: # Check the *original* intent from the command line
-        print(f"Download flag is set. Attempting to clean directory: {download_dir}")
-        if dir_exists:
-            try:
-                shutil.rmtree(download_dir)
-                print(f"Successfully deleted existing directory: {download_dir}")
-                dir_exists = False # Update status
-                dir_is_empty = True
-            except OSError as e:
-                print(f"Warning: Error deleting directory {download_dir}: {e}. Proceeding may result in outdated files.")
-        else:
-            print(f"Directory {download_dir} did not exist, no deletion needed.")
-
     # --- Ensure download directory exists before proceeding ---
     if not dir_exists:
         try:
@@ -318,33 +382,29 @@ def prepare_context_files(download_flag):
             print(f"ERROR: Error creating directory {download_dir}: {e}. Cannot proceed.")
             return None, None # Cannot proceed if directory creation fails
 
-    # --- Download or Use Local Files based on initial check/flag ---
+    # --- Sync or Use Local Files based on initial check/flag ---
     if should_download: # Use the calculated flag
-        print("--- Downloading Files from Google Drive ---")
-        drive_service = get_drive_service()
-        if not drive_service:
-            print("ERROR: Failed to get Google Drive service. Cannot download files.")
-            return None, None # Cannot proceed without Drive service
-        for name, file_id in file_ids.items():
-            # Use expected_local_files to determine the base path before extension
-            local_filename_base = os.path.splitext(expected_local_files[name])[0]
-            # local_filename_base = os.path.join(download_dir, name) # Old way
-            print(f"Processing '{name}' from Google Drive (ID: {file_id})...")
-            downloaded_path = download_google_doc(drive_service, file_id, local_filename_base)
-            if downloaded_path:
-                processed_files_paths[name] = downloaded_path
-                # print(f"Finished processing '{name}'. Saved to {downloaded_path}")
-            else:
-                print(f"Skipped file '{name}' due to download/conversion issue.")
+        # Only files whose Drive version changed since the last sync are downloaded; each file is
+        # written to a temp file and renamed into place, so a failed refresh keeps the old copies.
+        print("--- Syncing Files from Google Drive ---")
+        drive_creds = get_drive_credentials()
+        if not drive_creds:
+            print("ERROR: Failed to get Google Drive credentials. Cannot download files.")
+            return None, None # Cannot proceed without Drive access
+        local_filename_bases = {name: os.path.splitext(path)[0] for name, path in expected_local_files.items()}
+        # Files are fetched concurrently (DRIVE_MAX_WORKERS threads), retrying 429/5xx with backoff
+        processed_files_paths = sync_drive_files(make_service_factory(drive_creds), file_ids, download_dir, local_filename_bases, text_extension=extension)
     else:
         # This block now only runs if original download_flag was False AND dir existed AND dir was not empty
         print("--- Skipping Google Drive Download - Using Existing Local Files ---")
+        synced_paths = manifest_local_paths(download_dir, file_ids)
         for name, expected_path in expected_local_files.items():
-            if os.path.exists(expected_path):
-                print(f"Found local file: {expected_path}")
-                processed_files_paths[name] = expected_path
+            local_path = synced_paths.get(name, expected_path)
+            if os.path.exists(local_path):
+                print(f"Found local file: {local_path}")
+                processed_files_paths[name] = local_path
             else:
-                print(f"Local file not found: {expected_path}. It will not be used.")
+                print(f"Local file not found: {local_path}. It will not be used.")
 
     # --- Proceed with GenAI Client Init and Upload ---
     if not processed_files_paths:
@@ -354,52 +414,18 @@ def prepare_context_files(download_flag):
     # --- Initialize GenAI Client ---
     print("--- Initializing GenAI Client --- ")
     try:
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
+        client = make_genai_client()
     except Exception as e:
         print(f"Failed to initialize GenAI client: {e}")
         return None, None
 
-    # --- Upload Files to GenAI API Sequentially ---
-    print("--- Uploading Files Sequentially to GenAI API --- ")
-    genai_file_parts = []
-
-    def upload_single_file(name, file_path):
-        try:
-            print(f"✅ Uploading {file_path} ({name}) to GenAI API...")
-            # Determine MIME type based on file extension
-            if file_path.lower().endswith(f'.{extension}'):
-                mime_type = 'text/plain'
-            elif file_path.lower().endswith('.csv'):
-                mime_type = 'text/csv'
-            else:
-                # Fallback or raise an error if other types are possible and need specific handling
-                mime_type = None # Let the library try to guess, or handle error
-                print(f"Warning: Could not determine MIME type for {file_path}, attempting upload without it.")
-
-            genai_file = client.files.upload(file=file_path)
-            # print(f"Successfully uploaded {name} ({genai_file.name})")
-            return types.Part.from_uri(file_uri=genai_file.uri, mime_type=mime_type)
-        except Exception as e:
-             print(f"Failed to upload {file_path} ({name}) to GenAI: {e}")
-             return None # Return None on failure
-
-    # Upload text files first (exported Google Docs)
-    print("Uploading text files...")
-    for name, file_path in processed_files_paths.items():
-        if file_path.lower().endswith(f'.{extension}'):
-            result = upload_single_file(name, file_path)
-            if result:
-                genai_file_parts.append(result)
-
-    # Upload CSV files next (exported Google Sheets)
-    # print("Uploading CSV files...")
-    # for name, file_path in processed_files_paths.items():
-    #     if file_path.lower().endswith('.csv'):
-    #         result = upload_single_file(name, file_path)
-    #         if result:
-    #             genai_file_parts.append(result)
+    # --- Upload Files to GenAI API Concurrently ---
+    # Documents come before CSV sheets in a fixed order, however the uploads finish
+    print("--- Uploading Files to GenAI API --- ")
+    genai_file_parts, upload_timings = upload_context_files(client, processed_files_paths)
+    for timing in upload_timings:
+        icon = "❌" if timing["status"] == "failed" else "✅"
+        print(f"{icon} {timing['name']} ({timing['path']}): {timing['status']} in {timing['seconds']:.2f}s")
 
     if not genai_file_parts:
         print("No files were successfully uploaded to GenAI. Aborting.")
@@ -410,71 +436,89 @@ def prepare_context_files(download_flag):
     return client, genai_file_parts
 
 
-def generate_response(client, file_parts, inquiry_text, model_name, conversation_history, tts_channel):
-    """Generates a response, maintaining conversation history."""
+def build_generation_request(file_parts, inquiry_text, model_name, conversation_history):
+    """Returns (model_str, user_content, config) for the next turn without modifying the history."""
+    # Tier from -m, or picked per inquiry with -m auto (model versions live in model_router.py)
+    model_str = model_router.choose(inquiry_text, len(conversation_history) // 2, mode=model_name)["model"]
+
+    # Construct initial prompt or use history
+    if not conversation_history:
+        try:
+            system_instructions = prompt_registry.text("voice" if format == "voice" else "chat")
+        except (OSError, ValueError) as e:
+            print(f"Error: could not load system prompts: {e}. Exiting.")
+            exit()
+        # Prompt + documents prefix is prebuilt once per prompt version; only the inquiry is new
+        initial_user_parts = prompt_registry.prefix_parts(system_instructions, file_parts)
+        initial_user_parts += [INQUIRY_MARKER_PART, types.Part.from_text(text=inquiry_text)]
+        user_content = types.Content(role="user", parts=initial_user_parts)
+    else:
+        user_content = types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)])
+
+    generate_content_config = types.GenerateContentConfig(
+        temperature=1,
+        response_mime_type="text/plain",
+    )
+    return model_str, user_content, generate_content_config
+
+def start_model_stream(client, file_parts, inquiry_text, model_name, conversation_history):
+    """Sends the request for a (speculative) inquiry and waits for the first chunk; returns (first_chunk, stream)."""
+    model_str, user_content, config = build_generation_request(file_parts, inquiry_text, model_name, conversation_history)
+    stream = client.models.generate_content_stream(model=model_str, contents=conversation_history + [user_content], config=config)
+    return next(stream, None), stream
+
+def close_model_stream(started):
+    """Abandons a speculative stream that was not used."""
+    started[1].close()
+
+def generate_response(client, file_parts, inquiry_text, model_name, conversation_history, tts_channel, prefetched=None, cancel_token=None):
+    """Generates a response, maintaining conversation history.
+
+    `prefetched` is a (first_chunk, stream) pair from start_model_stream for this exact inquiry,
+    started speculatively while the user was still speaking. When `cancel_token` is given, the call
+    also waits for playback to finish, and a cancel (barge-in) stops playback, drops pending TTS and
+    closes the model stream; only the sentences the caller heard are kept in the history.
+    """
     print("\n📤 Inquiry\n")
     print(inquiry_text + "\n")
 
     last_usage_metadata = None
     response_text = ""
     text_buffer = "" # Buffer for incoming text
-    # Removed tts_buffer and sentence counter
+    speech = None # SpeechPipeline for this response
 
     if not client:
         print("GenAI client is not available.")
         return None, conversation_history
 
     try:
-        # Select model
-        if model_name == 'flash':
-            model_str = "models/gemini-1.5-flash-latest"
-        elif model_name == 'flash-lite':
-            model_str = "models/gemini-1.5-flash-latest" # Or a specific lite model if available
-        elif model_name == 'pro':
-             model_str = "models/gemini-1.5-pro-latest"
+        start_time = time.perf_counter()
+        model_str, user_content, generate_content_config = build_generation_request(file_parts, inquiry_text, model_name, conversation_history)
+        conversation_history.append(user_content)
+        contents = conversation_history
+
+        # Sentences are synthesized concurrently and played in order while the model keeps streaming
+        speech = SpeechPipeline(tts_channel)
+        if prefetched:
+            first_chunk, model_stream = prefetched
+            stream = itertools.chain([first_chunk] if first_chunk else [], model_stream)
         else:
-            model_str = "models/gemini-1.5-pro-latest"
-            print(f"Warning: Invalid model '{model_name}' specified. Defaulting to {model_str}")
-
-        # Construct initial prompt or use history
-        if not conversation_history:
-            try:
-                with open("sys_prompts.json", "r") as f:
-                    sys_prompts = json.load(f)
-            except FileNotFoundError:
-                print("Error: sys_prompts.json not found. Exiting.")
-                exit()
-            if format == "chat":
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_chat"])]
-            elif format == "voice":
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_voice"])]
-            else:
-                initial_user_parts = [types.Part.from_text(text=sys_prompts["system_instruction_chat"])]
-             
-            if file_parts:
-                 initial_user_parts.extend(file_parts)
-            initial_user_parts.append(types.Part.from_text(text="--- User Inquiry ---"))
-            initial_user_parts.append(types.Part.from_text(text=inquiry_text))
-            conversation_history.append(types.Content(role="user", parts=initial_user_parts))
-            contents = conversation_history
-        else:
-            conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)]))
-            contents = conversation_history
-
-        generate_content_config = types.GenerateContentConfig(
-            temperature=1,
-            response_mime_type="text/plain",
-        )
-
-        stream = client.models.generate_content_stream(
-            model=model_str,
-            contents=contents,
-            config=generate_content_config,
-        )
+            stream = model_stream = client.models.generate_content_stream(
+                model=model_str,
+                contents=contents,
+                config=generate_content_config,
+            )
+        if cancel_token:
+            playback_stopped_ms = []
+            cancel_token.add_callback(lambda: (speech.cancel(), playback_stopped_ms.append(cancel_token.elapsed_ms())))
 
         print("\n🔊 Assistant:", end=" ")
         for chunk in stream:
+            if cancel_token and cancel_token.cancelled:
+                break
             if chunk.text:
+                if not response_text:
+                    metrics.observe("time_to_first_token_seconds", time.perf_counter() - start_time, model=model_str)
                 print(chunk.text, end="", flush=True)
                 response_text += chunk.text
                 text_buffer += chunk.text
@@ -489,10 +533,7 @@ def generate_response(client, file_parts, inquiry_text, model_name, conversation
                         
                         # Heuristic check (e.g., > 15 chars or contains punctuation)
                         if len(segment_to_process) > 15 or re.search(r"[.?!]", segment_to_process):
-                            audio_data = text_to_speech(segment_to_process.strip())
-                            if audio_data:
-                                stream_audio(audio_data, tts_channel) # Pass channel
-                            
+                            speech.submit(segment_to_process.strip())
                             text_buffer = text_buffer[current_end_pos:]
                             search_start = 0
                         else:
@@ -506,34 +547,68 @@ def generate_response(client, file_parts, inquiry_text, model_name, conversation
 
         # Process any final fragment left in the buffer
         if text_buffer.strip():
-            audio_data = text_to_speech(text_buffer.strip())
-            if audio_data:
-                stream_audio(audio_data, tts_channel) # Pass channel
+            speech.submit(text_buffer.strip())
         print() # Newline after response
+        model_router.record(model_str, (time.perf_counter() - start_time) * 1000, last_usage_metadata)
+
+        if cancel_token:
+            speech.close()
+            while speech.is_playing() and not cancel_token.cancelled: # Caller can still interrupt the tail
+                time.sleep(0.02)
+        if cancel_token and cancel_token.cancelled:
+            model_stream.close() # Stops generation (and token spend) if it was still running
+            print(f"\n✋ Interrupted: playback stopped {playback_stopped_ms[0]} ms and model stream closed {cancel_token.elapsed_ms()} ms after the caller spoke")
+            spoken_text = speech.spoken_text()
+            response_text = f"{spoken_text} [interrupted by the caller]".strip()
 
         if response_text:
             conversation_history.append(types.Content(role="model", parts=[types.Part.from_text(text=response_text)]))
 
     except Exception as e:
         print(f"\nAn error occurred during generation: {e}")
+    finally:
+        if speech:
+            speech.close()
+            if speech.first_audio_ms is not None:
+                print(f"🔈 Time to first audio: {speech.first_audio_ms:.0f} ms ({speech.sentences} sentences, {speech.stalls} playback stalls)")
 
     return last_usage_metadata, conversation_history
 
+def capture_spoken_inquiry(client, file_parts, model_name, conversation_history, input_audio=None, source=None):
+    """Listens for one spoken inquiry, starting the model early on a settled partial; returns (inquiry, prefetched)."""
+    speculation = SpeculativeStart(
+        lambda text: start_model_stream(client, file_parts, text, model_name, conversation_history),
+        discard_fn=close_model_stream,
+    ) if SPECULATE else None
+    inquiry_text = listen_for_inquiry(input_audio, on_partial=speculation.offer if speculation else None, source=source)
+    if not speculation:
+        return inquiry_text, None
+    inquiry_text, prefetched = speculation.claim(inquiry_text)
+    if speculation.starts:
+        print(f"⚡ Speculative start: {'used' if prefetched else 'discarded'} ({speculation.starts} started)")
+    return inquiry_text, prefetched
+
+def start_barge_in_monitor(cancel_token):
+    """Listens for the caller talking over the next answer; None if no microphone is available."""
+    try:
+        return BargeInMonitor(cancel_token).start()
+    except Exception as e:
+        print(f"Barge-in disabled (microphone unavailable: {e}).")
+        return None
+
 if __name__ == "__main__":
     args = parse_arguments()
     model_name = args.model
 
+    # Fail fast on a missing or malformed prompt file rather than on the first inquiry
+    try:
+        prompt_registry.load()
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load system prompts: {e}. Exiting.")
+        exit()
+
     # Initialize Pygame and reserve a channel for TTS playback
-    tts_channel = None
-    if pygame: # Check if pygame was initialized successfully
-        try:
-            # Allocate a specific channel (e.g., channel 0)
-            tts_channel = pygame.mixer.Channel(0) 
-            print("Reserved Pygame mixer channel 0 for TTS playback.")
-        except pygame.error as e:
-            print(f"Error getting pygame channel: {e}. Audio queueing might not work.")
-            # Continue without a dedicated channel? Or handle differently?
-            # For now, stream_audio will need to handle tts_channel being None
+    tts_channel = init_audio_output()
 
     # Prepare files and client ONCE
     genai_client, prepared_file_parts = prepare_context_files(args.download)
@@ -542,31 +617,36 @@ if __name__ == "__main__":
         print("Exiting due to issue with GenAI client initialization.")
         exit()
 
-    # Initialize conversation history
+    # Cache synthesized sentences and pre-warm common phrases in the background
+    if not args.no_tts_cache:
+        tts_cache = TtsCache()
+        phrases = load_phrases() + kb_phrases(glob.glob(os.path.join("drive", f"*.{extension}")))
+        threading.Thread(target=tts_cache.prewarm, args=(phrases, TTS_VOICE["name"], TTS_AUDIO_CONFIG, synthesize_speech), daemon=True).start()
+
+    # Initialize conversation history (older turns are summarized once over the token budget)
     conversation_history = []
+    history_manager = HistoryManager(genai_client, budget_tokens=args.history_budget)
 
     # Main inquiry loop
+    interruption = None # Microphone stream of a caller who talked over the last answer
     while True:
+        # Trim first, so a speculative start sees the same history as the real request
+        conversation_history, history_stats = history_manager.trim(conversation_history)
+        prefetched = None # Model stream started from a partial transcript, if it matched the final one
         inquiry_to_use = args.inquiry # Get inquiry from args for the *first* iteration
         if inquiry_to_use:
             args.inquiry = None # Clear it so we prompt next time
+        elif interruption: # Transcribe the interruption straight away instead of prompting
+            inquiry_to_use, prefetched = capture_spoken_inquiry(genai_client, prepared_file_parts, args.model, conversation_history, source=interruption)
+            interruption = None
         else:
             try:
                 user_input = input("\nEnter text prompt, press Enter to record audio, or 'q' to quit: ")
                 if user_input.lower() == 'q':
                     print("Exiting.")
                     break
-                elif not user_input: # User pressed Enter, initiate recording
-                    audio_path = record_audio() # Record for default duration
-                    if audio_path:
-                        inquiry_to_use = speech_to_text(audio_path)
-                        # Clean up the temporary audio file
-                        try:
-                            os.remove(audio_path)
-                        except OSError as e:
-                            print(f"Warning: Could not remove temp audio file {audio_path}: {e}")
-                    else:
-                        inquiry_to_use = None # Recording failed
+                elif not user_input: # User pressed Enter, stream from the microphone until they pause
+                    inquiry_to_use, prefetched = capture_spoken_inquiry(genai_client, prepared_file_parts, args.model, conversation_history, args.input_audio)
                 else:
                     inquiry_to_use = user_input # Use text input
 
@@ -580,24 +660,41 @@ if __name__ == "__main__":
 
         # Process this single inquiry, passing and updating history
         start_time = time.time()
+        cancel_token = CancelToken()
+        barge_in = start_barge_in_monitor(cancel_token) if args.barge_in and not args.input_audio else None
+        args.barge_in = args.barge_in and (barge_in is not None or bool(args.input_audio)) # Don't retry without a microphone
         final_usage_metadata, conversation_history = generate_response(
             genai_client,
             prepared_file_parts,
             inquiry_to_use,
             args.model,
             conversation_history, # Pass current history
-            tts_channel # Pass the reserved channel
+            tts_channel, # Pass the reserved channel
+            prefetched=prefetched,
+            cancel_token=cancel_token if barge_in else None,
         )
+        if barge_in:
+            interruption = barge_in.stop()
         end_time = time.time()
         duration = end_time - start_time
 
         # Print summary for this inquiry
         print(f"\n\n=== Summary ===")
         print(f"Time taken: {duration:.2f} seconds")
+        if history_stats["summarized_turns"]:
+            print(f"History Tokens (est.): {history_stats['before_tokens']} -> {history_stats['after_tokens']} ({history_stats['summarized_turns']} earlier turns summarized)")
+        else:
+            print(f"History Tokens (est.): {history_stats['before_tokens']}")
         if final_usage_metadata:
             print(f"Input Tokens: {final_usage_metadata.prompt_token_count}")
             print(f"Output Tokens: {final_usage_metadata.candidates_token_count}")
             print(f"Total Tokens: {final_usage_metadata.total_token_count}")
         else:
             print("Token usage metadata not available for this inquiry.")
+        if tts_cache:
+            print(f"TTS Cache: {tts_cache.stats()}")
+        if model_name == "auto":
+            print(f"Model Routing: {model_router.stats()}")
         print("=======================")
+
+    metrics.report_session("voice_goog", args.metrics_out)
@@ -1,156 +1,190 @@
-import json
 from dotenv import load_dotenv
 import os
-import io
-import shutil # Added for directory deletion
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google import genai
+from prompt_registry import PromptRegistry, INQUIRY_MARKER_PART
+from model_router import ModelRouter, TIER_CHOICES
+import metrics
+from context_prep import load_drive_file_ids, make_genai_client, upload_context_files
+from audio_sink import make_sink
+from speech_stream import MicrophoneSource, FileReplaySource, SpeculativeStart, CancelToken, BargeInMonitor, transcribe_utterance
+from drive_sync import sync_drive_files, manifest_local_paths, make_service_factory, MANIFEST_FILENAME
+from history import HistoryManager, DEFAULT_TOKEN_BUDGET
 from google.genai import types
-from googleapiclient.errors import HttpError
 import argparse
 import time
+import logging
 import asyncio
-import edge_tts
-import tempfile
-import sounddevice as sd
-import soundfile as sf
-from google.cloud import speech
+import re
+import itertools
+import glob
+import threading
+from tts_cache import TtsCache, tts_cache_key, load_phrases, kb_phrases
 extension = "txt"
 format = "voice" # voice or chat or email
 
 load_dotenv(override=True)
 
-# --- Audio Recording Settings ---
-SAMPLE_RATE = 16000 # Sample rate for recording (Hz) - common for STT
-CHANNELS = 1       # Mono audio
-AUDIO_FILENAME = "temp_input_audio.wav"
+# --- Logging (shared modules report progress through logging) ---
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("google_genai").setLevel(logging.WARNING)
+
+# --- System Prompts ---
+prompt_registry = PromptRegistry() # Loaded (and validated) at startup, reloaded when sys_prompts.json changes
+
+# --- Model Routing ---
+model_router = ModelRouter() # The tier comes from -m on each call; keeps per-tier latency and cost totals
+
+# --- Speech Input Settings ---
+SPECULATE = os.environ.get("DISABLE_SPECULATION", "").lower() not in ("1", "true", "yes") # Start the model on settled partial transcripts
 
 # --- Edge TTS Settings ---
 VOICE = "en-US-AvaNeural" # Example voice
-SENTENCES_PER_CHUNK = 4 # Target sentences per playback chunk
+TTS_AUDIO_CONFIG = {"format": "audio-24khz-48kbitrate-mono-mp3", "rate": "+0%"} # edge-tts defaults; part of the cache key
+tts_cache = None # TtsCache for repeated sentence groups (memory + disk), created at startup unless --no-tts-cache
+FIRST_CHUNK_SENTENCES = 1 # Speak the first sentence on its own so audio starts quickly
+SENTENCES_PER_CHUNK = 2 # Sentences per later synthesis request
+TTS_LOOKAHEAD_CHUNKS = int(os.environ.get("TTS_LOOKAHEAD_CHUNKS", 2)) # Sentence groups queued ahead of the speaker
+TTS_MAX_BUFFERED_SECONDS = float(os.environ.get("TTS_MAX_BUFFERED_SECONDS", 6)) # Synthesis pauses while this much audio is unplayed
 # --- Sentence End Detection ---
-SENTENCE_ENDS = {'.', '?', '!'}
-
-# --- afplay Audio Playback Function (Async) ---
-async def play_audio_chunk_async(audio_data):
-    if not audio_data:
-        print("Warning: No audio data received to play.")
-        return
-    temp_file_path = None
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_audio_file:
-            temp_audio_file.write(audio_data)
-            temp_file_path = temp_audio_file.name
-        process = await asyncio.create_subprocess_exec(
-            "afplay",
-            temp_file_path,
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            error_message = stderr.decode().strip() if stderr else 'Unknown error'
-            print(f"\n[afplay error: {error_message}]")
-    except Exception as e:
-        print(f"\n[Error during audio playback: {e}]")
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-            except OSError as e:
-                print(f"\n[Warning: Could not remove temp file {temp_file_path}: {e}]")
-
-# --- Edge TTS Streaming Function (Async) ---
-async def synthesize_text_async(text, voice=VOICE):
-    """Synthesizes the given text using edge-tts and *returns* the audio data bytes."""
-    if not text:
-        print("No text provided for TTS synthesis.")
-        return None # Return None if no text
-    print(f"\n[Synthesizing TTS for text starting with: '{text[:50]}...']")
-    audio_buffer = bytearray()
+SENTENCE_END = re.compile(r"[.?!]+(?=\s)") # Terminal punctuation followed by whitespace (so "3.5" is not split)
+
+# --- Audio Playback (in-memory MP3 decoding into one output stream) ---
+audio_sink = None # AudioSink chosen by AUDIO_SINK (stream, null or file:<path>), created on first use
+
+def get_audio_sink():
+    global audio_sink
+    if audio_sink is None:
+        audio_sink = make_sink()
+    return audio_sink
+
+# --- Edge TTS Streaming Functions (Async) ---
+async def stream_speech_async(text, sink, voice=VOICE, timing=None):
+    """Synthesizes text with edge-tts, feeding each audio chunk to the sink as soon as it is yielded.
+
+    Text spoken before is played straight from the TTS cache; complete syntheses are added to it.
+    Records the time of the first audio chunk in timing["first_audio"] if a dict is given.
+    Returns the number of MP3 bytes streamed.
+    """
+    streamed = 0
+    key = tts_cache_key(text, voice, TTS_AUDIO_CONFIG)
     try:
+        cached = tts_cache.get(key) if tts_cache else None
+        if cached:
+            sink.feed_mp3(cached)
+            if timing is not None and "first_audio" not in timing:
+                timing["first_audio"] = time.perf_counter()
+            return len(cached)
+        import edge_tts # Imported on first synthesis, keeping it out of startup
+        tts_start = time.perf_counter()
+        audio = bytearray()
         communicate = edge_tts.Communicate(text, voice)
         async for chunk in communicate.stream():
             if chunk["type"] == "audio":
-                audio_buffer.extend(chunk["data"])
-
-        if not audio_buffer:
-            print(f"\n[Warning: No audio generated during synthesis for text '{text[:50]}...']")
-            return None
-
-        print(f"\n[Finished TTS for '{text[:50]}...']")
-        return bytes(audio_buffer) # Return the synthesized bytes
-
+                sink.feed_mp3(chunk["data"])
+                streamed += len(chunk["data"])
+                audio.extend(chunk["data"])
+                if timing is not None and "first_audio" not in timing:
+                    timing["first_audio"] = time.perf_counter()
+        metrics.observe("tts_seconds", time.perf_counter() - tts_start, engine="edge")
+        if tts_cache:
+            tts_cache.put(key, bytes(audio)) # Only reached when the synthesis completed
     except Exception as e:
         print(f"\n[Error during TTS synthesis for text '{text[:50]}...': {e}]")
-        return None # Return None on error
-
-    # Removed playback call
+    finally:
+        sink.end_utterance()
+    return streamed
 
-# --- Audio Recording Function ---
-def record_audio(filename=AUDIO_FILENAME, duration=5, samplerate=SAMPLE_RATE, channels=CHANNELS):
-    """Records audio from the microphone for a specified duration."""
-    print(f"Recording for {duration} seconds... Speak now!")
+async def synthesize_speech_async(text, voice=VOICE):
+    """Synthesizes text with edge-tts and returns the whole MP3, or None on failure."""
+    audio = bytearray()
     try:
-        recording = sd.rec(int(duration * samplerate), samplerate=samplerate, channels=channels, dtype='int16')
-        sd.wait() # Wait until recording is finished
-        sf.write(filename, recording, samplerate)
-        print(f"Recording saved to {filename}")
-        return filename
+        import edge_tts
+        tts_start = time.perf_counter()
+        async for chunk in edge_tts.Communicate(text, voice).stream():
+            if chunk["type"] == "audio":
+                audio.extend(chunk["data"])
+        metrics.observe("tts_seconds", time.perf_counter() - tts_start, engine="edge")
     except Exception as e:
-        print(f"Error during audio recording: {e}")
+        print(f"\n[Error during TTS synthesis for text '{text[:50]}...': {e}]")
         return None
+    return bytes(audio) or None
 
-# --- Speech-to-Text Function ---
-def speech_to_text(audio_file_path):
-    """Transcribes audio file using Google Cloud Speech-to-Text."""
-    # Requires GOOGLE_APPLICATION_CREDENTIALS environment variable to be set
-    # to the path of your service account key file.
-    try:
-        client = speech.SpeechClient()
-        with io.open(audio_file_path, "rb") as audio_file:
-            content = audio_file.read()
-
-        audio = speech.RecognitionAudio(content=content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=SAMPLE_RATE,
-            language_code="en-US",
-        )
+def synthesize_speech(text):
+    """Blocking wrapper around synthesize_speech_async, for pre-warming the TTS cache from a thread."""
+    return asyncio.run(synthesize_speech_async(text))
 
-        print("Transcribing audio...")
-        response = client.recognize(config=config, audio=audio)
+async def speak_chunks_async(text_queue, sink, timing, spoken_groups):
+    """Speaks queued sentence groups in order until a None arrives, appending each to spoken_groups as it starts.
 
-        if not response.results:
-            print("Transcription failed: No speech detected or recognized.")
-            return None
+    Synthesis of the next group waits while more than TTS_MAX_BUFFERED_SECONDS of audio is still
+    unplayed, so it never runs far ahead of playback.
+    """
+    while True:
+        text = await text_queue.get()
+        if text is None:
+            return
+        while sink.buffered_ms() > TTS_MAX_BUFFERED_SECONDS * 1000:
+            await asyncio.sleep(0.05)
+        spoken_groups.append(text)
+        await stream_speech_async(text, sink, timing=timing)
+
+def take_sentence_group(text, group_size):
+    """Returns (group, rest) once `text` holds `group_size` complete sentences, otherwise (None, text)."""
+    ends = [match.end() for match in SENTENCE_END.finditer(text)]
+    if len(ends) < group_size:
+        return None, text
+    return text[:ends[group_size - 1]].strip(), text[ends[group_size - 1]:]
 
-        transcript = "".join(result.alternatives[0].transcript for result in response.results)
-        print(f"Transcription: {transcript}")
-        return transcript
+# --- Speech-to-Text Function ---
+def listen_for_inquiry(input_audio=None, on_partial=None, source=None):
+    """Streams one spoken inquiry from the microphone (or a WAV file) to Google Cloud Speech-to-Text.
 
+    Recording stops when the speaker pauses. `source` continues an audio stream that is already
+    open (the caller interrupting an answer). Requires GOOGLE_APPLICATION_CREDENTIALS to point to a
+    service account key with the Speech-to-Text API enabled.
+    """
+    try:
+        if source:
+            print("Listening to the interruption...")
+        else:
+            source = FileReplaySource(input_audio) if input_audio else MicrophoneSource()
+            print(f"Replaying {input_audio}..." if input_audio else "Listening... speak now (recording stops when you pause).")
+        transcript, stats = transcribe_utterance(source, on_partial=on_partial)
     except Exception as e:
         print(f"Error during speech-to-text: {e}")
         print("Ensure GOOGLE_APPLICATION_CREDENTIALS is set correctly and Speech-to-Text API is enabled.")
         return None
 
+    if not transcript:
+        print("Transcription failed: No speech detected or recognized." if stats["reason"] != "no_speech" else "No speech detected.")
+        return None
+    print(f"Transcription: {transcript}")
+    print(f"🎙️ Speech: {stats['speech_ms'] / 1000:.1f}s, final transcript {stats['final_after_endpoint_ms']} ms after you stopped ({stats['reason']})")
+    return transcript
+
 # --- Argument Parsing ---
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate a response to a customer inquiry using Google Drive resources and GenAI.")
     parser.add_argument("-i", "--inquiry", help="The customer inquiry text (will prompt if not provided).")
     parser.add_argument("-d", "--download", action="store_true", help="Download files from Google Drive (otherwise use local files).")
-    parser.add_argument("-m", "--model", choices=['flash', 'flash-lite', 'pro'], default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', or 'pro'). Defaults to 'flash'.")
+    parser.add_argument("-m", "--model", choices=TIER_CHOICES, default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', 'pro', or 'auto' to pick the cheapest adequate tier per inquiry). Defaults to 'flash'.")
+    parser.add_argument("--barge-in", action="store_true", help="Stop an answer when the caller talks over it. Use with headphones: on open speakers the assistant hears itself and cuts its own answers short.")
+    parser.add_argument("--no-tts-cache", action="store_true", help="Synthesize every sentence group instead of reusing cached audio.")
+    parser.add_argument("--input-audio", help="Replay this 16 kHz mono WAV file instead of recording from the microphone (for testing).")
+    parser.add_argument("--history-budget", type=int, default=DEFAULT_TOKEN_BUDGET, help=f"Token budget for earlier turns before they are summarized (0 keeps the full history). Defaults to {DEFAULT_TOKEN_BUDGET}.")
+    parser.add_argument("--metrics-out", metavar="JSON", help="Write the session's latency histograms and token counters here on exit (default METRICS_JSON; they are always printed).")
     args = parser.parse_args()
     return args
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 
-def get_drive_service():
+def get_drive_credentials():
+    """Loads (or obtains) Drive credentials; each download thread builds its own service from them."""
+    # google-auth is only needed when syncing from Drive, so it is imported here rather than at startup
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
     creds = None
     if os.path.exists("./keys/token.json"):
         creds = Credentials.from_authorized_user_file("./keys/token.json", SCOPES)
@@ -162,66 +196,13 @@ def get_drive_service():
             creds = flow.run_local_server(port=0)
         with open("./keys/token.json", "w") as token:
             token.write(creds.to_json())
-    return build("drive", "v3", credentials=creds)
-
-def download_google_doc(service, file_id, local_filename_base):
-    try:
-        # Get file metadata to check MIME type
-        file_metadata = service.files().get(fileId=file_id, fields='mimeType, name').execute()
-        mime_type = file_metadata.get('mimeType')
-        original_name = file_metadata.get('name')
-        print(f"  File '{original_name}' has MIME type: {mime_type}")
-
-        request = None
-        local_filename = f"{local_filename_base}.{extension}" # Default download extension
-
-        if mime_type == 'application/vnd.google-apps.document':
-            print(f"  Exporting Google Doc '{original_name}' as text/plain...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/plain")
-        elif mime_type == 'text/plain':
-            print(f"  Downloading plain text file '{original_name}' directly...")
-            request = service.files().get_media(fileId=file_id)
-        elif mime_type == 'application/vnd.google-apps.spreadsheet':
-            print(f"  Exporting Google Sheet '{original_name}' as text/csv...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/csv")
-            local_filename = f"{local_filename_base}.csv" # Change extension for CSV
-        else:
-            print(f"  WARNING: Skipping file '{original_name}' (ID: {file_id}). Unsupported MIME type for conversion: {mime_type}")
-            return None
-
-        # Proceed with download if request is valid
-        if request:
-            fh = io.FileIO(local_filename, "wb")
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if status:
-                    print(f"  Download {int(status.progress() * 100)}%.")
-            fh.close()
-            return local_filename
-        else:
-             # Should not happen if logic above is correct, but included for safety
-             print(f"  ERROR: Could not create download request for file '{original_name}' (ID: {file_id})")
-             return None
-
-    except HttpError as error:
-        print(f"  An error occurred downloading file ID {file_id}: {error}")
-        return None
+    return creds
 
 def prepare_context_files(download_flag):
     """Handles local file check or Drive download, and uploads files to GenAI API once."""
     print("--- Preparing Context Files ---")
     # --- Load File IDs from Environment Variables ---
-    file_ids = {}
-    prefix = "GDRIVE_"
-    for key, value in os.environ.items():
-        if key.startswith(prefix):
-            # Convert GDRIVE_FILE_ID_SOME_NAME to "Some Name"
-            name_parts = key[len(prefix):].split('_')
-            name = ' '.join(part.capitalize() for part in name_parts)
-            # Specific adjustments removed
-            file_ids[name] = value
+    file_ids = load_drive_file_ids() # GDRIVE_SOME_NAME=<id> -> "Some Name"
 
     if not file_ids:
         print("ERROR: No Google Drive file IDs found in environment variables (expected format: GDRIVE_SOME_NAME=...).")
@@ -244,7 +225,7 @@ def prepare_context_files(download_flag):
     dir_is_empty = True
     if dir_exists:
         try:
-            if not os.listdir(download_dir):
+            if not [f for f in os.listdir(download_dir) if f != MANIFEST_FILENAME]:
                 dir_is_empty = True
             else:
                 dir_is_empty = False
@@ -267,23 +248,6 @@ def prepare_context_files(download_flag):
         download_flag = True
         print("Forcing download due to missing or empty directory.")
 
-    # --- Clean directory ONLY if download flag is explicitly set at the start ---
-    # Note: We use the original download_flag from args here, not the potentially modified one
-    original_download_flag = args.download # Assuming args is accessible or passed appropriately
-                                          # If not accessible, need to refactor to pass original flag
-    if original_download_flag: # Check the *original* intent from the command line
-        print(f"Download flag is set. Attempting to clean directory: {download_dir}")
-        if dir_exists:
-            try:
-                shutil.rmtree(download_dir)
-                print(f"Successfully deleted existing directory: {download_dir}")
-                dir_exists = False # Update status
-                dir_is_empty = True
-            except OSError as e:
-                print(f"Warning: Error deleting directory {download_dir}: {e}. Proceeding may result in outdated files.")
-        else:
-            print(f"Directory {download_dir} did not exist, no deletion needed.")
-
     # --- Ensure download directory exists before proceeding ---
     if not dir_exists:
         try:
@@ -293,33 +257,29 @@ def prepare_context_files(download_flag):
             print(f"ERROR: Error creating directory {download_dir}: {e}. Cannot proceed.")
             return None, None # Cannot proceed if directory creation fails
 
-    # --- Download or Use Local Files based on initial check/flag ---
+    # --- Sync or Use Local Files based on initial check/flag ---
     if should_download: # Use the calculated flag
-        print("--- Downloading Files from Google Drive ---")
-        drive_service = get_drive_service()
-        if not drive_service:
-            print("ERROR: Failed to get Google Drive service. Cannot download files.")
-            return None, None # Cannot proceed without Drive service
-        for name, file_id in file_ids.items():
-            # Use expected_local_files to determine the base path before extension
-            local_filename_base = os.path.splitext(expected_local_files[name])[0]
-            # local_filename_base = os.path.join(download_dir, name) # Old way
-            print(f"Processing '{name}' from Google Drive (ID: {file_id})...")
-            downloaded_path = download_google_doc(drive_service, file_id, local_filename_base)
-            if downloaded_path:
-                processed_files_paths[name] = downloaded_path
-                # print(f"Finished processing '{name}'. Saved to {downloaded_path}")
-            else:
-                print(f"Skipped file '{name}' due to download/conversion issue.")
+        # Only files whose Drive version changed since the last sync are downloaded; each file is
+        # written to a temp file and renamed into place, so a failed refresh keeps the old copies.
+        print("--- Syncing Files from Google Drive ---")
+        drive_creds = get_drive_credentials()
+        if not drive_creds:
+            print("ERROR: Failed to get Google Drive credentials. Cannot download files.")
+            return None, None # Cannot proceed without Drive access
+        local_filename_bases = {name: os.path.splitext(path)[0] for name, path in expected_local_files.items()}
+        # Files are fetched concurrently (DRIVE_MAX_WORKERS threads), retrying 429/5xx with backoff
+        processed_files_paths = sync_drive_files(make_service_factory(drive_creds), file_ids, download_dir, local_filename_bases, text_extension=extension)
     else:
         # This block now only runs if original download_flag was False AND dir existed AND dir was not empty
         print("--- Skipping Google Drive Download - Using Existing Local Files ---")
+        synced_paths = manifest_local_paths(download_dir, file_ids)
         for name, expected_path in expected_local_files.items():
-            if os.path.exists(expected_path):
-                print(f"Found local file: {expected_path}")
-                processed_files_paths[name] = expected_path
+            local_path = synced_paths.get(name, expected_path)
+            if os.path.exists(local_path):
+                print(f"Found local file: {local_path}")
+                processed_files_paths[name] = local_path
             else:
-                print(f"Local file not found: {expected_path}. It will not be used.")
+                print(f"Local file not found: {local_path}. It will not be used.")
 
     # --- Proceed with GenAI Client Init and Upload ---
     if not processed_files_paths:
@@ -329,44 +289,18 @@ def prepare_context_files(download_flag):
     # --- Initialize GenAI Client ---
     print("--- Initializing GenAI Client --- ")
     try:
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
-        )
+        client = make_genai_client()
     except Exception as e:
         print(f"Failed to initialize GenAI client: {e}")
         return None, None
 
-    # --- Upload Files to GenAI API Sequentially ---
-    print("--- Uploading Files Sequentially to GenAI API --- ")
-    genai_file_parts = []
-
-    def upload_single_file(name, file_path):
-        try:
-            print(f"✅ Uploading {file_path} ({name}) to GenAI API...")
-            # Determine MIME type based on file extension
-            if file_path.lower().endswith(f'.{extension}'):
-                mime_type = 'text/plain'
-            elif file_path.lower().endswith('.csv'):
-                mime_type = 'text/csv'
-            else:
-                # Fallback or raise an error if other types are possible and need specific handling
-                mime_type = None # Let the library try to guess, or handle error
-                print(f"Warning: Could not determine MIME type for {file_path}, attempting upload without it.")
-
-            genai_file = client.files.upload(file=file_path)
-            # print(f"Successfully uploaded {name} ({genai_file.name})")
-            return types.Part.from_uri(file_uri=genai_file.uri, mime_type=mime_type)
-        except Exception as e:
-             print(f"Failed to upload {file_path} ({name}) to GenAI: {e}")
-             return None # Return None on failure
-
-    # Upload text files first (exported Google Docs)
-    print("Uploading text files...")
-    for name, file_path in processed_files_paths.items():
-        if file_path.lower().endswith(f'.{extension}'):
-            result = upload_single_file(name, file_path)
-            if result:
-                genai_file_parts.append(result)
+    # --- Upload Files to GenAI API Concurrently ---
+    # Documents come before CSV sheets in a fixed order, however the uploads finish
+    print("--- Uploading Files to GenAI API --- ")
+    genai_file_parts, upload_timings = upload_context_files(client, processed_files_paths)
+    for timing in upload_timings:
+        icon = "❌" if timing["status"] == "failed" else "✅"
+        print(f"{icon} {timing['name']} ({timing['path']}): {timing['status']} in {timing['seconds']:.2f}s")
 
     if not genai_file_parts:
         print("No files were successfully uploaded to GenAI. Aborting.")
@@ -383,79 +317,102 @@ def _get_next_chunk(iterator):
     except StopIteration:
         return None
 
-async def generate_response(client, file_parts, inquiry_text, model_name, conversation_history):
-    """Generates a response, starting TTS early and maintaining conversation history."""
+def build_generation_request(file_parts, inquiry_text, model_name, conversation_history):
+    """Returns (model_str, user_content, config) for the next turn without modifying the history."""
+    # Tier from -m, or picked per inquiry with -m auto (model versions live in model_router.py)
+    model_str = model_router.choose(inquiry_text, len(conversation_history) // 2, mode=model_name)["model"]
+
+    # Construct initial prompt or use history
+    if not conversation_history:
+        try:
+            system_instructions = prompt_registry.text("voice" if format == "voice" else "chat")
+        except (OSError, ValueError) as e:
+            print(f"Error: could not load system prompts: {e}. Exiting.")
+            exit()
+        # Prompt + documents prefix is prebuilt once per prompt version; only the inquiry is new
+        initial_user_parts = prompt_registry.prefix_parts(system_instructions, file_parts)
+        initial_user_parts += [INQUIRY_MARKER_PART, types.Part.from_text(text=inquiry_text)]
+        user_content = types.Content(role="user", parts=initial_user_parts)
+    else:
+        user_content = types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)])
+
+    generate_content_config = types.GenerateContentConfig(
+        # temperature=1, # Consider adjusting if needed
+        response_mime_type="text/plain",
+    )
+    return model_str, user_content, generate_content_config
+
+def start_model_stream(client, file_parts, inquiry_text, model_name, conversation_history):
+    """Sends the request for a (speculative) inquiry and waits for the first chunk; returns (first_chunk, stream)."""
+    model_str, user_content, config = build_generation_request(file_parts, inquiry_text, model_name, conversation_history)
+    stream = client.models.generate_content_stream(model=model_str, contents=conversation_history + [user_content], config=config)
+    return next(stream, None), stream
+
+def close_model_stream(started):
+    """Abandons a speculative stream that was not used."""
+    started[1].close()
+
+async def generate_response(client, file_parts, inquiry_text, model_name, conversation_history, prefetched=None, cancel_token=None):
+    """Generates a response, starting TTS early and maintaining conversation history.
+
+    `prefetched` is a (first_chunk, stream) pair from start_model_stream for this exact inquiry,
+    started speculatively while the user was still speaking. A cancel of `cancel_token` (barge-in)
+    stops playback, cancels synthesis and closes the model stream; only the sentence groups the
+    caller heard are kept in the history.
+    """
     print("\n📤 Inquiry\n")
     print(inquiry_text + "\n")
 
     last_usage_metadata = None
     response_text = ""
-    first_chunk_text = ""
-    remaining_text = ""
-    first_chunk_spoken = False # We use this to know *when* to split text
-    sentence_count = 0
-    # Tasks for SYNTHESIS
-    first_chunk_synthesis_task = None
-    remaining_text_synthesis_task = None
-    # Variables to hold synthesized AUDIO DATA
-    first_chunk_audio = None
-    remaining_text_audio = None
-    # Task for first chunk PLAYBACK
-    first_playback_task = None
+    speaker_task = None # Task speaking sentence groups while the model streams
 
     if not client:
         print("GenAI client is not available.")
         return None, None, conversation_history
 
     try:
-        # Select model
-        if model_name == 'flash':
-            model_str = "models/gemini-1.5-flash-latest"
-        elif model_name == 'flash-lite':
-            model_str = "models/gemini-1.5-flash-latest" # Or a specific lite model if available
-        elif model_name == 'pro':
-             model_str = "models/gemini-1.5-pro-latest"
-        else:
-            model_str = "models/gemini-1.5-pro-latest" # Defaulting
-            print(f"Warning: Invalid model '{model_name}' specified. Defaulting to {model_str}")
-
-        # Construct initial prompt or use history
-        if not conversation_history:
-            try:
-                with open("sys_prompts.json", "r") as f:
-                    sys_prompts = json.load(f)
-                if format == "chat":
-                    system_instructions = sys_prompts["system_instruction_chat"]
-                elif format == "voice":
-                    system_instructions = sys_prompts["system_instruction_voice"]
-                else:
-                    system_instructions = sys_prompts["system_instruction_chat"] # Default
-            except FileNotFoundError:
-                print("Error: sys_prompts.json not found. Exiting.")
-                exit()
-
-            initial_user_parts = [types.Part.from_text(text=system_instructions)]
-            if file_parts:
-                initial_user_parts.extend(file_parts)
-            initial_user_parts.append(types.Part.from_text(text="--- User Inquiry ---"))
-            initial_user_parts.append(types.Part.from_text(text=inquiry_text))
-            conversation_history.append(types.Content(role="user", parts=initial_user_parts))
-            contents = conversation_history
-        else:
-            conversation_history.append(types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)]))
-            contents = conversation_history
-
-        generate_content_config = types.GenerateContentConfig(
-            # temperature=1, # Consider adjusting if needed
-            response_mime_type="text/plain",
-        )
+        model_str, user_content, generate_content_config = build_generation_request(file_parts, inquiry_text, model_name, conversation_history)
+        conversation_history.append(user_content)
+        contents = conversation_history
 
         # generate_content_stream seems to return a sync generator
-        stream = client.models.generate_content_stream(
-            model=model_str,
-            contents=contents,
-            config=generate_content_config,
-        )
+        if prefetched:
+            first_chunk, model_stream = prefetched
+            stream = itertools.chain([first_chunk] if first_chunk else [], model_stream)
+        else:
+            stream = model_stream = client.models.generate_content_stream(
+                model=model_str,
+                contents=contents,
+                config=generate_content_config,
+            )
+
+        # Sentence groups are spoken as soon as they complete: the first sentence alone, then
+        # SENTENCES_PER_CHUNK at a time, with at most TTS_LOOKAHEAD_CHUNKS groups waiting
+        sink = get_audio_sink()
+        speech_queue = asyncio.Queue(maxsize=TTS_LOOKAHEAD_CHUNKS)
+        timing = {"start": time.perf_counter()}
+        spoken_groups = [] # Groups handed to the sink, in order
+        speaker_task = asyncio.create_task(speak_chunks_async(speech_queue, sink, timing, spoken_groups))
+        pending_text = ""
+        groups_sent = 0
+        cancelled = lambda: bool(cancel_token and cancel_token.cancelled)
+        if cancel_token:
+            loop = asyncio.get_running_loop()
+            utterance_base = sink.utterances_started()
+
+            def stop_speaking(): # Runs on the barge-in thread: silence first, then unwind the tasks
+                timing["heard_groups"] = sink.utterances_started() - utterance_base
+                sink.stop()
+                timing["playback_stopped_ms"] = cancel_token.elapsed_ms()
+                loop.call_soon_threadsafe(cancel_speaker)
+
+            def cancel_speaker():
+                speaker_task.cancel()
+                while not speech_queue.empty(): # Frees a chunker blocked on a full queue
+                    speech_queue.get_nowait()
+
+            cancel_token.add_callback(stop_speaking)
 
         print("\n🔊 Assistant:", end=" ")
         # Get the synchronous stream iterator
@@ -467,29 +424,24 @@ async def generate_response(client, file_parts, inquiry_text, model_name, conver
                 # Use the helper function to catch StopIteration within the thread
                 chunk = await asyncio.to_thread(_get_next_chunk, sync_stream_iterator)
 
-                # Check if the iterator is exhausted
-                if chunk is None:
+                # Check if the iterator is exhausted (or the caller interrupted)
+                if chunk is None or cancelled():
                     break # Exit the loop if stream ended
 
-                # Process the chunk (same logic as before)
                 if chunk.text:
+                    if not response_text:
+                        metrics.observe("time_to_first_token_seconds", time.perf_counter() - timing["start"], model=model_str)
                     text_piece = chunk.text
                     print(text_piece, end="", flush=True)
                     response_text += text_piece # Accumulate full response
-
-                    if not first_chunk_spoken:
-                        first_chunk_text += text_piece
-                        # Simple sentence counting based on terminal punctuation
-                        sentence_count += text_piece.count('.') + text_piece.count('?') + text_piece.count('!')
-                        if sentence_count >= SENTENCES_PER_CHUNK:
-                            print(f"\n[Starting TTS synthesis task for first {sentence_count} sentence(s)...]")
-                            # Start SYNTHESIS for the first chunk in the background
-                            first_chunk_synthesis_task = asyncio.create_task(synthesize_text_async(first_chunk_text))
-                            first_chunk_spoken = True
-                            # No longer need first_chunk_text after task creation
-                    else:
-                        # Once the first chunk is being spoken, accumulate the rest
-                        remaining_text += text_piece
+                    pending_text += text_piece
+                    while True:
+                        group_size = FIRST_CHUNK_SENTENCES if groups_sent == 0 else SENTENCES_PER_CHUNK
+                        group, pending_text = take_sentence_group(pending_text, group_size)
+                        if not group or cancelled():
+                            break
+                        await speech_queue.put(group) # Waits here if the speaker is TTS_LOOKAHEAD_CHUNKS behind
+                        groups_sent += 1
 
                 if hasattr(chunk, 'usage_metadata') and chunk.usage_metadata:
                     last_usage_metadata = chunk.usage_metadata
@@ -497,60 +449,29 @@ async def generate_response(client, file_parts, inquiry_text, model_name, conver
             except Exception as e:
                 # Handle other potential errors during stream processing loop
                 print(f"\nError during stream processing loop: {e}")
-                # Optionally add more specific error handling or re-raise
                 break
 
         print() # Newline after response stream finishes
+        model_router.record(model_str, (time.perf_counter() - timing["start"]) * 1000, last_usage_metadata)
 
-        # --- Start synthesis for remaining text immediately after stream ends ---
-        if remaining_text and not first_chunk_synthesis_task:
-             # This case should ideally not happen if SENTENCES_PER_CHUNK > 0
-             # but handles edge case where first chunk logic didn't trigger a task
-             print("\n[Response shorter than chunk size, preparing to speak all at once...]")
-             # We'll handle the actual await later
-        elif remaining_text:
-            print(f"\n[LLM stream finished. Starting TTS synthesis task for remaining {len(remaining_text.split())} words...]")
-            remaining_text_synthesis_task = asyncio.create_task(synthesize_text_async(remaining_text))
-
-        # --- Wait for Synthesis Tasks to Complete --- #
-        # --- Wait for Synthesis Tasks (and start first playback) --- #
-        print("\n[Waiting for TTS synthesis tasks to complete...]")
-        if first_chunk_synthesis_task:
-            first_chunk_audio = await first_chunk_synthesis_task
-            # If first synthesis succeeded, start its playback in background
-            if first_chunk_audio:
-                print("\n[Starting playback task for first audio chunk...]")
-                first_playback_task = asyncio.create_task(play_audio_chunk_async(first_chunk_audio))
-            else:
-                print("\n[Skipping playback for first chunk (synthesis failed or no audio)]")
-
-        # Wait for the second synthesis task (might happen during first playback)
-        if remaining_text_synthesis_task:
-            remaining_text_audio = await remaining_text_synthesis_task
-
-        # --- Handle Sequential PLAYBACK --- #
-        # Ensure first playback is finished before starting second
-        if first_playback_task:
-            print("\n[Ensuring first chunk playback is finished...]")
-            await first_playback_task
-
-        # Now play the second chunk if available
-        if first_chunk_synthesis_task:
-            # If we started speaking the first chunk...
-            # We already waited for first playback above.
-            # Play the second chunk now.
-            if remaining_text_audio:
-                 print("\n[Playing remaining audio chunk...]")
-                 await play_audio_chunk_async(remaining_text_audio)
-        elif response_text:
-            # If the response finished before reaching SENTENCES_PER_CHUNK
-            print("\n[Response shorter than chunk size, synthesizing and speaking all at once...]")
-            full_audio = await synthesize_text_async(response_text)
-            if full_audio:
-                 await play_audio_chunk_async(full_audio)
-        else:
-            # Handle case where LLM returned nothing
+        if pending_text.strip() and not cancelled():
+            await speech_queue.put(pending_text.strip())
+            groups_sent += 1
+        if not response_text:
             print("\nWarning: LLM returned an empty response. No TTS.")
+        if not cancelled():
+            await speech_queue.put(None)
+        await asyncio.gather(speaker_task, return_exceptions=True) # Raises nothing if the speaker was cancelled
+        while not cancelled(): # Poll so a barge-in during the tail is still noticed
+            if await asyncio.to_thread(sink.wait_until_drained, 0.1):
+                break
+        if "first_audio" in timing:
+            print(f"\n🔈 Time to first audio: {(timing['first_audio'] - timing['start']) * 1000:.0f} ms ({groups_sent} sentence groups)")
+        if cancelled():
+            model_stream.close() # Stops generation (and token spend) if it was still running
+            print(f"\n✋ Interrupted: playback stopped {timing['playback_stopped_ms']} ms and model stream closed {cancel_token.elapsed_ms()} ms after the caller spoke")
+            spoken_text = " ".join(spoken_groups[:timing["heard_groups"]])
+            response_text = f"{spoken_text} [interrupted by the caller]".strip()
 
         # Update conversation history *after* processing the full response
         if response_text:
@@ -558,6 +479,9 @@ async def generate_response(client, file_parts, inquiry_text, model_name, conver
 
     except Exception as e:
         print(f"\nAn error occurred during generation or TTS handling: {e}")
+        if speaker_task and not speaker_task.done():
+            speaker_task.cancel()
+            get_audio_sink().stop()
         # Attempt to update history even on error, if we have some response text
         if response_text and not any(c.role == 'model' and c.parts[0].text == response_text for c in conversation_history):
              conversation_history.append(types.Content(role="model", parts=[types.Part.from_text(text=response_text)]))
@@ -567,10 +491,43 @@ async def generate_response(client, file_parts, inquiry_text, model_name, conver
     # Return the full response text along with metadata and history
     return response_text, last_usage_metadata, conversation_history
 
+def capture_spoken_inquiry(client, file_parts, model_name, conversation_history, input_audio=None, source=None):
+    """Listens for one spoken inquiry, starting the model early on a settled partial; returns (inquiry, prefetched).
+
+    Blocking; run it in a thread.
+    """
+    speculation = SpeculativeStart(
+        lambda text: start_model_stream(client, file_parts, text, model_name, conversation_history),
+        discard_fn=close_model_stream,
+    ) if SPECULATE else None
+    inquiry_text = listen_for_inquiry(input_audio, on_partial=speculation.offer if speculation else None, source=source)
+    if not speculation:
+        return inquiry_text, None
+    inquiry_text, prefetched = speculation.claim(inquiry_text) # Waits for the first chunk on a match
+    if speculation.starts:
+        print(f"⚡ Speculative start: {'used' if prefetched else 'discarded'} ({speculation.starts} started)")
+    return inquiry_text, prefetched
+
+def start_barge_in_monitor(cancel_token):
+    """Listens for the caller talking over the next answer; None if no microphone is available."""
+    try:
+        return BargeInMonitor(cancel_token).start()
+    except Exception as e:
+        print(f"Barge-in disabled (microphone unavailable: {e}).")
+        return None
+
 async def main(): # Wrap main logic in an async function
+    global tts_cache
     args = parse_arguments()
     model_name = args.model
 
+    # Fail fast on a missing or malformed prompt file rather than on the first inquiry
+    try:
+        prompt_registry.load()
+    except (OSError, ValueError) as e:
+        print(f"Error: could not load system prompts: {e}. Exiting.")
+        exit()
+
     # Prepare files and client ONCE
     genai_client, prepared_file_parts = prepare_context_files(args.download)
 
@@ -578,14 +535,30 @@ async def main(): # Wrap main logic in an async function
         print("Exiting due to issue with GenAI client initialization.")
         return # Use return instead of exit in async main
 
-    # Initialize conversation history
+    # Cache synthesized sentence groups and pre-warm common phrases in the background
+    if not args.no_tts_cache:
+        tts_cache = TtsCache()
+        phrases = load_phrases() + kb_phrases(glob.glob(os.path.join("drive", f"*.{extension}")))
+        threading.Thread(target=tts_cache.prewarm, args=(phrases, VOICE, TTS_AUDIO_CONFIG, synthesize_speech), daemon=True).start()
+
+    # Initialize conversation history (older turns are summarized once over the token budget)
     conversation_history = []
+    history_manager = HistoryManager(genai_client, budget_tokens=args.history_budget)
 
     # Main inquiry loop
+    interruption = None # Microphone stream of a caller who talked over the last answer
     while True:
+        # Trim first, so a speculative start sees the same history as the real request
+        conversation_history, history_stats = await asyncio.to_thread(history_manager.trim, conversation_history)
+        prefetched = None # Model stream started from a partial transcript, if it matched the final one
         inquiry_to_use = args.inquiry # Get inquiry from args for the *first* iteration
         if inquiry_to_use:
             args.inquiry = None # Clear it so we prompt next time
+        elif interruption: # Transcribe the interruption straight away instead of prompting
+            inquiry_to_use, prefetched = await asyncio.to_thread(
+                capture_spoken_inquiry, genai_client, prepared_file_parts, args.model, conversation_history, None, interruption,
+            )
+            interruption = None
         else:
             try:
                 # Use asyncio.to_thread for synchronous input in async context if needed
@@ -595,18 +568,11 @@ async def main(): # Wrap main logic in an async function
                 if user_input.lower() == 'q':
                     print("Exiting.")
                     break
-                elif not user_input: # User pressed Enter, initiate recording
-                    # Run synchronous recording/STT in a thread executor
-                    audio_path = await asyncio.to_thread(record_audio)
-                    if audio_path:
-                        inquiry_to_use = await asyncio.to_thread(speech_to_text, audio_path)
-                        # Clean up the temporary audio file (sync os call is okay)
-                        try:
-                            os.remove(audio_path)
-                        except OSError as e:
-                            print(f"Warning: Could not remove temp audio file {audio_path}: {e}")
-                    else:
-                        inquiry_to_use = None # Recording failed
+                elif not user_input: # User pressed Enter, stream from the microphone until they pause
+                    # Run the blocking capture/STT in a thread executor
+                    inquiry_to_use, prefetched = await asyncio.to_thread(
+                        capture_spoken_inquiry, genai_client, prepared_file_parts, args.model, conversation_history, args.input_audio,
+                    )
                 else:
                     inquiry_to_use = user_input # Use text input
 
@@ -620,6 +586,9 @@ async def main(): # Wrap main logic in an async function
 
         # Process this single inquiry, passing and updating history
         start_time = time.time()
+        cancel_token = CancelToken()
+        barge_in = start_barge_in_monitor(cancel_token) if args.barge_in and not args.input_audio else None
+        args.barge_in = args.barge_in and (barge_in is not None or bool(args.input_audio)) # Don't retry without a microphone
         # Call the async generate_response function
         llm_response_text, final_usage_metadata, conversation_history = await generate_response(
             genai_client,
@@ -627,7 +596,11 @@ async def main(): # Wrap main logic in an async function
             inquiry_to_use,
             args.model,
             conversation_history, # Pass current history
+            prefetched=prefetched,
+            cancel_token=cancel_token if barge_in else None,
         )
+        if barge_in:
+            interruption = await asyncio.to_thread(barge_in.stop)
         end_time = time.time()
         duration = end_time - start_time
 
@@ -646,12 +619,22 @@ async def main(): # Wrap main logic in an async function
         # Print summary for this inquiry
         print(f"\n\n=== Summary ===")
         print(f"Time taken: {duration:.2f} seconds")
+        if history_stats["summarized_turns"]:
+            print(f"History Tokens (est.): {history_stats['before_tokens']} -> {history_stats['after_tokens']} ({history_stats['summarized_turns']} earlier turns summarized)")
+        else:
+            print(f"History Tokens (est.): {history_stats['before_tokens']}")
         if final_usage_metadata:
             print(f"Input Tokens: {final_usage_metadata.prompt_token_count}")
             print(f"Output Tokens: {final_usage_metadata.candidates_token_count}")
             print(f"Total Tokens: {final_usage_metadata.total_token_count}")
         else:
             print("Token usage metadata not available for this inquiry.")
+        if audio_sink:
+            print(f"Audio: {audio_sink.metrics()}")
+        if tts_cache:
+            print(f"TTS Cache: {tts_cache.stats()}")
+        if model_name == "auto":
+            print(f"Model Routing: {model_router.stats()}")
         print("=======================")
 
 
@@ -662,3 +645,4 @@ if __name__ == "__main__":
         asyncio.run(main()) # Run the async main function
     except KeyboardInterrupt:
         print("\nInterrupted by user. Exiting.")
+    metrics.report_session("voice_msft", args.metrics_out)
@@ -1,20 +1,28 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 import os
-import io
-import concurrent.futures
+import json
+import time
 import threading
-import shutil # Added for directory deletion
+import contextlib
+import sqlite3
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google import genai
+from context_prep import load_drive_file_ids, make_genai_client, upload_context_files
+from drive_sync import sync_drive_files, manifest_local_paths, make_service_factory, MANIFEST_FILENAME
 from google.genai import types
-from googleapiclient.errors import HttpError
 import logging
 import argparse # Added for command-line arguments
+from context_cache import ContextCacheManager, compute_kb_version, cached_token_count, is_missing_cache_error
+from response_cache import ResponseCache, cache_namespace
+from session_store import SessionStore
+from prompt_registry import PromptRegistry
+from model_router import ModelRouter, TIER_CHOICES, cache_model_key, resolve_model_str
+from kb_refresh import BackgroundRefresher
+import metrics
+from drone_lookup import load_drone_index, match_compatibility_inquiry, format_rows, template_answer
+from batch import run_batch, summarize, DEFAULT_CONCURRENCY as BATCH_CONCURRENCY, DEFAULT_REQUESTS_PER_MINUTE as BATCH_REQUESTS_PER_MINUTE
 
 # --- Setup Logging ---
 logging.basicConfig(level=logging.INFO)
@@ -24,27 +32,47 @@ load_dotenv(override=True)
 
 # --- Global Variables for GenAI Client and Files ---
 genai_client = None
-prepared_file_parts = None
 initialization_lock = threading.Lock()
 is_initialized = False
 download_files_on_init = False # Global flag to hold arg value
-selected_model_name = 'flash' # Default model - flash or pro
+selected_model_name = 'flash' # Model tier (flash-lite, flash, pro) or 'auto' to route per inquiry
+model_router = ModelRouter() # Routing decisions plus per-tier latency, token and cost totals
+knowledge_base = None # Current knowledge-base snapshot (see build_knowledge_base); replaced whole, never mutated
+kb_refresher = None # BackgroundRefresher re-syncing Drive and swapping in new snapshots
+context_cache = None # ContextCacheManager for the static system prompt + files prefix
+response_cache = None # ResponseCache answering repeated inquiries without a model call
+session_store = None # SessionStore with per-email-thread history for follow-ups
+prompt_registry = PromptRegistry() # Email prompt shared with the CLI, reloaded when sys_prompts.json changes
+DRONE_TEMPLATE_ANSWERS = os.environ.get("DRONE_TEMPLATE_ANSWERS", "").lower() in ("1", "true", "yes")
 
 # --- Constants ---
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 DOWNLOAD_DIR = "drive_worker" # Use a separate directory for worker
+DRIVE_NOTIFY_TOKEN = os.environ.get("DRIVE_NOTIFY_TOKEN") # Channel token expected on /drive/notify pushes
+# /webhook/batch answers within one HTTP request, so batches must finish before proxies time out
+# (Cloudflare Tunnel closes idle requests after 100s); larger backlogs go through main.py --batch
+MAX_BATCH_SIZE = int(os.environ.get("WORKER_MAX_BATCH_SIZE", 50))
+MAX_BATCH_SECONDS = float(os.environ.get("WORKER_MAX_BATCH_SECONDS", 90)) # Longest batch the rate budget may imply
+MAX_BATCH_CONCURRENCY = int(os.environ.get("WORKER_MAX_BATCH_CONCURRENCY", 16))
+MAX_BATCH_REQUESTS_PER_MINUTE = float(os.environ.get("WORKER_MAX_BATCH_RPM", 300))
 
 # --- Argument Parsing (similar to main.py) ---
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Run the Gemini Cloudflare Worker with optional file download.")
     parser.add_argument("-d", "--download", action="store_true", help="Download files from Google Drive on startup.")
-    parser.add_argument("-m", "--model", choices=['flash', 'pro'], default='flash', help="Specify the GenAI model to use ('flash' or 'pro'). Defaults to 'flash'.")
+    parser.add_argument("--refresh-seconds", type=float, default=None, help="Re-sync Drive and hot-swap the knowledge base this often (default KB_REFRESH_SECONDS, 0 = only on /drive/notify).")
+    parser.add_argument("-m", "--model", choices=TIER_CHOICES, default='flash', help="Specify the GenAI model to use ('flash', 'flash-lite', 'pro', or 'auto' to pick the cheapest adequate tier per inquiry). Defaults to 'flash'.")
     # Add other worker-specific args here if needed
     args = parser.parse_args()
     return args
 
 # --- Google Drive Functions (Adapted from main.py) ---
-def get_drive_service():
+def get_drive_credentials(interactive=True):
+    """Loads, refreshes or obtains Drive credentials (None on failure).
+
+    With interactive=False (background refreshes) a missing or revoked token is a failure rather
+    than a browser authorization flow.
+    """
     creds = None
     token_path = "token.json" # Use separate token for worker
     credentials_path = "credentials.json"
@@ -62,6 +90,9 @@ def get_drive_service():
             except Exception as e:
                 logger.error(f"Failed to refresh token: {e}. Need new authorization.")
                 creds = None # Force re-authentication
+        if not creds and not interactive:
+            logger.error(f"No valid Drive token in {token_path}; run the worker with -d once to authorize.")
+            return None
         if not creds: # If still no valid creds, run flow
             try:
                 logger.info("Attempting new Google Drive authorization flow.")
@@ -86,71 +117,121 @@ def get_drive_service():
     if not creds:
          logger.error("Failed to obtain valid Google Drive credentials.")
          return None
-
-    try:
-        return build("drive", "v3", credentials=creds)
-    except Exception as e:
-        logger.error(f"Failed to build Drive service: {e}")
-        return None
-
-def download_google_doc(service, file_id, local_filename_base):
-    try:
-        file_metadata = service.files().get(fileId=file_id, fields='mimeType, name').execute()
-        mime_type = file_metadata.get('mimeType')
-        original_name = file_metadata.get('name')
-        logger.info(f"  File '{original_name}' has MIME type: {mime_type}")
-        request = None
-        local_filename = f"{local_filename_base}.txt"
-        if mime_type == 'application/vnd.google-apps.document':
-            logger.info(f"  Exporting Google Doc '{original_name}' as text/plain...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/plain")
-        elif mime_type == 'text/plain':
-            logger.info(f"  Downloading plain text file '{original_name}' directly...")
-            request = service.files().get_media(fileId=file_id)
-        elif mime_type == 'application/vnd.google-apps.spreadsheet':
-            logger.info(f"  Exporting Google Sheet '{original_name}' as text/csv...")
-            request = service.files().export_media(fileId=file_id, mimeType="text/csv")
-            local_filename = f"{local_filename_base}.csv"
-        else:
-            logger.warning(f"  Skipping file '{original_name}' (ID: {file_id}). Unsupported MIME type: {mime_type}")
-            return None
-        if request:
-            fh = io.FileIO(local_filename, "wb")
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-                if status:
-                    logger.debug(f"  Download {int(status.progress() * 100)}%.")
-            fh.close()
-            logger.info(f"  Successfully downloaded/exported to {local_filename}")
-            return local_filename
+    return creds
+
+def expected_local_paths(file_ids):
+    """{name: local path} each Drive file is exported to under DOWNLOAD_DIR."""
+    return {
+        name: os.path.join(DOWNLOAD_DIR,
+                            f"{name.replace(' ', '_')}.csv" if name == "Links" else f"{name.replace(' ', '_')}.txt")
+        for name in file_ids
+    }
+
+# --- Knowledge-Base Snapshots ---
+# Requests read `knowledge_base` once and use that snapshot throughout, so a refresh that swaps in a
+# new one never changes the documents, version or drone index under a request already in flight.
+def build_knowledge_base(file_paths):
+    """Uploads {name: local path} and returns a snapshot {"version", "file_parts", "file_paths", "drone_index", "built_at"}.
+
+    Unchanged files are reused from the upload registry, so a refresh only uploads what changed.
+    """
+    file_parts = []
+    if file_paths:
+        logger.info("--- Uploading Files to GenAI API ---")
+        # Concurrent with retries; parts keep a fixed order (documents, then CSVs) so the cached prefix is stable
+        file_parts, upload_timings = upload_context_files(genai_client, file_paths)
+        for timing in upload_timings:
+            logger.info(f"{timing['name']}: {timing['status']} in {timing['seconds']:.2f}s ({timing['attempts']} attempt(s))")
+        if not file_parts:
+            logger.warning("No files were successfully uploaded to GenAI. Responses will lack file context.")
         else:
-             logger.error(f"  Could not create download request for file '{original_name}' (ID: {file_id})")
-             return None
-    except HttpError as error:
-        logger.error(f"  An HTTP error occurred downloading file ID {file_id}: {error}")
-        return None
-    except Exception as e:
-        logger.error(f"  A general error occurred downloading file ID {file_id}: {e}")
-        return None
+            logger.info(f"Successfully uploaded {len(file_parts)} files to GenAI.")
+    else:
+        logger.info("Skipping GenAI file upload as no files were processed.")
+    drone_index = None
+    if file_paths and os.environ.get("DISABLE_DRONE_LOOKUP", "").lower() not in ("1", "true", "yes"):
+        drone_index = load_drone_index(file_paths)
+    return {
+        "version": compute_kb_version(file_paths) if file_paths else None,
+        "file_parts": tuple(file_parts),
+        "file_paths": dict(file_paths),
+        "drone_index": drone_index,
+        "built_at": time.time(),
+    }
+
+def install_knowledge_base(snapshot):
+    """Makes `snapshot` the one new requests use (a single reference swap; in-flight requests keep theirs)."""
+    global knowledge_base
+    previous = knowledge_base
+    knowledge_base = snapshot
+    if previous:
+        logger.info(f"Knowledge base swapped: version {previous['version']} -> {snapshot['version']} ({len(snapshot['file_parts'])} files).")
+    else:
+        logger.info(f"Knowledge base version: {snapshot['version']}")
+
+def current_knowledge_base():
+    """The snapshot for a new request (an empty one before initialization)."""
+    return knowledge_base or {"version": None, "file_parts": (), "file_paths": {}, "drone_index": None, "built_at": None}
+
+def refresh_knowledge_base():
+    """Re-syncs Drive and, if any file changed, builds and installs a new snapshot off to the side.
+
+    Returns True if a new version was installed. Runs on the refresher thread; requests keep being
+    served from the current snapshot the whole time.
+    """
+    file_ids = load_drive_file_ids()
+    drive_creds = get_drive_credentials(interactive=False)
+    if not file_ids or not drive_creds or not genai_client:
+        return False
+    local_filename_bases = {name: os.path.splitext(path)[0] for name, path in expected_local_paths(file_ids).items()}
+    # Each file is written to a temp name and renamed, so the directory is never half-updated
+    file_paths = sync_drive_files(make_service_factory(drive_creds), file_ids, DOWNLOAD_DIR, local_filename_bases)
+    current = current_knowledge_base()
+    if not file_paths or compute_kb_version(file_paths) == current["version"]:
+        logger.info(f"Knowledge base unchanged (version {current['version']}).")
+        return False
+
+    snapshot = build_knowledge_base(file_paths)
+    if current["file_parts"] and len(snapshot["file_parts"]) < len(file_paths):
+        logger.error("Some refreshed files failed to upload; keeping the current knowledge base.")
+        return False
+    # Build the new context-cache entry before the swap so the first request after it doesn't pay for it.
+    # The old version's caches are never deleted: other processes may still use them, and once nobody
+    # renews them they expire on their own TTL
+    if context_cache and snapshot["file_parts"] and selected_model_name != "auto":
+        context_cache.get_cache_name(
+            resolve_model_str(selected_model_name), snapshot["version"], webhook_system_instruction(),
+            list(snapshot["file_parts"]), as_system_instruction=True,
+        )
+    install_knowledge_base(snapshot)
+    return True
+
+def start_kb_refresher(interval_seconds=None):
+    """Starts the background refresher (once); /drive/notify triggers it early."""
+    global kb_refresher
+    if kb_refresher is None:
+        kb_refresher = BackgroundRefresher(refresh_knowledge_base, **({} if interval_seconds is None else {"interval_seconds": interval_seconds}))
+        kb_refresher.start()
+    return kb_refresher
+
+def knowledge_base_health():
+    """Current version and refresher state for /health."""
+    kb = current_knowledge_base()
+    health = {"version": kb["version"], "files": len(kb["file_parts"]), "built_at": kb["built_at"]}
+    if kb_refresher:
+        health["refresh"] = kb_refresher.stats()
+    return health
 
 # --- GenAI Functions (Adapted from main.py) ---
 def prepare_context_files_and_client(download_flag):
-    global genai_client, prepared_file_parts, is_initialized
+    global genai_client, is_initialized, context_cache, response_cache, session_store
     with initialization_lock:
         if is_initialized:
             logger.info("Initialization already performed.")
             return
 
         logger.info("--- Initializing GenAI Client and Preparing Context Files ---")
-        file_ids = {}
-        prefix = "GDRIVE_"
-        for key, value in os.environ.items():
-            if key.startswith(prefix):
-                name_parts = key[len(prefix):].split('_')
-                name = ' '.join(part.capitalize() for part in name_parts)
-                file_ids[name] = value
+        file_ids = load_drive_file_ids()
 
         if not file_ids:
             logger.error("ERROR: No Google Drive file IDs found in environment variables (e.g., GDRIVE_XYZ=...). Cannot prepare context.")
@@ -166,7 +247,7 @@ def prepare_context_files_and_client(download_flag):
         dir_is_empty = True
         if dir_exists:
             try:
-                if not os.listdir(DOWNLOAD_DIR):
+                if not [f for f in os.listdir(DOWNLOAD_DIR) if f != MANIFEST_FILENAME]:
                     dir_is_empty = True
                 else:
                     dir_is_empty = False
@@ -185,22 +266,8 @@ def prepare_context_files_and_client(download_flag):
             elif dir_is_empty:
                 logger.info(f"Directory '{DOWNLOAD_DIR}' is empty. Files will be downloaded.")
 
-        # --- Clean directory ONLY if download flag is explicitly set ---
-        if download_flag:
-            logger.info(f"Download flag is set. Attempting to clean directory: {DOWNLOAD_DIR}")
-            if dir_exists:
-                try:
-                    shutil.rmtree(DOWNLOAD_DIR)
-                    logger.info(f"Successfully deleted existing directory: {DOWNLOAD_DIR}")
-                    dir_exists = False # Update status after deletion
-                    dir_is_empty = True
-                except OSError as e:
-                    logger.error(f"Error deleting directory {DOWNLOAD_DIR}: {e}. Proceeding may result in outdated files.")
-            else:
-                logger.info(f"Directory {DOWNLOAD_DIR} did not exist, no deletion needed.")
-
         # --- Ensure download directory exists before proceeding ---
-        # Needed if it didn't exist initially OR if it was deleted above
+        # Needed if it didn't exist initially
         if not dir_exists:
             try:
                 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -211,42 +278,34 @@ def prepare_context_files_and_client(download_flag):
                 return
 
         # --- Determine expected local files (needed for both scenarios) ---
-        expected_local_files = {
-            name: os.path.join(DOWNLOAD_DIR,
-                                f"{name.replace(' ', '_')}.csv" if name == "Links" else f"{name.replace(' ', '_')}.txt")
-            for name in file_ids
-        }
+        expected_local_files = expected_local_paths(file_ids)
 
-        # --- Download or Use Local Files ---
+        # --- Sync or Use Local Files ---
         if should_download:
-            # This block runs if -d flag OR dir was missing/empty
-            logger.info("--- Downloading Files from Google Drive for Worker ---")
-            drive_service = get_drive_service()
-            if not drive_service:
-                logger.error("Failed to get Google Drive service. Cannot download files.")
+            # This block runs if -d flag OR dir was missing/empty. Only files whose Drive version
+            # changed are downloaded, and each is renamed into place once complete.
+            logger.info("--- Syncing Files from Google Drive for Worker ---")
+            drive_creds = get_drive_credentials()
+            if not drive_creds:
+                logger.error("Failed to get Google Drive credentials. Cannot download files.")
                 is_initialized = True
                 return
 
-            for name, file_id in file_ids.items():
-                # Use the expected path base for consistency
-                local_filename_base = os.path.splitext(expected_local_files[name])[0]
-                logger.info(f"Processing '{name}' from Google Drive (ID: {file_id})...")
-                downloaded_path = download_google_doc(drive_service, file_id, local_filename_base)
-                if downloaded_path:
-                    processed_files_paths[name] = downloaded_path
-                    logger.info(f"Finished processing '{name}'. Saved to {downloaded_path}")
-                else:
-                    logger.warning(f"Skipped file '{name}' due to download/conversion issue.")
+            local_filename_bases = {name: os.path.splitext(path)[0] for name, path in expected_local_files.items()}
+            # Files are fetched concurrently (DRIVE_MAX_WORKERS threads), retrying 429/5xx with backoff
+            processed_files_paths = sync_drive_files(make_service_factory(drive_creds), file_ids, DOWNLOAD_DIR, local_filename_bases)
         else:
             # This block now only runs if download_flag is False AND dir existed AND dir was not empty
             logger.info("--- Skipping Google Drive Download - Using Existing Local Files ---")
+            synced_paths = manifest_local_paths(DOWNLOAD_DIR, file_ids)
             for name, expected_path in expected_local_files.items():
-                if os.path.exists(expected_path):
-                    logger.info(f"Found local file: {expected_path}")
-                    processed_files_paths[name] = expected_path
+                local_path = synced_paths.get(name, expected_path)
+                if os.path.exists(local_path):
+                    logger.info(f"Found local file: {local_path}")
+                    processed_files_paths[name] = local_path
                 else:
                     # This case should be less likely if the dir wasn't empty, but good to log
-                    logger.warning(f"Expected local file not found: {expected_path}. It will not be used for context.")
+                    logger.warning(f"Expected local file not found: {local_path}. It will not be used for context.")
 
         # --- Proceed with GenAI Client Init and Upload ---
         if not processed_files_paths:
@@ -261,8 +320,7 @@ def prepare_context_files_and_client(download_flag):
             is_initialized = True
             return
         try:
-            # Use genai.configure() for API key and then Client()
-            genai_client = genai.Client(api_key=api_key) # Correct initialization
+            genai_client = make_genai_client(api_key)
             # Test connection (optional but recommended)
             # list(genai_client.models.list())
             logger.info("GenAI Client Initialized Successfully.")
@@ -271,60 +329,31 @@ def prepare_context_files_and_client(download_flag):
             is_initialized = True
             return # Cannot proceed without client
 
-        # --- Upload Files to GenAI API ---
-        logger.info("--- Uploading Files to GenAI API ---")
-        uploaded_parts = []
-        if processed_files_paths: # Only upload if we have paths
-            def upload_single_file(name, file_path):
-                try:
-                    logger.info(f"Uploading {file_path} ({name}) to GenAI API...")
-                    genai_file = genai_client.files.upload(file=file_path) # Use global client
-                    logger.info(f"Successfully uploaded {name} ({genai_file.name})")
-                    return types.Part.from_uri(file_uri=genai_file.uri, mime_type=genai_file.mime_type)
-                except Exception as e:
-                     logger.error(f"Failed to upload {file_path} ({name}) to GenAI: {e}")
-                     return None
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_to_name = {executor.submit(upload_single_file, name, path): name for name, path in processed_files_paths.items()}
-                for future in concurrent.futures.as_completed(future_to_name):
-                    result = future.result()
-                    if result:
-                        uploaded_parts.append(result)
-        else:
-            logger.info("Skipping GenAI file upload as no files were processed.")
+        # --- Upload Files and Install the First Knowledge-Base Snapshot ---
+        install_knowledge_base(build_knowledge_base(processed_files_paths))
 
-        prepared_file_parts = uploaded_parts # Assign to global
-        if not prepared_file_parts:
-            logger.warning("No files were successfully uploaded to GenAI. Responses will lack file context.")
-        else:
-             logger.info(f"Successfully uploaded {len(prepared_file_parts)} files to GenAI.")
+        # --- Context Cache ---
+        if os.environ.get("DISABLE_CONTEXT_CACHE", "").lower() not in ("1", "true", "yes"):
+            context_cache = ContextCacheManager(genai_client)
+        if os.environ.get("DISABLE_RESPONSE_CACHE", "").lower() not in ("1", "true", "yes"):
+            response_cache = ResponseCache(client=genai_client)
+        if os.environ.get("DISABLE_SESSIONS", "").lower() not in ("1", "true", "yes"):
+            try:
+                session_store = SessionStore()
+            except sqlite3.Error as e:
+                logger.error(f"Could not open session database: {e}. Follow-ups will not keep thread context.")
+
+        try:
+            prompt_registry.load()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load system prompts ({e}); using the built-in webhook instruction.")
 
         logger.info("--- Context File Preparation and Client Initialization Complete ---")
         is_initialized = True # Mark initialization as complete
 
 
-def generate_response_for_webhook(inquiry_text):
-    """Generates a response using the pre-initialized client and files."""
-    logger.info(f"Generating response for inquiry: {inquiry_text[:50]}...") # Log truncated inquiry
-    if not is_initialized or not genai_client:
-        logger.error("GenAI client not initialized. Cannot generate response.")
-        return "Error: Service not ready.", 503 # Service Unavailable
-
-    response_text = ""
-    try:
-        # Use the globally selected model name
-        model_str = "models/gemini-2.0-flash" if selected_model_name == 'flash' else "models/gemini-2.5-pro-exp-03-25"
-        print(f"Using model: {model_str}")
-
-        current_parts = []
-        if prepared_file_parts: # Use the globally prepared file parts
-            current_parts.extend(prepared_file_parts)
-        current_parts.append(types.Part.from_text(text=inquiry_text))
-        contents = [types.Content(role="user", parts=current_parts)]
-
-        # Reuse system instruction from main.py
-        system_instruction_text = """You are a customer support specialist for SkyeBrowse. Use the provided resources when necessary to assist the customer with their inquiry. If there is a link that would be beneficial for customer, provide the link. The customer has sent an email, so you are to write an email response back. Write the email in complete paragraphs. Be direct and straight to the point. Again, do NOT use bullet points in your email.
+# Fallback when no prompt file is available; otherwise the registry's email prompt is used
+WEBHOOK_SYSTEM_INSTRUCTION = """You are a customer support specialist for SkyeBrowse. Use the provided resources when necessary to assist the customer with their inquiry. If there is a link that would be beneficial for customer, provide the link. The customer has sent an email, so you are to write an email response back. Write the email in complete paragraphs. Be direct and straight to the point. Again, do NOT use bullet points in your email.
                     Here is an example of a customer inquiry and response format.
                     Customer Inquiry:
 
@@ -339,46 +368,363 @@ def generate_response_for_webhook(inquiry_text):
 
                     The Air2S should be supported from this link: https://play.google.com/store/apps/details?id=com.skyebrowse.android&pli=1. Alternatively, you can also manually record a video and upload it using the Universal Upload option."""
 
+def webhook_system_instruction():
+    """The current email system prompt from the registry, or WEBHOOK_SYSTEM_INSTRUCTION without a prompt file."""
+    try:
+        return prompt_registry.text("email")
+    except (OSError, ValueError):
+        return WEBHOOK_SYSTEM_INSTRUCTION
+
+def webhook_model_str(inquiry_text, history=None, drone_match=None):
+    """Model for an inquiry: the tier selected with -m, or the routed one with -m auto."""
+    return model_router.choose(inquiry_text, len(history or []) // 2, drone_match, mode=selected_model_name)["model"]
+
+def webhook_cache_namespace(kb=None):
+    """Response-cache namespace for a knowledge-base snapshot (default: the current one), prompt and model."""
+    kb = kb or current_knowledge_base()
+    return cache_namespace(kb["version"], webhook_system_instruction(), cache_model_key(selected_model_name))
+
+def history_to_contents(history):
+    """Converts stored session turns ({"role", "text"}) into Content objects."""
+    return [types.Content(role=turn["role"], parts=[types.Part.from_text(text=turn["text"])]) for turn in history]
+
+def build_webhook_request(inquiry_text, history=None, kb=None):
+    """Builds the model name, contents and config shared by the blocking and streaming webhook paths.
+
+    `history` holds earlier turns of the email thread; they go between the documents and the inquiry.
+    `kb` is the knowledge-base snapshot the request started with (default: the current one).
+    """
+    kb = kb or current_knowledge_base()
+    drone_index, file_parts = kb["drone_index"], list(kb["file_parts"])
+    earlier_turns = history_to_contents(history or [])
+    system_text = webhook_system_instruction()
+    # The rows replace the documents, so only a thread's first message uses them; follow-ups keep everything
+    drone_match = match_compatibility_inquiry(drone_index, inquiry_text) if not history else None
+    model_str = webhook_model_str(inquiry_text, history, drone_match)
+    logger.info(f"Using model: {model_str}")
+
+    if drone_match:
+        # Compatibility question: the matching Supported Drones rows replace the documents
+        logger.info(f"Drone lookup matched {', '.join(drone_match['models'])} ({len(drone_match['rows'])} rows).")
+        rows_part = types.Part.from_text(text=f"--- {drone_index.source} (matching entries) ---\n{format_rows(drone_match)}")
+        contents = earlier_turns + [types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)])]
+        contents[0] = types.Content(role=contents[0].role, parts=[rows_part] + list(contents[0].parts))
         generate_content_config = types.GenerateContentConfig(
             response_mime_type="text/plain",
-            system_instruction=[types.Part.from_text(text=system_instruction_text)],
-            # Removed temperature as it might not be needed for direct responses
+            system_instruction=[prompt_registry.part_for(system_text)],
         )
+        return model_str, contents, generate_content_config
 
-        # Using generate_content for simpler webhook response (no streaming needed)
-        response = genai_client.models.get(model_str).generate_content(
-             contents=contents,
-             config=generate_content_config,
+    cache_name = None
+    if context_cache and file_parts:
+        cache_name = context_cache.get_cache_name(
+            model_str, kb["version"], system_text, file_parts, as_system_instruction=True
         )
 
-        # Extract text safely
-        if response.candidates and response.candidates[0].content.parts:
-             response_text = response.candidates[0].content.parts[0].text
-        else:
-             response_text = "No response generated."
-             logger.warning("Received empty response from GenAI.")
-
-        # Log token usage if available
-        if response.usage_metadata:
-             logger.info(f"GenAI Token Usage: Input={response.usage_metadata.prompt_token_count}, Output={response.usage_metadata.candidates_token_count}, Total={response.usage_metadata.total_token_count}")
+    if cache_name:
+        # System instruction and files are served from the cache; only the thread and inquiry are sent
+        contents = earlier_turns + [types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)])]
+        generate_content_config = types.GenerateContentConfig(
+            response_mime_type="text/plain",
+            cached_content=cache_name,
+        )
+        return model_str, contents, generate_content_config
+
+    contents, generate_content_config = inline_webhook_request(inquiry_text, history, kb)
+    return model_str, contents, generate_content_config
+
+def inline_webhook_request(inquiry_text, history, kb):
+    """(contents, config) with the system instruction and the snapshot's documents sent inline."""
+    file_parts = list(kb["file_parts"])
+    contents = history_to_contents(history or []) + [types.Content(role="user", parts=[types.Part.from_text(text=inquiry_text)])]
+    if file_parts: # Use the snapshot's prepared file parts, ahead of the thread's first message
+        contents[0] = types.Content(role="user", parts=file_parts + list(contents[0].parts))
+
+    generate_content_config = types.GenerateContentConfig(
+        response_mime_type="text/plain",
+        system_instruction=[prompt_registry.part_for(webhook_system_instruction())],
+        # Removed temperature as it might not be needed for direct responses
+    )
+    return contents, generate_content_config
+
+def inline_request_after_cache_error(error, generate_content_config, inquiry_text, history, kb):
+    """The inline (contents, config) to retry with when `error` means the referenced context cache is gone; None otherwise."""
+    cache_name = generate_content_config.cached_content
+    if not (cache_name and context_cache and is_missing_cache_error(error)):
+        return None
+    logger.warning(f"Context cache {cache_name} is no longer available ({error}); retrying with the documents inline.")
+    context_cache.forget(cache_name)
+    return inline_webhook_request(inquiry_text, history, kb)
 
+def generate_webhook_content(model_str, contents, generate_content_config, inquiry_text, history, kb):
+    """One generate_content call, retried once with the documents inline if its context cache is gone."""
+    try:
+        return genai_client.models.generate_content(model=model_str, contents=contents, config=generate_content_config)
     except Exception as e:
-        logger.error(f"An error occurred during GenAI generation: {e}", exc_info=True)
-        # Return a user-friendly error, but log the details
-        return f"Error generating response: {type(e).__name__}", 500 # Internal Server Error
+        retry = inline_request_after_cache_error(e, generate_content_config, inquiry_text, history, kb)
+        if not retry:
+            raise
+        return genai_client.models.generate_content(model=model_str, contents=retry[0], config=retry[1])
+
+def stream_webhook_content(model_str, contents, generate_content_config, inquiry_text, history, kb):
+    """Chunks of one streamed call, retried once inline if its context cache is gone before the first chunk."""
+    started = False
+    try:
+        for chunk in genai_client.models.generate_content_stream(model=model_str, contents=contents, config=generate_content_config):
+            started = True
+            yield chunk
+    except Exception as e:
+        retry = None if started else inline_request_after_cache_error(e, generate_content_config, inquiry_text, history, kb)
+        if not retry:
+            raise
+        yield from genai_client.models.generate_content_stream(model=model_str, contents=retry[0], config=retry[1])
+
+def usage_to_dict(usage_metadata):
+    """Converts GenAI usage metadata into a JSON-serializable dict (or None)."""
+    if not usage_metadata:
+        return None
+    return {
+        "input_tokens": usage_metadata.prompt_token_count,
+        "output_tokens": usage_metadata.candidates_token_count,
+        "total_tokens": usage_metadata.total_token_count,
+        "cached_tokens": cached_token_count(usage_metadata),
+    }
+
+def drone_template_response(inquiry_text, history=None, kb=None):
+    """Templated answer for a first-message compatibility question about one listed drone (None otherwise or when disabled)."""
+    if not DRONE_TEMPLATE_ANSWERS or history:
+        return None
+    return template_answer(match_compatibility_inquiry((kb or current_knowledge_base())["drone_index"], inquiry_text))
+
+def answer_webhook_inquiry(inquiry_text, history=None):
+    """Answers one inquiry with the pre-initialized client and files; generation errors propagate.
+
+    Returns (response_text, usage dict or None, source) where source is 'cache:<layer>', 'model'
+    'drone lookup' or 'empty'. Follow-ups in a thread (`history`) bypass the response cache.
+    """
+    kb = current_knowledge_base() # One snapshot for the whole request, even if a refresh swaps it meanwhile
+    templated = drone_template_response(inquiry_text, history, kb)
+    if templated:
+        logger.info("Response answered from the supported drones list.")
+        return templated, None, "drone lookup"
+
+    if response_cache and not history:
+        cached_response, cache_layer = response_cache.lookup(inquiry_text, webhook_cache_namespace(kb))
+        if cached_response:
+            logger.info(f"Response served from cache ({cache_layer} match).")
+            return cached_response, None, f"cache:{cache_layer}"
+
+    model_str, contents, generate_content_config = build_webhook_request(inquiry_text, history, kb)
+
+    # Using generate_content for simpler webhook response (no streaming needed)
+    start_time = time.perf_counter()
+    response = generate_webhook_content(model_str, contents, generate_content_config, inquiry_text, history, kb)
+    model_router.record(model_str, (time.perf_counter() - start_time) * 1000, response.usage_metadata)
+
+    # Extract text safely
+    if response.candidates and response.candidates[0].content.parts:
+         response_text = response.candidates[0].content.parts[0].text
+         source = "model"
+         if response_cache and not history:
+             response_cache.store(inquiry_text, webhook_cache_namespace(kb), response_text)
+    else:
+         response_text = "No response generated."
+         source = "empty"
+         logger.warning("Received empty response from GenAI.")
+
+    # Log token usage if available
+    usage = usage_to_dict(response.usage_metadata)
+    if usage:
+         logger.info(f"GenAI Token Usage: Input={usage['input_tokens']}, Cached={usage['cached_tokens']}, Output={usage['output_tokens']}, Total={usage['total_tokens']}")
+    return response_text, usage, source
+
+def thread_session(thread_id):
+    """Lock serializing requests for one email thread (a no-op without a thread id or session store)."""
+    if session_store and thread_id:
+        return session_store.lock(thread_id)
+    return contextlib.nullcontext()
+
+def thread_history(thread_id):
+    return session_store.get(thread_id) if session_store and thread_id else []
+
+def record_thread_turn(thread_id, inquiry_text, response_text):
+    if session_store and thread_id and response_text:
+        session_store.append(thread_id, inquiry_text, response_text)
+
+def generate_response_for_webhook(inquiry_text, thread_id=None):
+    """Generates a response using the pre-initialized client and files, continuing the thread if given."""
+    logger.info(f"Generating response for inquiry: {inquiry_text[:50]}...") # Log truncated inquiry
+    if not is_initialized or not genai_client:
+        logger.error("GenAI client not initialized. Cannot generate response.")
+        return "Error: Service not ready.", 503 # Service Unavailable
+
+    with thread_session(thread_id):
+        history = thread_history(thread_id)
+        if history:
+            logger.info(f"Continuing thread {thread_id} ({len(history) // 2} earlier exchanges).")
+        try:
+            response_text, _, source = answer_webhook_inquiry(inquiry_text, history)
+        except Exception as e:
+            logger.error(f"An error occurred during GenAI generation: {e}", exc_info=True)
+            # Return a user-friendly error, but log the details
+            return f"Error generating response: {type(e).__name__}", 500 # Internal Server Error
+        if source != "empty":
+            record_thread_turn(thread_id, inquiry_text, response_text)
 
     logger.info("Response generated successfully.")
     return response_text, 200 # OK
 
+def parse_batch_items(data):
+    """Validates a /webhook/batch body into [{"id", "inquiry"}] (raises ValueError with a client-facing message)."""
+    inquiries = data.get('inquiries') if isinstance(data, dict) else None
+    if not isinstance(inquiries, list) or not inquiries:
+        raise ValueError("Request body must contain a non-empty 'inquiries' list")
+    if len(inquiries) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} inquiries per batch")
+    items, seen = [], set()
+    for position, entry in enumerate(inquiries):
+        if isinstance(entry, str):
+            entry = {"inquiry": entry}
+        if not isinstance(entry, dict) or not entry.get('inquiry'):
+            raise ValueError(f"Item {position} is missing an 'inquiry' field")
+        item_id = str(position) if entry.get('id') is None else str(entry['id'])
+        if item_id in seen:
+            raise ValueError(f"Duplicate id '{item_id}'")
+        seen.add(item_id)
+        items.append({"id": item_id, "inquiry": entry['inquiry']})
+    return items
+
+def _positive_number(data, field, default, cast):
+    value = data.get(field, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0 or value == float("inf"):
+        raise ValueError(f"'{field}' must be a positive number")
+    return cast(value)
+
+def parse_batch_options(data, item_count):
+    """(concurrency, requests_per_minute) for a /webhook/batch body, clamped to the server maxima.
+
+    Raises ValueError with a client-facing message for non-numeric or non-positive values, or when
+    the rate budget could not get through `item_count` inquiries within MAX_BATCH_SECONDS.
+    """
+    concurrency = min(_positive_number(data, 'concurrency', BATCH_CONCURRENCY, int) or 1, MAX_BATCH_CONCURRENCY)
+    requests_per_minute = min(_positive_number(data, 'requests_per_minute', BATCH_REQUESTS_PER_MINUTE, float), MAX_BATCH_REQUESTS_PER_MINUTE)
+    if (item_count - 1) * 60 / requests_per_minute > MAX_BATCH_SECONDS:
+        raise ValueError(
+            f"{item_count} inquiries at {requests_per_minute:g} requests/min would not finish within {MAX_BATCH_SECONDS:g}s; "
+            "raise requests_per_minute or split the batch"
+        )
+    return concurrency, requests_per_minute
+
+def sse_event(event, data):
+    """Formats a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_response_for_webhook(inquiry_text, thread_id=None):
+    """Streams a response as Server-Sent Events, reporting time-to-first-token and per-chunk timing.
+
+    Emits one `chunk` event per streamed text piece and a final `done` event carrying the
+    full response, timing and token usage (or an `error` event if generation fails).
+    With a thread id, earlier turns of the thread are included and the new exchange recorded.
+    """
+    with thread_session(thread_id):
+        result = {}
+        yield from stream_events(inquiry_text, thread_history(thread_id), result)
+        record_thread_turn(thread_id, inquiry_text, result.get("response"))
+
+def stream_events(inquiry_text, history, result):
+    """SSE generator behind stream_response_for_webhook; sets result["response"] on success."""
+    logger.info(f"Streaming response for inquiry: {inquiry_text[:50]}...")
+    start_time = time.perf_counter()
+    first_token_ms = None
+    last_chunk_time = start_time
+    chunk_timings = []
+    response_text = ""
+    last_usage_metadata = None
+    kb = current_knowledge_base()
+
+    templated = drone_template_response(inquiry_text, history, kb)
+    cached_response, cache_layer = (templated, "drone lookup") if templated else (None, None)
+    if response_cache and not history and not cached_response:
+        cached_response, cache_layer = response_cache.lookup(inquiry_text, webhook_cache_namespace(kb))
+    if cached_response:
+        result["response"] = cached_response
+        elapsed_ms = round((time.perf_counter() - start_time) * 1000, 1)
+        logger.info(f"Streamed response served without a model call ({cache_layer}).")
+        yield sse_event("chunk", {"text": cached_response, "index": 0, "elapsed_ms": elapsed_ms})
+        yield sse_event("done", {
+            "response": cached_response,
+            "time_to_first_token_ms": elapsed_ms,
+            "total_ms": elapsed_ms,
+            "chunks": [{"index": 0, "elapsed_ms": elapsed_ms, "delta_ms": elapsed_ms, "chars": len(cached_response)}],
+            "usage": None,
+            "cached": cache_layer,
+        })
+        return
+
+    try:
+        model_str, contents, generate_content_config = build_webhook_request(inquiry_text, history, kb)
+        stream = stream_webhook_content(model_str, contents, generate_content_config, inquiry_text, history, kb)
+
+        for chunk in stream:
+            if hasattr(chunk, 'usage_metadata') and chunk.usage_metadata:
+                last_usage_metadata = chunk.usage_metadata
+            if not chunk.text:
+                continue
+            now = time.perf_counter()
+            elapsed_ms = (now - start_time) * 1000
+            if first_token_ms is None:
+                first_token_ms = elapsed_ms
+                logger.info(f"Time to first token: {first_token_ms:.0f} ms")
+                metrics.observe("time_to_first_token_seconds", elapsed_ms / 1000, model=model_str)
+            chunk_timings.append({
+                "index": len(chunk_timings),
+                "elapsed_ms": round(elapsed_ms, 1),
+                "delta_ms": round((now - last_chunk_time) * 1000, 1),
+                "chars": len(chunk.text),
+            })
+            last_chunk_time = now
+            response_text += chunk.text
+            yield sse_event("chunk", {"text": chunk.text, "index": len(chunk_timings) - 1, "elapsed_ms": round(elapsed_ms, 1)})
+
+    except Exception as e:
+        logger.error(f"An error occurred during streamed GenAI generation: {e}", exc_info=True)
+        yield sse_event("error", {"error": f"Error generating response: {type(e).__name__}"})
+        return
+
+    total_ms = (time.perf_counter() - start_time) * 1000
+    model_router.record(model_str, total_ms, last_usage_metadata)
+    if not response_text:
+        logger.warning("Received empty streamed response from GenAI.")
+    else:
+        result["response"] = response_text
+        if response_cache and not history:
+            response_cache.store(inquiry_text, webhook_cache_namespace(kb), response_text)
+    usage = usage_to_dict(last_usage_metadata)
+    if usage:
+        logger.info(f"GenAI Token Usage: Input={usage['input_tokens']}, Cached={usage['cached_tokens']}, Output={usage['output_tokens']}, Total={usage['total_tokens']}")
+    first_token_text = f"{first_token_ms:.0f} ms" if first_token_ms is not None else "n/a"
+    logger.info(f"Streamed {len(chunk_timings)} chunks. TTFT={first_token_text}, Total={total_ms:.0f} ms")
+
+    yield sse_event("done", {
+        "response": response_text,
+        "time_to_first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+        "total_ms": round(total_ms, 1),
+        "chunks": chunk_timings,
+        "usage": usage,
+    })
+
 # --- Flask App ---
 app = Flask(__name__)
 
-def initialize(download_flag, model_name):
+def initialize(download_flag, model_name, refresh_seconds=None):
     """Function to run before the first request to initialize everything."""
-    global selected_model_name # Declare intent to modify global
+    global selected_model_name, model_router # Declare intent to modify global
     selected_model_name = model_name # Store the selected model name
+    model_router = ModelRouter(model_name)
     logger.info(f"Flask starting up - performing initialization with model: {selected_model_name}...")
     prepare_context_files_and_client(download_flag)
+    if genai_client and load_drive_file_ids():
+        start_kb_refresher(refresh_seconds) # New Drive content is swapped in without a restart
     logger.info("Initialization attempt complete.") # Log regardless of success
 
 @app.route('/webhook', methods=['POST'])
@@ -399,25 +745,91 @@ def handle_webhook():
 
     data = request.get_json()
     inquiry = data.get('inquiry')
+    thread_id = data.get('thread_id') # Optional email thread ID; follow-ups keep the thread's context
+    if thread_id is not None:
+        thread_id = str(thread_id)
 
     if not inquiry:
         logger.warning("Missing 'inquiry' field in JSON payload.")
         return jsonify({"error": "Missing 'inquiry' field in request body"}), 400
 
+    # Streaming mode: {"stream": true} in the body or an SSE Accept header
+    wants_stream = data.get('stream') is True or 'text/event-stream' in request.headers.get('Accept', '')
+    if wants_stream:
+        return Response(
+            stream_with_context(stream_response_for_webhook(inquiry, thread_id)),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # Keep proxies from buffering the stream
+        )
+
     # Generate the response using the core logic
-    response_content, status_code = generate_response_for_webhook(inquiry)
+    response_content, status_code = generate_response_for_webhook(inquiry, thread_id)
 
     if status_code == 200:
+        if thread_id:
+            return jsonify({"response": response_content, "thread_id": thread_id}), status_code
         return jsonify({"response": response_content}), status_code
     else:
         # Handle errors reported by the generation function
         return jsonify({"error": response_content}), status_code
 
+@app.route('/webhook/batch', methods=['POST'])
+def handle_webhook_batch():
+    """Answers a list of inquiries concurrently: {"inquiries": [{"id", "inquiry"}, ...]}.
+
+    Returns {"results": [...], "summary": {...}} with per-item status, latency and token usage,
+    in request order. Optional "concurrency" and "requests_per_minute" fields tune the scheduling
+    (positive numbers, capped at WORKER_MAX_BATCH_CONCURRENCY and WORKER_MAX_BATCH_RPM).
+    """
+    logger.info("Received request at /webhook/batch")
+    if not is_initialized:
+        return jsonify({"error": "Service initializing, please try again shortly."}), 503
+    if not genai_client:
+        return jsonify({"error": "Service configuration error."}), 500
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 400
+
+    data = request.get_json()
+    try:
+        items = parse_batch_items(data)
+        concurrency, requests_per_minute = parse_batch_options(data, len(items))
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Invalid batch request: {e}")
+        return jsonify({"error": str(e)}), 400
+
+    start_time = time.perf_counter()
+    records = run_batch(items, answer_webhook_inquiry, concurrency=concurrency, requests_per_minute=requests_per_minute)
+    return jsonify({"results": records, "summary": summarize(records, time.perf_counter() - start_time)}), 200
+
+@app.route('/drive/notify', methods=['POST'])
+def handle_drive_notify():
+    """Drive push-notification target: schedules a knowledge-base refresh and returns at once."""
+    if DRIVE_NOTIFY_TOKEN and request.headers.get('X-Goog-Channel-Token') != DRIVE_NOTIFY_TOKEN:
+        logger.warning("Rejected /drive/notify with a missing or wrong channel token.")
+        return jsonify({"error": "Invalid channel token"}), 403
+    if not kb_refresher:
+        return jsonify({"error": "Knowledge-base refresh is not running."}), 503
+    logger.info(f"Drive notification ({request.headers.get('X-Goog-Resource-State', 'unknown')}); refresh scheduled.")
+    kb_refresher.trigger()
+    return jsonify({"status": "refresh scheduled"}), 202
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape target: latency histograms and token counters for this process."""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint."""
     if is_initialized and genai_client:
-        return jsonify({"status": "OK", "initialized": True}), 200
+        health = {"status": "OK", "initialized": True}
+        if response_cache:
+            health["response_cache"] = response_cache.stats()
+        if session_store:
+            health["sessions"] = session_store.stats()
+        health["model_routing"] = model_router.stats()
+        health["knowledge_base"] = knowledge_base_health()
+        return jsonify(health), 200
     elif is_initialized and not genai_client:
          return jsonify({"status": "Error", "initialized": True, "message": "Initialization complete but client unavailable."}), 500
     else:
@@ -430,7 +842,7 @@ if __name__ == '__main__':
     # For development: python worker.py [-d]
     args = parse_arguments()
     if not os.environ.get("FLASK_RUN_FROM_CLI"): # Avoid double init if using `flask run`
-         initialize(args.download, args.model)
+         initialize(args.download, args.model, args.refresh_seconds)
 
     # Consider PORT from environment variable for flexibility
     port = int(os.environ.get("PORT", 8081)) # Use 8081 to avoid conflict
@@ -458,4 +870,8 @@ if __name__ == '__main__':
     # 5. Run the tunnel: `cloudflared tunnel run my-genai-webhook` (replace with your tunnel name/ID)
     #
     # Your webhook URL will be https://YOUR_ASSIGNED_CLOUDFLARE_URL/webhook
-    # Send POST requests to this URL with JSON body: {"inquiry": "Your customer question here"} 
\ No newline at end of file
+    # Send POST requests to this URL with JSON body: {"inquiry": "Your customer question here"}
+    # Add "thread_id": "<email thread id>" so replies in the same thread continue the conversation
+    # Add "stream": true (or send "Accept: text/event-stream") to receive Server-Sent Events:
+    #   event: chunk -> {"text", "index", "elapsed_ms"}
+    #   event: done  -> {"response", "time_to_first_token_ms", "total_ms", "chunks", "usage"} 
\ No newline at end of file
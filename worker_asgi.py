@@ -0,0 +1,370 @@
+import asyncio
+import os
+import time
+import weakref
+import logging
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+import worker
+from worker import sse_event, usage_to_dict
+from batch import run_batch, summarize
+import metrics
+
+# Async serving mode for the webhook worker. Same /webhook and /health contracts as worker.py,
+# but requests are served on one event loop through the GenAI client's async API (genai_client.aio),
+# so a single process can hold many in-flight inquiries without a thread per request. The client
+# reuses one httpx.AsyncClient for every async call; its connection pool bounds real concurrency.
+#
+#   python worker_asgi.py [-d] [-m flash|pro]
+#   uvicorn worker_asgi:app --port 8081   (set WORKER_DOWNLOAD=1 / WORKER_MODEL=pro instead of flags)
+
+logger = logging.getLogger(__name__)
+
+# --- Concurrency Settings ---
+# google-genai 1.8 builds its shared async httpx client with httpx's default limits (100 connections)
+# and HttpOptions cannot change them. Calls beyond the pool would wait inside httpx, unbounded and
+# invisible to queue_seconds, so the slot count never exceeds the pool and waiting happens here.
+HTTPX_POOL_SIZE = 100
+MAX_CONCURRENT_GENERATIONS = int(os.environ.get("WORKER_MAX_CONCURRENCY", HTTPX_POOL_SIZE))
+if MAX_CONCURRENT_GENERATIONS > HTTPX_POOL_SIZE:
+    logger.warning(f"WORKER_MAX_CONCURRENCY={MAX_CONCURRENT_GENERATIONS} exceeds the GenAI client's {HTTPX_POOL_SIZE}-connection pool; using {HTTPX_POOL_SIZE}.")
+    MAX_CONCURRENT_GENERATIONS = HTTPX_POOL_SIZE
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("WORKER_QUEUE_TIMEOUT_SECONDS", 30))
+
+generation_slots = None # asyncio.Semaphore limiting concurrent Gemini calls, created on startup
+in_flight = 0 # Generations currently holding a slot
+startup_options = {
+    "download": os.environ.get("WORKER_DOWNLOAD", "").lower() in ("1", "true", "yes"),
+    "model": os.environ.get("WORKER_MODEL", "flash"),
+    "refresh_seconds": None, # None: KB_REFRESH_SECONDS
+}
+
+thread_locks = weakref.WeakValueDictionary() # thread_id -> asyncio.Lock, dropped once no request holds it
+
+class ServiceBusy(Exception):
+    """Raised when no generation slot frees up within QUEUE_TIMEOUT_SECONDS."""
+
+@asynccontextmanager
+async def generation_slot():
+    """Holds one of the MAX_CONCURRENT_GENERATIONS slots for the duration of a Gemini call."""
+    global in_flight
+    try:
+        with metrics.timer("queue_seconds", stage="generation_slot"):
+            await asyncio.wait_for(generation_slots.acquire(), QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise ServiceBusy(f"no generation slot free after {QUEUE_TIMEOUT_SECONDS:.0f}s")
+    in_flight += 1
+    try:
+        yield
+    finally:
+        in_flight -= 1
+        generation_slots.release()
+
+@asynccontextmanager
+async def thread_session(thread_id):
+    """Serializes requests for one email thread and yields its earlier turns ([] without a thread id)."""
+    if not (worker.session_store and thread_id):
+        yield []
+        return
+    lock = thread_locks.get(thread_id)
+    if lock is None:
+        lock = thread_locks[thread_id] = asyncio.Lock()
+    async with lock:
+        yield await asyncio.to_thread(worker.thread_history, thread_id)
+
+async def record_thread_turn(thread_id, inquiry_text, response_text):
+    if worker.session_store and thread_id and response_text:
+        await asyncio.to_thread(worker.record_thread_turn, thread_id, inquiry_text, response_text)
+
+# --- Generation (async counterparts of worker.generate_response_for_webhook / stream_response_for_webhook) ---
+async def lookup_cached_response(inquiry_text, kb):
+    """(response, layer) answered without a model call: a templated drone answer or a response-cache hit."""
+    templated = worker.drone_template_response(inquiry_text, kb=kb)
+    if templated:
+        return templated, "drone lookup"
+    if not worker.response_cache:
+        return None, None
+    # Cache lookups may embed the inquiry, which is a blocking call
+    return await asyncio.to_thread(worker.response_cache.lookup, inquiry_text, worker.webhook_cache_namespace(kb))
+
+async def store_cached_response(inquiry_text, response_text, kb):
+    if worker.response_cache and response_text:
+        await asyncio.to_thread(worker.response_cache.store, inquiry_text, worker.webhook_cache_namespace(kb), response_text)
+
+async def generate_content_async(model_str, contents, generate_content_config, inquiry_text, history, kb):
+    """Async generate_content, retried once with the documents inline if its context cache is gone."""
+    try:
+        return await worker.genai_client.aio.models.generate_content(model=model_str, contents=contents, config=generate_content_config)
+    except Exception as e:
+        retry = worker.inline_request_after_cache_error(e, generate_content_config, inquiry_text, history, kb)
+        if not retry:
+            raise
+        return await worker.genai_client.aio.models.generate_content(model=model_str, contents=retry[0], config=retry[1])
+
+async def stream_content_async(model_str, contents, generate_content_config, inquiry_text, history, kb):
+    """Async chunks of one streamed call, retried once inline if its context cache is gone before the first chunk."""
+    started = False
+    try:
+        async for chunk in await worker.genai_client.aio.models.generate_content_stream(model=model_str, contents=contents, config=generate_content_config):
+            started = True
+            yield chunk
+    except Exception as e:
+        retry = None if started else worker.inline_request_after_cache_error(e, generate_content_config, inquiry_text, history, kb)
+        if not retry:
+            raise
+        async for chunk in await worker.genai_client.aio.models.generate_content_stream(model=model_str, contents=retry[0], config=retry[1]):
+            yield chunk
+
+async def generate_response_async(inquiry_text, thread_id=None):
+    """Generates a response with the shared async client. Returns (text, status code) like the Flask worker."""
+    async with thread_session(thread_id) as history:
+        response_text, status_code, recordable = await generate_with_history(inquiry_text, history)
+        if recordable:
+            await record_thread_turn(thread_id, inquiry_text, response_text)
+        return response_text, status_code
+
+async def generate_with_history(inquiry_text, history):
+    """Returns (text, status code, whether the text is a real answer worth recording in the thread)."""
+    logger.info(f"Generating response for inquiry: {inquiry_text[:50]}...")
+    kb = worker.current_knowledge_base() # Kept for the whole request, even if a refresh swaps in a new one
+    if not history: # Follow-ups depend on the thread, so only first messages use the response cache
+        cached_response, cache_layer = await lookup_cached_response(inquiry_text, kb)
+        if cached_response:
+            logger.info(f"Response served from cache ({cache_layer} match).")
+            return cached_response, 200, True
+
+    try:
+        async with generation_slot():
+            # Context-cache lookup/renewal uses the blocking client, so it runs off the event loop
+            model_str, contents, generate_content_config = await asyncio.to_thread(worker.build_webhook_request, inquiry_text, history, kb)
+            start_time = time.perf_counter()
+            response = await generate_content_async(model_str, contents, generate_content_config, inquiry_text, history, kb)
+            worker.model_router.record(model_str, (time.perf_counter() - start_time) * 1000, response.usage_metadata)
+    except ServiceBusy as e:
+        logger.warning(f"Rejecting inquiry: {e}")
+        return "Service busy, please try again shortly.", 503, False
+    except Exception as e:
+        logger.error(f"An error occurred during GenAI generation: {e}", exc_info=True)
+        return f"Error generating response: {type(e).__name__}", 500, False
+
+    usage = usage_to_dict(response.usage_metadata)
+    if usage:
+        logger.info(f"GenAI Token Usage: Input={usage['input_tokens']}, Cached={usage['cached_tokens']}, Output={usage['output_tokens']}, Total={usage['total_tokens']}")
+    if not (response.candidates and response.candidates[0].content.parts):
+        logger.warning("Received empty response from GenAI.")
+        return "No response generated.", 200, False
+    response_text = response.candidates[0].content.parts[0].text
+    if not history:
+        await store_cached_response(inquiry_text, response_text, kb)
+    return response_text, 200, True
+
+async def stream_response_async(inquiry_text, thread_id=None):
+    """Async generator of Server-Sent Events with the same chunk/done/error payloads as the Flask worker."""
+    async with thread_session(thread_id) as history:
+        result = {}
+        async for event in stream_events_async(inquiry_text, history, result):
+            yield event
+        await record_thread_turn(thread_id, inquiry_text, result.get("response"))
+
+async def stream_events_async(inquiry_text, history, result):
+    logger.info(f"Streaming response for inquiry: {inquiry_text[:50]}...")
+    start_time = time.perf_counter()
+    first_token_ms = None
+    last_chunk_time = start_time
+    chunk_timings = []
+    response_text = ""
+    last_usage_metadata = None
+    kb = worker.current_knowledge_base()
+
+    cached_response, cache_layer = (None, None) if history else await lookup_cached_response(inquiry_text, kb)
+    if cached_response:
+        result["response"] = cached_response
+        elapsed_ms = round((time.perf_counter() - start_time) * 1000, 1)
+        logger.info(f"Streamed response served from cache ({cache_layer} match).")
+        yield sse_event("chunk", {"text": cached_response, "index": 0, "elapsed_ms": elapsed_ms})
+        yield sse_event("done", {
+            "response": cached_response,
+            "time_to_first_token_ms": elapsed_ms,
+            "total_ms": elapsed_ms,
+            "chunks": [{"index": 0, "elapsed_ms": elapsed_ms, "delta_ms": elapsed_ms, "chars": len(cached_response)}],
+            "usage": None,
+            "cached": cache_layer,
+        })
+        return
+
+    try:
+        async with generation_slot():
+            model_str, contents, generate_content_config = await asyncio.to_thread(worker.build_webhook_request, inquiry_text, history, kb)
+            async for chunk in stream_content_async(model_str, contents, generate_content_config, inquiry_text, history, kb):
+                if chunk.usage_metadata:
+                    last_usage_metadata = chunk.usage_metadata
+                if not chunk.text:
+                    continue
+                now = time.perf_counter()
+                elapsed_ms = (now - start_time) * 1000
+                if first_token_ms is None:
+                    first_token_ms = elapsed_ms
+                    logger.info(f"Time to first token: {first_token_ms:.0f} ms")
+                    metrics.observe("time_to_first_token_seconds", elapsed_ms / 1000, model=model_str)
+                chunk_timings.append({
+                    "index": len(chunk_timings),
+                    "elapsed_ms": round(elapsed_ms, 1),
+                    "delta_ms": round((now - last_chunk_time) * 1000, 1),
+                    "chars": len(chunk.text),
+                })
+                last_chunk_time = now
+                response_text += chunk.text
+                yield sse_event("chunk", {"text": chunk.text, "index": len(chunk_timings) - 1, "elapsed_ms": round(elapsed_ms, 1)})
+    except ServiceBusy as e:
+        logger.warning(f"Rejecting streamed inquiry: {e}")
+        yield sse_event("error", {"error": "Service busy, please try again shortly."})
+        return
+    except Exception as e:
+        logger.error(f"An error occurred during streamed GenAI generation: {e}", exc_info=True)
+        yield sse_event("error", {"error": f"Error generating response: {type(e).__name__}"})
+        return
+
+    total_ms = (time.perf_counter() - start_time) * 1000
+    worker.model_router.record(model_str, total_ms, last_usage_metadata)
+    if not response_text:
+        logger.warning("Received empty streamed response from GenAI.")
+    elif not history:
+        await store_cached_response(inquiry_text, response_text, kb)
+    result["response"] = response_text
+    usage = usage_to_dict(last_usage_metadata)
+    first_token_text = f"{first_token_ms:.0f} ms" if first_token_ms is not None else "n/a"
+    logger.info(f"Streamed {len(chunk_timings)} chunks. TTFT={first_token_text}, Total={total_ms:.0f} ms")
+
+    yield sse_event("done", {
+        "response": response_text,
+        "time_to_first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+        "total_ms": round(total_ms, 1),
+        "chunks": chunk_timings,
+        "usage": usage,
+    })
+
+# --- Routes ---
+async def handle_webhook(request):
+    logger.info("Received request at /webhook")
+    if not worker.is_initialized:
+        logger.warning("Initialization not yet complete. Returning 503.")
+        return JSONResponse({"error": "Service initializing, please try again shortly."}, status_code=503)
+
+    if not worker.genai_client:
+        logger.error("GenAI client is not available after initialization attempt. Returning 500.")
+        return JSONResponse({"error": "Service configuration error."}, status_code=500)
+
+    if "json" not in request.headers.get("content-type", ""):
+        logger.warning("Request is not JSON.")
+        return JSONResponse({"error": "Request must be JSON"}, status_code=400)
+    try:
+        data = await request.json()
+    except ValueError:
+        logger.warning("Request body is not valid JSON.")
+        return JSONResponse({"error": "Request must be JSON"}, status_code=400)
+
+    inquiry = data.get('inquiry') if isinstance(data, dict) else None
+    thread_id = str(data['thread_id']) if inquiry and data.get('thread_id') is not None else None
+    if not inquiry:
+        logger.warning("Missing 'inquiry' field in JSON payload.")
+        return JSONResponse({"error": "Missing 'inquiry' field in request body"}, status_code=400)
+
+    # Streaming mode: {"stream": true} in the body or an SSE Accept header
+    if data.get('stream') is True or 'text/event-stream' in request.headers.get('accept', ''):
+        return StreamingResponse(
+            stream_response_async(inquiry, thread_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    response_content, status_code = await generate_response_async(inquiry, thread_id)
+    if status_code == 200:
+        if thread_id:
+            return JSONResponse({"response": response_content, "thread_id": thread_id}, status_code=status_code)
+        return JSONResponse({"response": response_content}, status_code=status_code)
+    return JSONResponse({"error": response_content}, status_code=status_code)
+
+async def handle_webhook_batch(request):
+    """Same contract as the Flask worker's /webhook/batch; the batch runs on its own bounded thread pool."""
+    logger.info("Received request at /webhook/batch")
+    if not worker.is_initialized:
+        return JSONResponse({"error": "Service initializing, please try again shortly."}, status_code=503)
+    if not worker.genai_client:
+        return JSONResponse({"error": "Service configuration error."}, status_code=500)
+    try:
+        data = await request.json()
+        items = worker.parse_batch_items(data)
+        concurrency, requests_per_minute = worker.parse_batch_options(data, len(items))
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Invalid batch request: {e}")
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    start_time = time.perf_counter()
+    records = await asyncio.to_thread(
+        run_batch, items, worker.answer_webhook_inquiry, concurrency=concurrency, requests_per_minute=requests_per_minute
+    )
+    return JSONResponse({"results": records, "summary": summarize(records, time.perf_counter() - start_time)})
+
+async def metrics_endpoint(request):
+    """Prometheus scrape target (same metrics as the Flask worker's /metrics)."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+async def health_check(request):
+    """Same payload as the Flask worker, plus current generation concurrency."""
+    if worker.is_initialized and worker.genai_client:
+        health = {"status": "OK", "initialized": True}
+        if worker.response_cache:
+            health["response_cache"] = worker.response_cache.stats()
+        if worker.session_store:
+            health["sessions"] = worker.session_store.stats()
+        health["model_routing"] = worker.model_router.stats()
+        health["knowledge_base"] = worker.knowledge_base_health()
+        health["concurrency"] = {"in_flight": in_flight, "limit": MAX_CONCURRENT_GENERATIONS}
+        return JSONResponse(health, status_code=200)
+    elif worker.is_initialized and not worker.genai_client:
+        return JSONResponse({"status": "Error", "initialized": True, "message": "Initialization complete but client unavailable."}, status_code=500)
+    return JSONResponse({"status": "Initializing", "initialized": False}, status_code=503)
+
+async def handle_drive_notify(request):
+    """Drive push-notification target; same contract as the Flask worker's /drive/notify."""
+    if worker.DRIVE_NOTIFY_TOKEN and request.headers.get("X-Goog-Channel-Token") != worker.DRIVE_NOTIFY_TOKEN:
+        logger.warning("Rejected /drive/notify with a missing or wrong channel token.")
+        return JSONResponse({"error": "Invalid channel token"}, status_code=403)
+    if not worker.kb_refresher:
+        return JSONResponse({"error": "Knowledge-base refresh is not running."}, status_code=503)
+    logger.info(f"Drive notification ({request.headers.get('X-Goog-Resource-State', 'unknown')}); refresh scheduled.")
+    worker.kb_refresher.trigger()
+    return JSONResponse({"status": "refresh scheduled"}, status_code=202)
+
+@asynccontextmanager
+async def lifespan(app):
+    global generation_slots
+    generation_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+    # Initialize in the background so /health can answer "Initializing" while files sync and upload
+    init_task = asyncio.create_task(asyncio.to_thread(
+        worker.initialize, startup_options["download"], startup_options["model"], startup_options["refresh_seconds"]
+    ))
+    yield
+    if not init_task.done():
+        init_task.cancel()
+
+app = Starlette(
+    routes=[
+        Route("/webhook", handle_webhook, methods=["POST"]),
+        Route("/webhook/batch", handle_webhook_batch, methods=["POST"]),
+        Route("/drive/notify", handle_drive_notify, methods=["POST"]),
+        Route("/health", health_check, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    args = worker.parse_arguments()
+    startup_options.update(download=args.download, model=args.model, refresh_seconds=args.refresh_seconds)
+    port = int(os.environ.get("PORT", 8081))
+    # One process is enough: concurrency comes from the event loop, bounded by WORKER_MAX_CONCURRENCY
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level="info")